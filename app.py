@@ -1,21 +1,53 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_file, g, abort, session
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import Counter, OrderedDict, namedtuple
 import csv
 import io
 import xlsxwriter
 import secrets
 import json
 from xhtml2pdf import pisa
+from pypdf import PdfReader
 import requests
+import threading
+import bisect
+import time
+import click
+import hashlib
+import tempfile
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import multiprocessing
+import math
+import pickle
+import sqlite3
+import gzip
+import zlib
+try:
+    import redis
+except ImportError:
+    redis = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
 app.config['SENDGRID_API_KEY'] = os.environ.get('SENDGRID_API_KEY', '')
+app.config['SENDGRID_API_URL'] = os.environ.get('SENDGRID_API_URL', 'https://api.sendgrid.com/v3/mail/send')
 
 database_url = os.environ.get('DATABASE_URL', 'sqlite:///attendance.db')
 if database_url.startswith('postgres://'):
@@ -70,6 +102,7 @@ class Department(db.Model):
         for name in defaults:
             dept = Department(name=name, organization_id=organization_id)
             db.session.add(dept)
+        invalidate_reference_data()
         db.session.commit()
 
 
@@ -173,6 +206,10 @@ class User(db.Model, UserMixin):
 
 class Staff(db.Model):
     __tablename__ = 'staff'
+    __table_args__ = (
+        db.Index('ix_staff_school_active', 'school_id', 'is_active'),
+        db.Index('ix_staff_staff_id', 'staff_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     staff_id = db.Column(db.String(20), nullable=False)
     name = db.Column(db.String(100), nullable=False)
@@ -180,6 +217,9 @@ class Staff(db.Model):
     school_id = db.Column(db.Integer, db.ForeignKey('schools.id'), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     times_late = db.Column(db.Integer, default=0)
+    # Maintained by send_query so query tracking never has to count staff_queries
+    query_count = db.Column(db.Integer, default=0)
+    last_queried_at = db.Column(db.DateTime, nullable=True)
     email = db.Column(db.String(120), nullable=True)
     phone = db.Column(db.String(20), nullable=True)
     photo_url = db.Column(db.String(500), nullable=True)
@@ -204,6 +244,9 @@ class Shift(db.Model):
 
 class StaffShiftAssignment(db.Model):
     __tablename__ = 'staff_shift_assignments'
+    __table_args__ = (
+        db.Index('ix_staff_shift_assignments_staff_active', 'staff_id', 'is_active'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     staff_id = db.Column(db.Integer, db.ForeignKey('staff.id'), nullable=False)
     shift_id = db.Column(db.Integer, db.ForeignKey('shifts.id'), nullable=False)
@@ -217,6 +260,11 @@ class StaffShiftAssignment(db.Model):
 
 class Attendance(db.Model):
     __tablename__ = 'attendance'
+    __table_args__ = (
+        # One row per staff member and day; sync relies on it to insert without reading first
+        db.Index('uq_attendance_staff_date', 'staff_id', 'date', unique=True),
+        db.Index('ix_attendance_date', 'date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     staff_id = db.Column(db.Integer, db.ForeignKey('staff.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
@@ -228,6 +276,26 @@ class Attendance(db.Model):
     overtime_minutes = db.Column(db.Integer, default=0)
 
 
+class AttendanceArchive(db.Model):
+    """Attendance older than the retention window, moved out by archive-attendance with its id unchanged"""
+    __tablename__ = 'attendance_archive'
+    __table_args__ = (
+        db.Index('uq_attendance_archive_staff_date', 'staff_id', 'date', unique=True),
+        db.Index('ix_attendance_archive_date', 'date'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    staff_id = db.Column(db.Integer, db.ForeignKey('staff.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    sign_in_time = db.Column(db.DateTime, nullable=True)
+    sign_out_time = db.Column(db.DateTime, nullable=True)
+    status = db.Column(db.String(20), default='present')
+    is_late = db.Column(db.Boolean, default=False)
+    late_minutes = db.Column(db.Integer, default=0)
+    overtime_minutes = db.Column(db.Integer, default=0)
+    
+    staff = db.relationship('Staff', backref=db.backref('archived_attendance', lazy=True, cascade='all, delete-orphan'))
+
+
 class QueryTemplate(db.Model):
     __tablename__ = 'query_templates'
     id = db.Column(db.Integer, primary_key=True)
@@ -239,6 +307,8 @@ class QueryTemplate(db.Model):
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
+    # Bumped on every edit so compiled renderers keyed by (id, version) never go stale
+    version = db.Column(db.Integer, default=1)
     
     organization = db.relationship('Organization', backref='query_templates')
     creator = db.relationship('User', backref='created_templates')
@@ -246,33 +316,680 @@ class QueryTemplate(db.Model):
 
 class StaffQuery(db.Model):
     __tablename__ = 'staff_queries'
+    __table_args__ = (
+        db.Index('ix_staff_queries_staff_sent', 'staff_id', 'sent_at', 'id'),
+        db.Index('ix_staff_queries_sent', 'sent_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     staff_id = db.Column(db.Integer, db.ForeignKey('staff.id'), nullable=False)
     template_id = db.Column(db.Integer, db.ForeignKey('query_templates.id'), nullable=False)
     sent_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     sent_at = db.Column(db.DateTime, default=datetime.utcnow)
     times_late_at_query = db.Column(db.Integer, default=0)
-    email_status = db.Column(db.String(20), default='pending')
+    email_status = db.Column(db.String(20), default='pending', index=True)
+    # Outbox fields: the rendered SendGrid payload and delivery bookkeeping
+    payload = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    claimed_by = db.Column(db.String(40), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    delivered_at = db.Column(db.DateTime, nullable=True)
     
     template = db.relationship('QueryTemplate', backref='queries_sent')
     sender = db.relationship('User', backref='queries_sent')
 
 
+class RecalculationJob(db.Model):
+    __tablename__ = 'recalculation_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id', ondelete='CASCADE'), nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(20), default='pending')
+    last_attendance_id = db.Column(db.Integer, default=0)
+    total_records = db.Column(db.Integer, default=0)
+    processed_records = db.Column(db.Integer, default=0)
+    changed_records = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    school = db.relationship('School', backref=db.backref('recalculation_jobs', lazy=True, cascade='all, delete-orphan'))
+    
+    def to_dict(self):
+        percent = round((self.processed_records / self.total_records) * 100, 1) if self.total_records else (100.0 if self.status == 'completed' else 0.0)
+        return {
+            'id': self.id,
+            'school_id': self.school_id,
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            'status': self.status,
+            'total_records': self.total_records,
+            'processed_records': self.processed_records,
+            'changed_records': self.changed_records,
+            'percent': percent,
+            'error': self.error,
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S') if self.updated_at else None
+        }
+
+
+class AttendanceDailyStats(db.Model):
+    __tablename__ = 'attendance_daily_stats'
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id', ondelete='CASCADE'), primary_key=True)
+    department = db.Column(db.String(50), primary_key=True)
+    date = db.Column(db.Date, primary_key=True, index=True)
+    present_count = db.Column(db.Integer, default=0)
+    late_count = db.Column(db.Integer, default=0)
+    late_minutes_sum = db.Column(db.Integer, default=0)
+    overtime_minutes_sum = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class AttendanceArrivalBucket(db.Model):
+    __tablename__ = 'attendance_arrival_buckets'
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id', ondelete='CASCADE'), primary_key=True)
+    department = db.Column(db.String(50), primary_key=True)
+    date = db.Column(db.Date, primary_key=True, index=True)
+    bucket = db.Column(db.Integer, primary_key=True)  # minute of day // ARRIVAL_BUCKET_MINUTES
+    arrivals = db.Column(db.Integer, default=0)
+    late_arrivals = db.Column(db.Integer, default=0)
+
+
+class StaffLifetimeStats(db.Model):
+    """All-time attendance counters per staff; unlike Staff.times_late these are never reset"""
+    __tablename__ = 'staff_lifetime_stats'
+    staff_id = db.Column(db.Integer, db.ForeignKey('staff.id', ondelete='CASCADE'), primary_key=True)
+    total_days = db.Column(db.Integer, default=0, nullable=False)
+    late_days = db.Column(db.Integer, default=0, nullable=False)
+    late_minutes = db.Column(db.Integer, default=0, nullable=False)
+    overtime_minutes = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    staff = db.relationship('Staff', backref=db.backref('lifetime_stats', uselist=False, lazy=True, cascade='all, delete-orphan'))
+
+
+class ExportJob(db.Model):
+    __tablename__ = 'export_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    job_key = db.Column(db.String(64), nullable=False, index=True)
+    export_type = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(20), default='pending')
+    file_path = db.Column(db.String(500), nullable=True)
+    filename = db.Column(db.String(255), nullable=True)
+    mimetype = db.Column(db.String(100), nullable=True)
+    file_size = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    completed_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True)
+    meta = db.Column(db.Text, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'export_type': self.export_type,
+            'params': json.loads(self.params) if self.params else {},
+            'status': self.status,
+            'filename': self.filename,
+            'file_size': self.file_size,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'completed_at': self.completed_at.strftime('%Y-%m-%d %H:%M:%S') if self.completed_at else None,
+            'expires_at': self.expires_at.strftime('%Y-%m-%d %H:%M:%S') if self.expires_at else None,
+            'meta': json.loads(self.meta) if self.meta else {},
+            'status_url': url_for('api_export_job', job_id=self.id),
+            'download_url': url_for('download_export', job_id=self.id) if self.status == 'completed' else None
+        }
+
+
+class SchemaVersion(db.Model):
+    """One row per applied migration step (see MIGRATIONS)"""
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class CacheVersion(db.Model):
+    """Version stamps shared by all processes; bumping one invalidates the caches built on it"""
+    __tablename__ = 'cache_versions'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 db.init_app(app)
 login_manager.init_app(app)
 
 
+# ==================== CACHE LAYER ====================
+
+# memory:// (per process), sqlite:///path/to/cache.db (shared by the workers on one host)
+# or redis://host:port/db (shared by every host; needs the optional redis package)
+CACHE_URL = os.environ.get('CACHE_URL', 'memory://')
+CACHE_PREFIX = os.environ.get('CACHE_PREFIX', 'attendance')
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 2048))
+CACHE_DEFAULT_TTL = int(os.environ.get('CACHE_DEFAULT_TTL', 3600))
+# How long get_or_set waits on another caller computing the same key before computing it too
+CACHE_LOCK_SECONDS = float(os.environ.get('CACHE_LOCK_SECONDS', 30))
+# How long a process trusts its copy of a version stamp before re-reading it
+CACHE_VERSION_CHECK_SECONDS = float(os.environ.get('CACHE_VERSION_CHECK_SECONDS', 5))
+_cache_versions = {}
+_cache_versions_lock = threading.Lock()
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache_versions(names, fresh=False):
+    """
+    Current version of each stamp, re-reading the ones this process has not checked lately
+    (or all of them when fresh, for answers that must not lag other processes' writes)
+    """
+    now = time.time()
+    versions = {}
+    stale = []
+    with _cache_versions_lock:
+        for name in names:
+            cached = _cache_versions.get(name)
+            if cached and not fresh and now - cached[1] < CACHE_VERSION_CHECK_SECONDS:
+                versions[name] = cached[0]
+            else:
+                stale.append(name)
+    if stale:
+        rows = dict(db.session.query(CacheVersion.name, CacheVersion.version).filter(CacheVersion.name.in_(stale)).all())
+        with _cache_versions_lock:
+            for name in stale:
+                versions[name] = rows.get(name) or 0
+                _cache_versions[name] = (versions[name], now)
+    return versions
+
+
+def get_cache_version(name):
+    return get_cache_versions([name])[name]
+
+
+def bump_cache_version(name):
+    """Invalidate everything stamped with `name`, in every process; the caller commits"""
+    updated = CacheVersion.query.filter_by(name=name).update({
+        CacheVersion.version: CacheVersion.version + 1,
+        CacheVersion.updated_at: datetime.utcnow()
+    }, synchronize_session=False)
+    if not updated:
+        try:
+            with db.session.begin_nested():
+                db.session.add(CacheVersion(name=name, version=1))
+        except Exception:
+            # Another process created the row first
+            CacheVersion.query.filter_by(name=name).update({
+                CacheVersion.version: CacheVersion.version + 1
+            }, synchronize_session=False)
+    with _cache_versions_lock:
+        _cache_versions.pop(name, None)
+
+
+def invalidate_tags(*tags):
+    """Invalidate every cache entry carrying any of these tags; the caller commits"""
+    for tag in dict.fromkeys(tags):
+        bump_cache_version(tag)
+
+
+def branch_cache_tag(school_id):
+    return f'branch:{school_id}'
+
+
+def invalidate_branch_data(school_ids):
+    """Call when attendance, staff or shifts of these branches change; the caller commits"""
+    invalidate_tags(*(branch_cache_tag(sid) for sid in school_ids if sid))
+
+
+def branch_data_version(school_ids, fresh=False):
+    """Digest of the data version counters of these branches and of the reference data"""
+    names = ['reference'] + [branch_cache_tag(sid) for sid in sorted(set(school_ids))]
+    versions = get_cache_versions(names, fresh=fresh)
+    return hashlib.sha1(repr([(name, versions[name]) for name in names]).encode('utf-8')).hexdigest()
+
+
+class MemoryCacheBackend:
+    """LRU dictionary private to this process; values are stored as-is"""
+    shared = False
+    
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def _live(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self.entries[key]
+            return None
+        return entry
+    
+    def _store(self, key, value, ttl):
+        self.entries[key] = (value, time.time() + ttl if ttl else None)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def get(self, key):
+        with self.lock:
+            entry = self._live(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+    
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._store(key, value, ttl)
+    
+    def add(self, key, value, ttl=None):
+        with self.lock:
+            if self._live(key) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+    
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+    
+    def clear(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+
+class SqliteCacheBackend:
+    """Table in a local SQLite file (WAL mode), shared by every worker process on the host"""
+    shared = True
+    PURGE_EVERY = 500
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)'
+        )
+    
+    def connection(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+    
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)', (key, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+    
+    def _written(self, conn):
+        self.writes += 1
+        if self.writes % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+    
+    def set(self, key, value, ttl=None):
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                     (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl if ttl else None))
+        self._written(conn)
+    
+    def add(self, key, value, ttl=None):
+        conn = self.connection()
+        now = time.time()
+        conn.execute('DELETE FROM cache WHERE key = ? AND expires_at <= ?', (key, now))
+        cursor = conn.execute('INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                              (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl if ttl else None))
+        self._written(conn)
+        return cursor.rowcount == 1
+    
+    def delete(self, key):
+        self.connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+    
+    def clear(self, prefix):
+        self.connection().execute('DELETE FROM cache WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+
+
+class RedisCacheBackend:
+    """Any server speaking the Redis protocol; takes a redis.Redis-compatible client (fakeredis in tests)"""
+    shared = True
+    
+    def __init__(self, client):
+        self.client = client
+    
+    @staticmethod
+    def expiry(ttl):
+        return max(1, int(math.ceil(ttl))) if ttl else None
+    
+    def get(self, key):
+        value = self.client.get(key)
+        return pickle.loads(value) if value is not None else None
+    
+    def set(self, key, value, ttl=None):
+        self.client.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=self.expiry(ttl))
+    
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=self.expiry(ttl), nx=True))
+    
+    def delete(self, key):
+        self.client.delete(key)
+    
+    def clear(self, prefix):
+        batch = []
+        for key in self.client.scan_iter(match=prefix + '*', count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                self.client.delete(*batch)
+                batch = []
+        if batch:
+            self.client.delete(*batch)
+
+
+class Cache:
+    """
+    The app's one cache. Keys live under an organization namespace; entries may carry tags,
+    version stamps that invalidate every entry holding them when bumped; get_or_set lets one
+    caller compute a missing value while concurrent callers for the same key wait for it.
+    Backend failures are logged and read as misses, so an unreachable cache only costs speed.
+    None is never cached.
+    """
+    
+    def __init__(self, backend, prefix=CACHE_PREFIX):
+        self.backend = backend
+        self.prefix = prefix
+    
+    def key(self, namespace, name, *parts):
+        key = f'{self.prefix}:{namespace}:{name}'
+        if parts:
+            key += ':' + hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+        return key
+    
+    def _call(self, operation, key, *args, default=None):
+        try:
+            return getattr(self.backend, operation)(key, *args)
+        except Exception as e:
+            app.logger.warning(f"Cache {operation} failed for {key}: {e}")
+            return default
+    
+    def get(self, key):
+        entry = self._call('get', key)
+        if entry is None:
+            return None
+        tags, stamps, value = entry
+        if tags:
+            versions = get_cache_versions(tags)
+            if stamps != tuple(versions[tag] for tag in tags):
+                return None
+        return value
+    
+    def set(self, key, value, ttl=CACHE_DEFAULT_TTL, tags=(), stamps=None):
+        """Store value; pass the stamps read before computing it so a concurrent bump is not lost"""
+        if value is None:
+            return
+        tags = tuple(tags)
+        if stamps is None:
+            versions = get_cache_versions(tags)
+            stamps = tuple(versions[tag] for tag in tags)
+        self._call('set', key, (tags, stamps, value), ttl)
+    
+    def delete(self, key):
+        self._call('delete', key)
+    
+    def clear(self, namespace=None):
+        prefix = f'{self.prefix}:{namespace}:' if namespace else f'{self.prefix}:'
+        self._call('clear', prefix)
+    
+    def get_or_set(self, key, compute, ttl=CACHE_DEFAULT_TTL, tags=()):
+        value = self.get(key)
+        if value is not None:
+            return value
+        tags = tuple(tags)
+        versions = get_cache_versions(tags)
+        stamps = tuple(versions[tag] for tag in tags)
+        lock_key = key + ':lock'
+        token = secrets.token_hex(8)
+        deadline = time.time() + CACHE_LOCK_SECONDS
+        locked = self._call('add', lock_key, token, CACHE_LOCK_SECONDS, default=True)
+        while not locked:
+            time.sleep(0.05)
+            value = self.get(key)
+            if value is not None:
+                return value
+            if time.time() >= deadline:
+                # The holder is slow or gone; compute without the lock
+                break
+            locked = self._call('add', lock_key, token, CACHE_LOCK_SECONDS, default=True)
+        try:
+            value = compute()
+            self.set(key, value, ttl, tags, stamps)
+        finally:
+            if locked and self._call('get', lock_key) == token:
+                self.delete(lock_key)
+        return value
+
+
+def cache_namespace(organization_id=None):
+    return f'org{organization_id}' if organization_id else 'global'
+
+
+def create_cache_backend(url):
+    if url.startswith('sqlite:///'):
+        return SqliteCacheBackend(url[len('sqlite:///'):] or os.path.join(tempfile.gettempdir(), 'attendance-cache.db'))
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        if redis is None:
+            app.logger.warning("CACHE_URL points at Redis but the redis package is not installed; using the in-process cache")
+            return MemoryCacheBackend()
+        return RedisCacheBackend(redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2))
+    if url != 'memory://':
+        app.logger.warning(f"Unknown CACHE_URL {url!r}; using the in-process cache")
+    return MemoryCacheBackend()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = Cache(create_cache_backend(CACHE_URL))
+    return _cache
+
+
+def configure_cache(backend):
+    """Swap the backend, e.g. RedisCacheBackend(fakeredis.FakeRedis()) in tests"""
+    global _cache
+    with _cache_lock:
+        _cache = Cache(backend)
+    return _cache
+
+
+@app.cli.command('cache-clear')
+@click.option('--organization', 'organization_id', type=int, default=None, help='Only clear this organization\'s namespace')
+def cache_clear_command(organization_id):
+    """Drop cached entries from the configured cache backend"""
+    get_cache().clear(cache_namespace(organization_id) if organization_id else None)
+    click.echo(f"Cleared {cache_namespace(organization_id) if organization_id else 'all'} cache entries")
+
+
+# ==================== PRINCIPAL CACHE ====================
+
+def invalidate_principals():
+    """Call when users, their branch access, branches or organizations change"""
+    bump_cache_version('principals')
+
+
+def request_memo(key, compute):
+    """Compute a value at most once per request"""
+    memo = g.setdefault('_request_memo', {})
+    if key not in memo:
+        memo[key] = compute()
+    return memo[key]
+
+
+def forget_request_memo(key):
+    g.get('_request_memo', {}).pop(key, None)
+
+
+class Principal(UserMixin):
+    """
+    The signed-in user's role and branch access, built from User once and kept in the
+    shared cache until the 'principals' version changes. ORM lookups it still offers
+    (schools, organizations) run at most once per request.
+    """
+    
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.role = user.role
+        self.school_id = user.school_id
+        self.active = bool(user.is_active)
+        self.allowed_school_ids = tuple(s.id for s in user.allowed_schools)
+        if user.role == 'super_admin':
+            self.school_ids = tuple(sid for (sid,) in db.session.query(School.id).order_by(School.id).all())
+            self.organization_ids = tuple(oid for (oid,) in db.session.query(Organization.id).order_by(Organization.id).all())
+            self.display_organization_id = None
+        else:
+            schools = user.get_accessible_schools()
+            self.school_ids = tuple(s.id for s in schools)
+            self.organization_ids = tuple(sorted({s.organization_id for s in schools if s.organization_id}))
+            self.display_organization_id = schools[0].organization_id if schools else None
+    
+    @property
+    def is_active(self):
+        return self.active
+    
+    def get_initials(self):
+        return self.username[0].upper() if self.username else 'U'
+    
+    def get_accessible_school_ids(self):
+        return list(self.school_ids)
+    
+    def get_accessible_schools(self):
+        def load():
+            if self.role == 'super_admin':
+                return School.query.all()
+            if not self.school_ids:
+                return []
+            order = {sid: i for i, sid in enumerate(self.school_ids)}
+            return sorted(School.query.filter(School.id.in_(self.school_ids)).all(), key=lambda s: order[s.id])
+        return list(request_memo(('principal_schools', self.id), load))
+    
+    def get_accessible_organizations(self):
+        def load():
+            if self.role == 'super_admin':
+                return Organization.query.all()
+            if not self.organization_ids:
+                return []
+            return Organization.query.filter(Organization.id.in_(self.organization_ids)).all()
+        return list(request_memo(('principal_organizations', self.id), load))
+    
+    def get_display_organization(self):
+        if not self.display_organization_id:
+            return None
+        return db.session.get(Organization, self.display_organization_id)
+    
+    @property
+    def allowed_schools(self):
+        if not self.allowed_school_ids:
+            return []
+        return request_memo(('principal_allowed_schools', self.id),
+                            lambda: School.query.filter(School.id.in_(self.allowed_school_ids)).all())
+    
+    @property
+    def school(self):
+        return db.session.get(School, self.school_id) if self.school_id else None
+
+
+def get_principal(user_id):
+    cache = get_cache()
+    key = cache.key(cache_namespace(), 'principal', user_id)
+    principal = cache.get(key)
+    if principal is not None:
+        return principal
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    principal = Principal(user)
+    cache.set(key, principal, tags=('principals',))
+    return principal
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    try:
+        return get_principal(int(user_id))
+    except (TypeError, ValueError):
+        return None
+
+
+# ==================== REFERENCE CACHE ====================
+
+SettingsRef = namedtuple('SettingsRef', 'id company_name company_logo_url')
+OrganizationRef = namedtuple('OrganizationRef', 'id name logo_url hr_email hr_email_name')
+SchoolRef = namedtuple('SchoolRef', 'id name short_name time_format_24h organization_id logo_url work_days')
+DEFAULT_DEPARTMENT_NAMES = ['Academic', 'Administrative', 'Management', 'Non-Academic', 'Support Staff']
+
+
+class ReferenceData:
+    """Read-only snapshot of settings, organizations, branches and departments"""
+    
+    def __init__(self):
+        settings = SystemSettings.get_settings()
+        self.settings = SettingsRef(settings.id, settings.company_name, settings.company_logo_url)
+        self.organizations = {o.id: OrganizationRef(o.id, o.name, o.logo_url, o.hr_email, o.hr_email_name)
+                              for o in Organization.query.order_by(Organization.id).all()}
+        self.schools = {s.id: SchoolRef(s.id, s.name, s.short_name, s.time_format_24h, s.organization_id, s.logo_url, s.work_days)
+                        for s in School.query.order_by(School.id).all()}
+        self.departments = {}
+        for d in Department.query.order_by(Department.name).all():
+            self.departments.setdefault(d.organization_id, []).append((d.id, d.name))
+    
+    def school_label(self, school_id, default='-'):
+        school = self.schools.get(school_id)
+        return (school.short_name or school.name) if school else default
+    
+    def school_uses_24h(self, school_id):
+        school = self.schools.get(school_id)
+        return school.time_format_24h if school and school.time_format_24h is not None else True
+    
+    def organization_school_ids(self, organization_id):
+        return [s.id for s in self.schools.values() if s.organization_id == organization_id]
+
+
+def get_reference_data():
+    """The current snapshot; rebuilt only when the 'reference' version stamp moves"""
+    def load():
+        cache = get_cache()
+        return cache.get_or_set(cache.key(cache_namespace(), 'reference'), ReferenceData, tags=('reference',))
+    return request_memo('reference_data', load)
+
+
+def invalidate_reference_data():
+    """Call from any route that changes settings, organizations, branches or departments"""
+    bump_cache_version('reference')
+    forget_request_memo('reference_data')
 
 
 @app.context_processor
 def inject_settings():
     if current_user.is_authenticated:
-        settings = SystemSettings.get_settings()
-        user_org = current_user.get_display_organization()
-        return {'system_settings': settings, 'user_organization': user_org}
+        reference = get_reference_data()
+        user_org = reference.organizations.get(current_user.display_organization_id)
+        return {'system_settings': reference.settings, 'user_organization': user_org}
     return {'system_settings': None, 'user_organization': None}
 @app.template_filter('convert_to_12h')
 def convert_to_12h(time_str):
@@ -300,6 +1017,50 @@ def role_required(*roles):
     return decorator
 
 
+# Changes with each deploy so cached pages never outlive the templates that rendered them
+ETAG_SALT = os.environ.get('ETAG_SALT') or str(int(os.path.getmtime(__file__)))
+
+
+def request_branch_scope(branch_id=None):
+    """Branch ids a report or API request reads: the one in its URL, its organization's, or all the user can access"""
+    school_id = branch_id or request.args.get('school_id', type=int)
+    if school_id:
+        return [school_id]
+    organization_id = request.args.get('organization_id', type=int)
+    if organization_id:
+        return get_reference_data().organization_school_ids(organization_id)
+    return current_user.get_accessible_school_ids()
+
+
+def conditional_on_branch_data(f):
+    """
+    For GET views whose response depends only on branch data, the URL and the user: the
+    ETag combines those, and a request whose If-None-Match still matches gets a 304
+    before the view runs.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # A pending flash message has to be rendered, so the page cannot come from the browser cache
+        if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+            return f(*args, **kwargs)
+        fingerprint = repr((
+            ETAG_SALT, request.path, sorted(request.args.items(multi=True)), date.today(),
+            current_user.id, current_user.role, current_user.get_accessible_school_ids(),
+            branch_data_version(request_branch_scope(kwargs.get('branch_id')), fresh=True)
+        ))
+        etag = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return decorated_function
+
+
 def get_school_schedule(school, day_of_week):
     """Get schedule for a specific day (0=Monday, 6=Sunday)"""
     days = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
@@ -325,13 +1086,73 @@ def format_time_display(time_str, use_24h=True):
         return time_str
 
 
+DEFAULT_WORK_DAYS_MASK = 0b0011111  # mon-fri
+
+
+@lru_cache(maxsize=256)
+def compile_work_days_mask(work_days_str):
+    """Compile a 'mon,tue,...' string into a bitmask where bit 0 is Monday"""
+    day_names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+    work_days = [d.strip().lower() for d in (work_days_str or 'mon,tue,wed,thu,fri').split(',')]
+    mask = 0
+    for day_of_week, day in enumerate(day_names):
+        if day in work_days:
+            mask |= 1 << day_of_week
+    return mask
+
+
+def count_work_days_in_mask(mask, start_date, end_date):
+    """Count work days in [start_date, end_date] in O(1): whole weeks plus a partial week"""
+    if end_date < start_date:
+        return 0
+    full_weeks, remainder = divmod((end_date - start_date).days + 1, 7)
+    count = full_weeks * bin(mask).count('1')
+    first_weekday = start_date.weekday()
+    for i in range(remainder):
+        count += (mask >> ((first_weekday + i) % 7)) & 1
+    return count
+
+
+class WorkCalendar:
+    """Work-day bitmasks for a set of branches"""
+    
+    def __init__(self, schools):
+        self.masks = {s.id: compile_work_days_mask(s.work_days or 'mon,tue,wed,thu,fri') for s in schools}
+    
+    def mask(self, school_id):
+        return self.masks.get(school_id, DEFAULT_WORK_DAYS_MASK)
+    
+    def union_mask(self, school_ids=None):
+        """Days on which at least one of the branches works"""
+        mask = 0
+        for school_id in (self.masks.keys() if school_ids is None else school_ids):
+            mask |= self.mask(school_id)
+        return mask or DEFAULT_WORK_DAYS_MASK
+    
+    def is_work_day(self, school_id, target_date):
+        return bool((self.mask(school_id) >> target_date.weekday()) & 1)
+    
+    def count_work_days(self, school_id, start_date, end_date):
+        return count_work_days_in_mask(self.mask(school_id), start_date, end_date)
+    
+    def count_by_school(self, start_date, end_date):
+        return {school_id: count_work_days_in_mask(mask, start_date, end_date) for school_id, mask in self.masks.items()}
+    
+    def expected_attendance(self, staff_per_school, start_date, end_date):
+        """Sum of staff x working days, each branch counted against its own calendar"""
+        return sum(count * self.count_work_days(school_id, start_date, end_date) for school_id, count in staff_per_school.items())
+    
+    def work_day_flags(self, start_date, end_date, school_ids=None):
+        """Per-day flags for [start_date, end_date]: True where any of the branches works"""
+        mask = self.union_mask(school_ids)
+        first_weekday = start_date.weekday()
+        return [bool((mask >> ((first_weekday + i) % 7)) & 1) for i in range((end_date - start_date).days + 1)]
+
+
 def is_work_day(school, target_date):
     """Check if target_date is a work day for the school"""
-    work_days_str = school.work_days or 'mon,tue,wed,thu,fri'
-    work_days = [d.strip().lower() for d in work_days_str.split(',')]
-    day_names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
-    day_of_week = target_date.weekday()
-    return day_names[day_of_week] in work_days
+    mask = compile_work_days_mask(school.work_days or 'mon,tue,wed,thu,fri')
+    return bool((mask >> target_date.weekday()) & 1)
 
 
 def get_staff_schedule_for_date(staff, target_date):
@@ -442,77 +1263,466 @@ def check_staff_id_exists_in_org(staff_id, school_id, exclude_staff_id=None):
     return query.first()
 
 
-def send_query_email(staff, template, organization, sender, late_count=None, period_str=None):
-    if not staff.email:
-        return False, "Staff has no email address"
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS', 8))
+EMAIL_CONNECT_TIMEOUT = float(os.environ.get('EMAIL_CONNECT_TIMEOUT', 5))
+EMAIL_READ_TIMEOUT = float(os.environ.get('EMAIL_READ_TIMEOUT', 15))
+_email_session = None
+_email_executor = None
+_email_lock = threading.Lock()
+
+
+KEYSET_PAGE_SIZE = 50
+
+
+def make_keyset_cursor(*values):
+    """Opaque cursor for the row a page ended on, e.g. '2024-05-01T08:00:00|123'"""
+    return '|'.join(v.isoformat() if isinstance(v, (datetime, date)) else str(v) for v in values)
+
+
+def parse_keyset_cursor(cursor, *casts):
+    """Inverse of make_keyset_cursor; returns None for a missing or malformed cursor"""
+    if not cursor:
+        return None
+    # Only the last separators are structural; a leading text value may itself contain '|'
+    parts = cursor.rsplit('|', len(casts) - 1)
+    if len(parts) != len(casts):
+        return None
+    try:
+        return tuple(cast(part) for cast, part in zip(casts, parts))
+    except (ValueError, TypeError):
+        return None
+
+
+def refresh_staff_query_counters(staff_ids=None):
+    """Recompute Staff.query_count / last_queried_at from staff_queries"""
+    counts = db.session.query(
+        StaffQuery.staff_id, db.func.count(StaffQuery.id), db.func.max(StaffQuery.sent_at)
+    ).group_by(StaffQuery.staff_id)
+    reset = Staff.query
+    if staff_ids is not None:
+        counts = counts.filter(StaffQuery.staff_id.in_(staff_ids))
+        reset = reset.filter(Staff.id.in_(staff_ids))
+    reset.update({Staff.query_count: 0, Staff.last_queried_at: None}, synchronize_session=False)
+    updates = [{'id': staff_id, 'query_count': count, 'last_queried_at': last} for staff_id, count, last in counts.all()]
+    if updates:
+        db.session.bulk_update_mappings(Staff, updates)
+    return len(updates)
+
+
+def get_email_session():
+    """Keep-alive session shared by all SendGrid calls, sized so every dispatcher thread gets a pooled connection"""
+    global _email_session
+    with _email_lock:
+        if _email_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=EMAIL_WORKERS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _email_session = session
+        return _email_session
+
+
+def get_email_executor():
+    global _email_executor
+    with _email_lock:
+        if _email_executor is None:
+            _email_executor = ThreadPoolExecutor(max_workers=EMAIL_WORKERS, thread_name_prefix='email')
+        return _email_executor
+
+
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+# Placeholders a query template may use, and which of them are honoured in the subject
+QUERY_PLACEHOLDERS = ('staff_name', 'staff_id', 'department', 'branch', 'late_count', 'times_late', 'period',
+                      'current_date', 'date', 'organization_name', 'branch_name')
+QUERY_SUBJECT_PLACEHOLDERS = ('staff_name', 'date', 'period')
+_placeholder_re = re.compile(r'\{(\w+)\}')
+
+
+class CompiledQueryTemplate:
+    """
+    A query template's subject and body parsed once into token lists: literal strings
+    alternating with placeholder names. Rendering is a single join over the tokens.
+    """
     
-    api_key = app.config.get('SENDGRID_API_KEY')
-    if not api_key:
-        return False, "SendGrid API key not configured"
+    def __init__(self, subject, body):
+        self.subject_tokens = self.tokenize(subject, QUERY_SUBJECT_PLACEHOLDERS)
+        self.body_tokens = self.tokenize(body, QUERY_PLACEHOLDERS)
+        self.keys = tuple(sorted({token[1] for token in self.subject_tokens + self.body_tokens if token[0]}))
+    
+    @staticmethod
+    def tokenize(text, allowed):
+        tokens = []
+        pos = 0
+        for match in _placeholder_re.finditer(text or ''):
+            if match.group(1) not in allowed:
+                continue
+            if match.start() > pos:
+                tokens.append((False, text[pos:match.start()]))
+            tokens.append((True, match.group(1)))
+            pos = match.end()
+        if pos < len(text or ''):
+            tokens.append((False, text[pos:]))
+        return tokens
     
+    @staticmethod
+    def join(tokens, values):
+        return ''.join(values[value] if is_key else value for is_key, value in tokens)
+    
+    def render(self, values):
+        """Returns (subject, body) with every placeholder filled from values"""
+        return self.join(self.subject_tokens, values), self.join(self.body_tokens, values)
+    
+    def substitution_form(self):
+        """Returns (subject, body) with placeholders as SendGrid substitution tags"""
+        tags = {key: f'%{key}%' for key in self.keys}
+        return self.render(tags)
+
+
+def get_compiled_query_template(template):
+    # Edits bump the template's version, so older compilations are never read again and age out
+    cache = get_cache()
+    key = cache.key(cache_namespace(template.organization_id), 'query_template', template.id, template.version or 1)
+    return cache.get_or_set(key, lambda: CompiledQueryTemplate(template.subject, template.body))
+
+
+def find_unknown_placeholders(subject, body):
+    """Placeholders a template uses that will not be filled in, for validation on save"""
+    unknown = []
+    for text, allowed in ((subject, QUERY_SUBJECT_PLACEHOLDERS), (body, QUERY_PLACEHOLDERS)):
+        for name in _placeholder_re.findall(text or ''):
+            if name not in allowed and '{' + name + '}' not in unknown:
+                unknown.append('{' + name + '}')
+    return unknown
+
+
+def query_placeholder_values(staff, organization, late_count=None, period_str=None, today_str=None):
+    # Use passed late_count or fall back to staff.times_late; period defaults to "All Time"
+    actual_late_count = str(late_count if late_count is not None else staff.times_late)
+    branch_name = staff.school.name if staff.school else ''
+    today_str = today_str or datetime.now().strftime('%d/%m/%Y')
+    return {
+        'staff_name': staff.name,
+        'staff_id': staff.staff_id,
+        'department': staff.department or '',
+        'branch': branch_name,
+        'late_count': actual_late_count,
+        'times_late': actual_late_count,
+        'period': period_str if period_str else "All Time",
+        'current_date': today_str,
+        'date': today_str,
+        'organization_name': organization.name if organization else '',
+        'branch_name': branch_name
+    }
+
+
+def build_query_message(template, organization):
+    """The part of a query email shared by every recipient of the same template and Reply-To"""
     # Get verified sender email from environment
     from_email = os.environ.get('SENDGRID_FROM_EMAIL', 'noreply@wakatotech.com')
-    
-    # Reply-To: Use template's from_email, or organization's hr_email, or fallback
-    reply_to_email = None
-    if template.from_email:
-        reply_to_email = template.from_email
-    elif organization and organization.hr_email:
-        reply_to_email = organization.hr_email
-    
-    # Use passed late_count or fall back to staff.times_late
-    actual_late_count = late_count if late_count is not None else staff.times_late
-    
-    # Use passed period or default to "All Time"
-    actual_period = period_str if period_str else "All Time"
-    
-    # Replace placeholders in body
-    body = template.body
-    body = body.replace('{staff_name}', staff.name)
-    body = body.replace('{staff_id}', staff.staff_id)
-    body = body.replace('{department}', staff.department or '')
-    body = body.replace('{branch}', staff.school.name if staff.school else '')
-    body = body.replace('{late_count}', str(actual_late_count))
-    body = body.replace('{times_late}', str(actual_late_count))
-    body = body.replace('{period}', actual_period)
-    body = body.replace('{current_date}', datetime.now().strftime('%d/%m/%Y'))
-    body = body.replace('{date}', datetime.now().strftime('%d/%m/%Y'))
-    body = body.replace('{organization_name}', organization.name if organization else '')
-    body = body.replace('{branch_name}', staff.school.name if staff.school else '')
-    
-    # Replace placeholders in subject
-    subject = template.subject
-    subject = subject.replace('{staff_name}', staff.name)
-    subject = subject.replace('{date}', datetime.now().strftime('%d/%m/%Y'))
-    subject = subject.replace('{period}', actual_period)
-    
-    # Build email payload
-    email_data = {
-        'personalizations': [{'to': [{'email': staff.email}]}],
+    compiled = get_compiled_query_template(template)
+    subject, body = compiled.substitution_form()
+    keys = compiled.keys
+    message = {
         'from': {'email': from_email, 'name': 'HR Department'},
         'subject': subject,
         'content': [{'type': 'text/html', 'value': body}]
     }
-    
-    # Add Reply-To if available
+    # Reply-To: Use template's from_email, or organization's hr_email
+    reply_to_email = template.from_email or (organization.hr_email if organization else None)
     if reply_to_email:
-        email_data['reply_to'] = {'email': reply_to_email}
+        message['reply_to'] = {'email': reply_to_email}
+    return message, keys
+
+
+def build_query_personalization(staff, organization, keys, late_count=None, period_str=None, today_str=None):
+    """One recipient's personalization: address plus the substitution values its template uses"""
+    personalization = {'to': [{'email': staff.email}]}
+    if keys:
+        values = query_placeholder_values(staff, organization, late_count, period_str, today_str)
+        personalization['substitutions'] = {f'%{key}%': values[key] for key in keys}
+    return personalization
+
+
+def render_query_payload(payload):
+    """The (subject, body) a recipient received, with substitutions applied as SendGrid does"""
+    if 'message' not in payload:
+        return payload.get('subject', ''), payload['content'][0]['value']
+    substitutions = payload['personalization'].get('substitutions', {})
+    fill = lambda m: substitutions.get(m.group(0), m.group(0))
+    message = payload['message']
+    return re.sub(r'%\w+%', fill, message['subject']), re.sub(r'%\w+%', fill, message['content'][0]['value'])
+
+
+def group_query_payloads(payloads):
+    """
+    Merge outbox payloads that share a message into SendGrid requests of up to
+    SENDGRID_MAX_PERSONALIZATIONS recipients. Returns [(indexes, email_data)].
+    """
+    groups = {}
+    requests_out = []
+    for index, payload in enumerate(payloads):
+        if 'message' not in payload:
+            # A fully rendered single message
+            requests_out.append(([index], payload))
+            continue
+        key = json.dumps(payload['message'], sort_keys=True)
+        groups.setdefault(key, (payload['message'], []))[1].append(index)
+    for message, indexes in groups.values():
+        for i in range(0, len(indexes), SENDGRID_MAX_PERSONALIZATIONS):
+            chunk = indexes[i:i + SENDGRID_MAX_PERSONALIZATIONS]
+            email_data = dict(message)
+            email_data['personalizations'] = [payloads[j]['personalization'] for j in chunk]
+            requests_out.append((chunk, email_data))
+    return requests_out
+
+
+def post_sendgrid_email(email_data):
+    """
+    POST one payload to SendGrid (or SENDGRID_API_URL) through the shared session.
+    Returns (success, message, retryable); rate limits, 5xx and network errors are retryable.
+    """
+    api_key = app.config.get('SENDGRID_API_KEY')
+    if not api_key:
+        return False, "SendGrid API key not configured", False
     
     try:
-        response = requests.post(
-            'https://api.sendgrid.com/v3/mail/send',
+        response = get_email_session().post(
+            app.config['SENDGRID_API_URL'],
             headers={
                 'Authorization': f'Bearer {api_key}',
                 'Content-Type': 'application/json'
             },
-            json=email_data
+            json=email_data,
+            timeout=(EMAIL_CONNECT_TIMEOUT, EMAIL_READ_TIMEOUT)
         )
         if response.status_code in [200, 201, 202]:
-            return True, "Email sent successfully"
+            return True, "Email sent successfully", False
         else:
-            return False, f"SendGrid error: {response.status_code} - {response.text}"
+            retryable = response.status_code == 429 or response.status_code >= 500
+            return False, f"SendGrid error: {response.status_code} - {response.text}", retryable
     except Exception as e:
-        return False, str(e)
+        return False, str(e), True
+
+
+def post_sendgrid_personalizations(email_data):
+    """
+    POST a grouped payload and return one (success, message, retryable) per personalization.
+    SendGrid rejects the whole request when any recipient is invalid, so a non-retryable
+    rejection of a multi-recipient request is bisected until only the offending
+    personalizations fail.
+    """
+    personalizations = email_data.get('personalizations')
+    result = post_sendgrid_email(email_data)
+    if not personalizations:
+        return [result]
+    success, message, retryable = result
+    # Without an API key nothing was sent, so splitting the request cannot help
+    if success or retryable or len(personalizations) == 1 or not app.config.get('SENDGRID_API_KEY'):
+        return [result] * len(personalizations)
+    middle = len(personalizations) // 2
+    results = []
+    for part in (personalizations[:middle], personalizations[middle:]):
+        results.extend(post_sendgrid_personalizations(dict(email_data, personalizations=part)))
+    return results
+
+
+def dispatch_emails(payloads):
+    """
+    Send payloads in parallel on the email pool. Returns, in input order, a list of
+    per-personalization results for each payload.
+    """
+    if not payloads:
+        return []
+    if len(payloads) == 1:
+        return [post_sendgrid_personalizations(payloads[0])]
+    return list(get_email_executor().map(post_sendgrid_personalizations, payloads))
+
+
+# ==================== EMAIL OUTBOX ====================
+
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', SENDGRID_MAX_PERSONALIZATIONS))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 6))
+OUTBOX_BACKOFF_SECONDS = int(os.environ.get('OUTBOX_BACKOFF_SECONDS', 30))
+OUTBOX_BACKOFF_MAX_SECONDS = int(os.environ.get('OUTBOX_BACKOFF_MAX_SECONDS', 3600))
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', 300))
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', 5))
+# Set to 0 when a dedicated `flask email-worker` process delivers the outbox
+OUTBOX_IN_PROCESS = os.environ.get('OUTBOX_IN_PROCESS', '1') != '0'
+OUTBOX_THROUGHPUT_WINDOW = 300
+_outbox_thread = None
+_outbox_wake = threading.Event()
+_outbox_lock = threading.Lock()
+_outbox_counters = {'sent': 0, 'failed': 0, 'retried': 0, 'batches': 0, 'last_batch_at': None}
+_outbox_recent = []
+
+
+def outbox_backoff_seconds(attempts):
+    """Exponential backoff with jitter: 30s, 60s, 120s ... capped at OUTBOX_BACKOFF_MAX_SECONDS"""
+    delay = min(OUTBOX_BACKOFF_SECONDS * (2 ** max(attempts - 1, 0)), OUTBOX_BACKOFF_MAX_SECONDS)
+    return delay * (0.8 + 0.4 * secrets.randbelow(1000) / 1000)
+
+
+def outbox_claimable_filter(now):
+    return db.and_(StaffQuery.payload.isnot(None), db.or_(
+        db.and_(StaffQuery.email_status == 'pending',
+                db.or_(StaffQuery.next_attempt_at.is_(None), StaffQuery.next_attempt_at <= now)),
+        # A 'sending' row whose lease ran out belongs to a worker that died mid-batch
+        db.and_(StaffQuery.email_status == 'sending', StaffQuery.locked_until < now)
+    ))
+
+
+def claim_outbox_batch(worker_id, limit=None):
+    """
+    Claim up to `limit` due outbox rows for this worker. On PostgreSQL the candidates are
+    locked with FOR UPDATE SKIP LOCKED so concurrent workers never wait on each other; the
+    conditional UPDATE makes the claim safe on databases without row locks too.
+    """
+    now = datetime.utcnow()
+    candidates = db.session.query(StaffQuery.id).filter(
+        outbox_claimable_filter(now)
+    ).order_by(StaffQuery.id).limit(limit or OUTBOX_BATCH_SIZE)
+    if db.engine.dialect.name == 'postgresql':
+        candidates = candidates.with_for_update(skip_locked=True)
+    ids = [r.id for r in candidates.all()]
+    if not ids:
+        db.session.commit()
+        return []
+    StaffQuery.query.filter(StaffQuery.id.in_(ids), outbox_claimable_filter(now)).update({
+        StaffQuery.email_status: 'sending',
+        StaffQuery.claimed_by: worker_id,
+        StaffQuery.locked_until: now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+    }, synchronize_session=False)
+    db.session.commit()
+    return StaffQuery.query.filter(
+        StaffQuery.id.in_(ids), StaffQuery.claimed_by == worker_id, StaffQuery.email_status == 'sending'
+    ).order_by(StaffQuery.id).all()
+
+
+def record_outbox_results(sent, failed, retried):
+    now = time.time()
+    with _outbox_lock:
+        _outbox_counters['sent'] += sent
+        _outbox_counters['failed'] += failed
+        _outbox_counters['retried'] += retried
+        _outbox_counters['batches'] += 1
+        _outbox_counters['last_batch_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        _outbox_recent.append((now, sent))
+        while _outbox_recent and now - _outbox_recent[0][0] > OUTBOX_THROUGHPUT_WINDOW:
+            _outbox_recent.pop(0)
+
+
+def deliver_outbox_batch(worker_id):
+    """Claim and send one batch; returns the number of rows processed"""
+    rows = claim_outbox_batch(worker_id)
+    if not rows:
+        return 0
+    
+    # Recipients of the same message go out as one request; each comes back with its own outcome
+    batches = group_query_payloads([json.loads(r.payload) for r in rows])
+    results = [None] * len(rows)
+    for (indexes, _), batch_results in zip(batches, dispatch_emails([email_data for _, email_data in batches])):
+        for index, result in zip(indexes, batch_results):
+            results[index] = result
+    now = datetime.utcnow()
+    sent = failed = retried = 0
+    updates = []
+    for row, (success, message, retryable) in zip(rows, results):
+        attempts = (row.attempts or 0) + 1
+        update = {'id': row.id, 'attempts': attempts, 'claimed_by': None, 'locked_until': None}
+        if success:
+            update.update(email_status='sent', delivered_at=now, last_error=None)
+            sent += 1
+        elif retryable and attempts < OUTBOX_MAX_ATTEMPTS:
+            update.update(email_status='pending', last_error=message,
+                          next_attempt_at=now + timedelta(seconds=outbox_backoff_seconds(attempts)))
+            retried += 1
+        else:
+            update.update(email_status='failed', last_error=message)
+            failed += 1
+            app.logger.warning(f"Query email {row.id} to staff {row.staff_id} failed after {attempts} attempt(s): {message}")
+        updates.append(update)
+    db.session.bulk_update_mappings(StaffQuery, updates)
+    db.session.commit()
+    record_outbox_results(sent, failed, retried)
+    return len(rows)
+
+
+def next_outbox_due_in():
+    """Seconds until the next pending row is due, or None when the outbox is empty"""
+    row = db.session.query(
+        db.func.min(db.case((StaffQuery.email_status == 'sending', StaffQuery.locked_until), else_=StaffQuery.next_attempt_at)),
+        db.func.count(StaffQuery.id)
+    ).filter(StaffQuery.email_status.in_(['pending', 'sending'])).one()
+    if not row[1]:
+        return None
+    if row[0] is None:
+        return 0
+    return max((row[0] - datetime.utcnow()).total_seconds(), 0)
+
+
+def run_outbox_worker(worker_id=None, exit_when_idle=True):
+    """Deliver the outbox until it is empty (web thread) or forever (dedicated worker)"""
+    worker_id = worker_id or f'{os.getpid()}-{threading.get_ident()}'
+    with app.app_context():
+        try:
+            while True:
+                try:
+                    if deliver_outbox_batch(worker_id):
+                        continue
+                    due_in = next_outbox_due_in()
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Email outbox worker error: {e}")
+                    due_in = OUTBOX_POLL_SECONDS
+                if due_in is None and exit_when_idle:
+                    return
+                wait = OUTBOX_POLL_SECONDS if due_in is None else min(max(due_in, 0.1), OUTBOX_POLL_SECONDS)
+                _outbox_wake.wait(wait)
+                _outbox_wake.clear()
+        finally:
+            db.session.remove()
+
+
+def wake_outbox_worker():
+    """Start the in-process delivery thread if it is not running, and nudge it to poll now"""
+    global _outbox_thread
+    if not OUTBOX_IN_PROCESS:
+        return
+    with _outbox_lock:
+        if _outbox_thread is None or not _outbox_thread.is_alive():
+            _outbox_thread = threading.Thread(target=run_outbox_worker, name='email-outbox', daemon=True)
+            _outbox_thread.start()
+    _outbox_wake.set()
+
+
+def get_outbox_stats():
+    now = datetime.utcnow()
+    depth = dict(db.session.query(StaffQuery.email_status, db.func.count(StaffQuery.id)).filter(
+        StaffQuery.email_status.in_(['pending', 'sending'])).group_by(StaffQuery.email_status).all())
+    due = StaffQuery.query.filter(outbox_claimable_filter(now)).count()
+    oldest = db.session.query(db.func.min(StaffQuery.sent_at)).filter(
+        StaffQuery.email_status.in_(['pending', 'sending'])).scalar()
+    with _outbox_lock:
+        counters = dict(_outbox_counters)
+        window_sent = sum(n for ts, n in _outbox_recent if time.time() - ts <= OUTBOX_THROUGHPUT_WINDOW)
+    return {
+        'pending': depth.get('pending', 0),
+        'sending': depth.get('sending', 0),
+        'due': due,
+        'oldest_pending_seconds': int((now - oldest).total_seconds()) if oldest else None,
+        'sent_per_minute': round(window_sent * 60.0 / OUTBOX_THROUGHPUT_WINDOW, 2),
+        'worker_running': bool(_outbox_thread and _outbox_thread.is_alive()),
+        'process_totals': counters
+    }
+
+
+@app.cli.command('email-worker')
+@click.option('--once', is_flag=True, help='Deliver what is due and exit instead of polling forever.')
+def email_worker_command(once):
+    """Deliver queued query emails from the outbox."""
+    click.echo('Email outbox worker started.')
+    run_outbox_worker(exit_when_idle=once)
 
 
 def format_minutes_to_hours(minutes):
@@ -580,16 +1790,719 @@ def calculate_overtime(staff, sign_out_datetime, record_date):
         return 0
     except:
         return 0
-# ==================== AUTH ROUTES ====================
-
-@app.route('/')
-def index():
-    if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
-    return redirect(url_for('login'))
 
 
-@app.route('/login', methods=['GET', 'POST'])
+def parse_time_to_minutes(time_str):
+    """Convert an 'HH:MM' string to minutes after midnight, or None if invalid"""
+    if not time_str:
+        return None
+    try:
+        time_obj = datetime.strptime(time_str, '%H:%M')
+        return time_obj.hour * 60 + time_obj.minute
+    except:
+        return None
+
+
+def compile_branch_schedule(school):
+    """
+    Compile a branch's schedule into plain lookups so attendance rows can be
+    classified without per-row queries.
+    Mirrors get_staff_schedule_for_date: non-work days have no schedule, and in
+    shift mode the first active assignment covering the date wins.
+    """
+    work_days_mask = compile_work_days_mask(school.work_days or 'mon,tue,wed,thu,fri')
+    days = []
+    for day_of_week in range(7):
+        if (work_days_mask >> day_of_week) & 1:
+            start_time, end_time = get_school_schedule(school, day_of_week)
+            days.append((parse_time_to_minutes(start_time), parse_time_to_minutes(end_time)))
+        else:
+            days.append(None)
+    
+    assignments = {}
+    if school.shift_mode_enabled:
+        rows = db.session.query(
+            StaffShiftAssignment.staff_id,
+            StaffShiftAssignment.effective_from,
+            StaffShiftAssignment.effective_to,
+            Shift.is_active,
+            Shift.start_time,
+            Shift.end_time,
+            Shift.grace_period_minutes
+        ).join(
+            Shift, StaffShiftAssignment.shift_id == Shift.id
+        ).join(
+            Staff, StaffShiftAssignment.staff_id == Staff.id
+        ).filter(
+            Staff.school_id == school.id,
+            StaffShiftAssignment.is_active == True
+        ).order_by(StaffShiftAssignment.id).all()
+        for r in rows:
+            assignments.setdefault(r.staff_id, []).append((
+                r.effective_from,
+                r.effective_to,
+                bool(r.is_active),
+                parse_time_to_minutes(r.start_time),
+                parse_time_to_minutes(r.end_time),
+                r.grace_period_minutes or 0
+            ))
+    
+    return {
+        'days': days,
+        'grace': school.grace_period_minutes or 0,
+        'assignments': assignments
+    }
+
+
+def get_compiled_schedule_for_date(schedule, staff_id, target_date):
+    """Returns (start_minutes, end_minutes, grace_minutes, is_shift) or None on non-work days"""
+    day = schedule['days'][target_date.weekday()]
+    if day is None:
+        return None
+    for effective_from, effective_to, shift_active, start, end, grace in schedule['assignments'].get(staff_id, []):
+        if effective_from <= target_date and (effective_to is None or effective_to >= target_date):
+            if shift_active:
+                return start, end, grace, True
+            break
+    return day[0], day[1], schedule['grace'], False
+
+
+def classify_attendance(schedule, staff_id, department, record_date, sign_in_datetime, sign_out_datetime):
+    """
+    Classify one attendance row against a compiled schedule.
+    Returns (is_late, late_minutes, overtime_minutes), matching
+    calculate_late_status and calculate_overtime.
+    """
+    day_schedule = get_compiled_schedule_for_date(schedule, staff_id, record_date)
+    if day_schedule is None:
+        return False, 0, 0
+    start, end, grace, is_shift = day_schedule
+    
+    is_late = False
+    late_minutes = 0
+    if start is not None and sign_in_datetime and department != 'Management':
+        sign_in_seconds = sign_in_datetime.hour * 3600 + sign_in_datetime.minute * 60 + sign_in_datetime.second
+        if sign_in_seconds > ((start + grace) % 1440) * 60:
+            is_late = True
+            late_minutes = int((sign_in_seconds - start * 60) / 60)
+    
+    overtime_minutes = 0
+    if end is not None and sign_out_datetime:
+        sign_out_seconds = sign_out_datetime.hour * 3600 + sign_out_datetime.minute * 60 + sign_out_datetime.second
+        if sign_out_seconds > end * 60:
+            overtime_minutes = int((sign_out_seconds - end * 60) / 60)
+    
+    return is_late, late_minutes, overtime_minutes
+
+
+# ==================== ATTENDANCE RECALCULATION ====================
+
+RECALCULATION_BATCH_SIZE = int(os.environ.get('RECALCULATION_BATCH_SIZE', 1000))
+RECALCULATION_STALE_SECONDS = 120
+RECALCULATION_POLL_SECONDS = float(os.environ.get('RECALCULATION_POLL_SECONDS', 2))
+# Set to 0 when a dedicated `flask recalculation-worker` process runs the jobs; otherwise a web
+# process that queues a job starts a short-lived worker process for it
+RECALCULATION_SPAWN_WORKER = os.environ.get('RECALCULATION_SPAWN_WORKER', '1') != '0'
+_recalculation_process = None
+_recalculation_lock = threading.Lock()
+
+
+def recalculate_attendance_batch(job, schedule):
+    """
+    Reclassify the next batch of a job's attendance rows and write back only the
+    rows whose late/overtime values changed. Returns the number of rows read.
+    """
+    rows = db.session.query(
+        Attendance.id,
+        Attendance.staff_id,
+        Attendance.date,
+        Attendance.sign_in_time,
+        Attendance.sign_out_time,
+        Attendance.is_late,
+        Attendance.late_minutes,
+        Attendance.overtime_minutes,
+        Staff.department
+    ).join(
+        Staff, Attendance.staff_id == Staff.id
+    ).filter(
+        Staff.school_id == job.school_id,
+        Attendance.date >= job.start_date,
+        Attendance.date <= job.end_date,
+        Attendance.id > job.last_attendance_id
+    ).order_by(Attendance.id).limit(RECALCULATION_BATCH_SIZE).all()
+    
+    if not rows:
+        return 0
+    
+    changes = []
+    late_deltas = {}
+    lifetime_deltas = {}
+    for r in rows:
+        is_late, late_minutes, overtime_minutes = classify_attendance(
+            schedule, r.staff_id, r.department, r.date, r.sign_in_time, r.sign_out_time)
+        if is_late != bool(r.is_late) or late_minutes != (r.late_minutes or 0) or overtime_minutes != (r.overtime_minutes or 0):
+            changes.append({
+                'id': r.id,
+                'is_late': is_late,
+                'late_minutes': late_minutes,
+                'overtime_minutes': overtime_minutes
+            })
+            if is_late != bool(r.is_late) and r.department != 'Management':
+                late_deltas[r.staff_id] = late_deltas.get(r.staff_id, 0) + (1 if is_late else -1)
+            add_lifetime_deltas(
+                lifetime_deltas, r.staff_id,
+                late_days=int(is_late) - int(bool(r.is_late)),
+                late_minutes=(late_minutes if is_late else 0) - ((r.late_minutes or 0) if r.is_late else 0),
+                overtime_minutes=overtime_minutes - (r.overtime_minutes or 0)
+            )
+    
+    if changes:
+        db.session.bulk_update_mappings(Attendance, changes)
+    
+    # Group staff by delta so times_late is adjusted with one UPDATE per distinct delta
+    staff_by_delta = {}
+    for staff_id, delta in late_deltas.items():
+        if delta:
+            staff_by_delta.setdefault(delta, []).append(staff_id)
+    for delta, staff_ids in staff_by_delta.items():
+        Staff.query.filter(Staff.id.in_(staff_ids)).update({
+            Staff.times_late: db.case((Staff.times_late + delta < 0, 0), else_=Staff.times_late + delta)
+        }, synchronize_session=False)
+    apply_lifetime_deltas(lifetime_deltas)
+    
+    job.last_attendance_id = rows[-1].id
+    job.processed_records = (job.processed_records or 0) + len(rows)
+    job.changed_records = (job.changed_records or 0) + len(changes)
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    return len(rows)
+
+
+def recalculation_claimable_filter(now):
+    return db.or_(
+        RecalculationJob.status == 'pending',
+        # A running job whose worker died (restart, crash) stops updating its heartbeat
+        db.and_(RecalculationJob.status == 'running',
+                RecalculationJob.updated_at < now - timedelta(seconds=RECALCULATION_STALE_SECONDS))
+    )
+
+
+def claim_recalculation_job():
+    """Mark the oldest pending or abandoned job as running and return its id; the conditional UPDATE makes the claim safe across processes"""
+    while True:
+        now = datetime.utcnow()
+        candidate = db.session.query(RecalculationJob.id, RecalculationJob.updated_at).filter(
+            recalculation_claimable_filter(now)
+        ).order_by(RecalculationJob.id).first()
+        if not candidate:
+            db.session.commit()
+            return None
+        claimed = RecalculationJob.query.filter(
+            RecalculationJob.id == candidate.id, recalculation_claimable_filter(now),
+            # Unchanged heartbeat: no other worker claimed the job in between
+            RecalculationJob.updated_at.is_(None) if candidate.updated_at is None else RecalculationJob.updated_at == candidate.updated_at
+        ).update({
+            RecalculationJob.status: 'running',
+            RecalculationJob.error: None,
+            RecalculationJob.updated_at: now
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return candidate.id
+
+
+def run_recalculation_job(job_id):
+    """Process a claimed recalculation job batch by batch from its cursor"""
+    job = db.session.get(RecalculationJob, job_id)
+    if not job or job.status != 'running':
+        return
+    try:
+        schedule = compile_branch_schedule(job.school)
+        while recalculate_attendance_batch(job, schedule):
+            pass
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+        rebuild_attendance_cube(job.school_id, job.start_date, job.end_date)
+        job.status = 'completed'
+        job.total_records = max(job.total_records or 0, job.processed_records or 0)
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(RecalculationJob, job_id)
+        if job:
+            job.status = 'failed'
+            job.error = str(e)
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+
+
+def run_recalculation_worker(exit_when_idle=True):
+    """Run recalculation jobs until none are left (spawned worker) or forever (dedicated worker)"""
+    with app.app_context():
+        try:
+            while True:
+                try:
+                    job_id = claim_recalculation_job()
+                    if job_id:
+                        run_recalculation_job(job_id)
+                        continue
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Recalculation worker error: {e}")
+                if exit_when_idle:
+                    return
+                time.sleep(RECALCULATION_POLL_SECONDS)
+        finally:
+            db.session.remove()
+
+
+def start_recalculation_worker():
+    """Start a worker process for queued jobs unless the one this web process started is still running"""
+    global _recalculation_process
+    if not RECALCULATION_SPAWN_WORKER:
+        return
+    with _recalculation_lock:
+        if _recalculation_process is None or not _recalculation_process.is_alive():
+            # Spawned rather than forked so no DB connections or locks are inherited
+            _recalculation_process = multiprocessing.get_context('spawn').Process(
+                target=run_recalculation_worker, name='recalculation-worker', daemon=False)
+            _recalculation_process.start()
+
+
+def is_recalculation_job_resumable(job):
+    if job.status == 'failed':
+        return True
+    if job.status in ('pending', 'running'):
+        # Queued or abandoned with no worker around to claim it
+        return not job.updated_at or (datetime.utcnow() - job.updated_at).total_seconds() > RECALCULATION_STALE_SECONDS
+    return False
+
+
+@app.cli.command('recalculation-worker')
+@click.option('--once', is_flag=True, help='Run the queued jobs and exit instead of polling forever.')
+def recalculation_worker_command(once):
+    """Run queued attendance recalculation jobs."""
+    click.echo('Recalculation worker started.')
+    run_recalculation_worker(exit_when_idle=once)
+
+
+# ==================== ATTENDANCE CUBE ====================
+
+ARRIVAL_BUCKET_MINUTES = 15
+ATTENDANCE_CUBE_CHUNK_DAYS = 31
+CUBE_STAT_FIELDS = ('present_count', 'late_count', 'late_minutes_sum', 'overtime_minutes_sum')
+
+
+def refresh_attendance_cube(school_id, start_date, end_date, dates=None):
+    """
+    Recompute the daily stats and arrival histogram rows of one branch from raw
+    attendance, for every day in [start_date, end_date] (or only the given dates).
+    Rows are keyed by the staff's current department and, like the rest of analytics,
+    only count active staff. Also invalidates the branch's cached data. The caller commits.
+    """
+    invalidate_branch_data([school_id])
+    source = attendance_source(start_date)
+    filters = [Staff.school_id == school_id, Staff.is_active == True, source.date >= start_date, source.date <= end_date]
+    if dates is not None:
+        filters.append(source.date.in_(list(dates)))
+    
+    rows = db.session.query(
+        Staff.department,
+        source.date,
+        source.sign_in_time,
+        source.is_late,
+        source.late_minutes,
+        source.overtime_minutes
+    ).join(
+        Staff, source.staff_id == Staff.id
+    ).filter(*filters).all()
+    
+    stats = {}
+    buckets = {}
+    for r in rows:
+        key = (r.department, r.date)
+        day = stats.setdefault(key, {'present_count': 0, 'late_count': 0, 'late_minutes_sum': 0, 'overtime_minutes_sum': 0})
+        day['present_count'] += 1
+        if r.is_late:
+            day['late_count'] += 1
+            day['late_minutes_sum'] += r.late_minutes or 0
+        day['overtime_minutes_sum'] += r.overtime_minutes or 0
+        if r.sign_in_time:
+            bucket = (r.sign_in_time.hour * 60 + r.sign_in_time.minute) // ARRIVAL_BUCKET_MINUTES
+            counts = buckets.setdefault((r.department, r.date, bucket), [0, 0])
+            counts[0] += 1
+            if r.is_late:
+                counts[1] += 1
+    
+    for model in (AttendanceDailyStats, AttendanceArrivalBucket):
+        stale_rows = model.query.filter(model.school_id == school_id, model.date >= start_date, model.date <= end_date)
+        if dates is not None:
+            stale_rows = stale_rows.filter(model.date.in_(list(dates)))
+        stale_rows.delete(synchronize_session=False)
+    
+    now = datetime.utcnow()
+    if stats:
+        db.session.bulk_insert_mappings(AttendanceDailyStats, [
+            dict(values, school_id=school_id, department=department, date=day, updated_at=now)
+            for (department, day), values in stats.items()
+        ])
+    if buckets:
+        db.session.bulk_insert_mappings(AttendanceArrivalBucket, [
+            {'school_id': school_id, 'department': department, 'date': day, 'bucket': bucket, 'arrivals': counts[0], 'late_arrivals': counts[1]}
+            for (department, day, bucket), counts in buckets.items()
+        ])
+
+
+def add_cube_deltas(deltas, department, day, sign_in_time=None, **changes):
+    """
+    Accumulate one attendance event into {'days': {(department, date): {field: delta}},
+    'buckets': {(department, date, bucket): [arrivals, late_arrivals]}}
+    """
+    day_deltas = deltas['days'].setdefault((department, day), dict.fromkeys(CUBE_STAT_FIELDS, 0))
+    for field, value in changes.items():
+        day_deltas[field] += value or 0
+    if sign_in_time:
+        bucket = (sign_in_time.hour * 60 + sign_in_time.minute) // ARRIVAL_BUCKET_MINUTES
+        counts = deltas['buckets'].setdefault((department, day, bucket), [0, 0])
+        counts[0] += 1
+        counts[1] += 1 if changes.get('late_count') else 0
+
+
+def upsert_increments(model, keys, increments, **assign):
+    """Add increments to the row with these key values, creating it if missing, in one statement where the database allows"""
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        statement = insert(model).values(**keys, **increments, **assign)
+        updates = {field: getattr(model, field) + getattr(statement.excluded, field) for field in increments}
+        updates.update({field: getattr(statement.excluded, field) for field in assign})
+        db.session.execute(statement.on_conflict_do_update(index_elements=list(keys), set_=updates))
+        return
+    values = {getattr(model, field): getattr(model, field) + delta for field, delta in increments.items()}
+    values.update({getattr(model, field): value for field, value in assign.items()})
+    if model.query.filter_by(**keys).update(values, synchronize_session=False):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(**keys, **increments, **assign))
+    except Exception:
+        # Another request created the row first; fall back to the increment
+        model.query.filter_by(**keys).update(values, synchronize_session=False)
+
+
+def apply_attendance_cube_deltas(school_id, deltas):
+    """
+    Apply accumulated cube deltas of one branch with in-database increments, so concurrent
+    syncs neither lose updates nor re-read raw attendance. Keys are applied in a fixed order
+    to keep concurrent transactions from deadlocking. The caller commits.
+    """
+    now = datetime.utcnow()
+    for (department, day), changes in sorted(deltas['days'].items(), key=lambda item: repr(item[0])):
+        if any(changes.values()):
+            upsert_increments(AttendanceDailyStats, {'school_id': school_id, 'department': department, 'date': day},
+                              changes, updated_at=now)
+    for (department, day, bucket), (arrivals, late_arrivals) in sorted(deltas['buckets'].items(), key=lambda item: repr(item[0])):
+        upsert_increments(AttendanceArrivalBucket, {'school_id': school_id, 'department': department, 'date': day, 'bucket': bucket},
+                          {'arrivals': arrivals, 'late_arrivals': late_arrivals})
+
+
+def rebuild_attendance_cube(school_id, start_date, end_date):
+    """Rebuild a branch's cube over a long range, committing one chunk of days at a time"""
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=ATTENDANCE_CUBE_CHUNK_DAYS - 1), end_date)
+        refresh_attendance_cube(school_id, chunk_start, chunk_end)
+        db.session.commit()
+        chunk_start = chunk_end + timedelta(days=1)
+
+
+def get_staff_attendance_dates(staff_id):
+    source = attendance_source()
+    return sorted(r.date for r in db.session.query(source.date).filter(source.staff_id == staff_id).distinct().all())
+
+
+def refresh_attendance_cube_dates(school_ids, dates):
+    """Refresh the cube of the given branches on scattered dates, e.g. one staff member's attendance days"""
+    dates = sorted(set(dates))
+    for school_id in set(school_ids):
+        for i in range(0, len(dates), 500):
+            chunk = dates[i:i + 500]
+            refresh_attendance_cube(school_id, chunk[0], chunk[-1], dates=chunk)
+
+
+def query_attendance_cube(group_by, start_date, end_date, school_ids=None, department=None):
+    """
+    Sum the daily cube over a date range grouped by the given columns, e.g.
+    [AttendanceDailyStats.date] or [AttendanceDailyStats.department].
+    school_ids=None means all branches.
+    """
+    query = db.session.query(
+        *group_by,
+        db.func.sum(AttendanceDailyStats.present_count).label('present'),
+        db.func.sum(AttendanceDailyStats.late_count).label('late'),
+        db.func.sum(AttendanceDailyStats.late_minutes_sum).label('late_minutes'),
+        db.func.sum(AttendanceDailyStats.overtime_minutes_sum).label('overtime_minutes')
+    ).filter(
+        AttendanceDailyStats.date >= start_date,
+        AttendanceDailyStats.date <= end_date
+    )
+    if school_ids is not None:
+        query = query.filter(AttendanceDailyStats.school_id.in_(school_ids))
+    if department:
+        query = query.filter(AttendanceDailyStats.department == department)
+    return query.group_by(*group_by).all()
+
+
+def rollup_attendance_cube(daily_rows, grain='week'):
+    """
+    Roll rows grouped by date (from query_attendance_cube) up to weeks (starting
+    Monday) or calendar months. Returns {period_start: totals} in date order.
+    """
+    periods = {}
+    for r in sorted(daily_rows, key=lambda x: x.date):
+        if grain == 'month':
+            period_start = r.date.replace(day=1)
+        else:
+            period_start = r.date - timedelta(days=r.date.weekday())
+        totals = periods.setdefault(period_start, {'present': 0, 'late': 0, 'late_minutes': 0, 'overtime_minutes': 0})
+        totals['present'] += r.present or 0
+        totals['late'] += r.late or 0
+        totals['late_minutes'] += r.late_minutes or 0
+        totals['overtime_minutes'] += r.overtime_minutes or 0
+    return periods
+
+
+def rebuild_all_attendance_cubes(log=None):
+    """Rebuild the cube of every branch over the whole attendance history; returns False when there is no attendance"""
+    source = attendance_source()
+    bounds = db.session.query(db.func.min(source.date), db.func.max(source.date)).first()
+    if not bounds or not bounds[0]:
+        return False
+    start_date, end_date = bounds
+    for school in School.query.all():
+        rebuild_attendance_cube(school.id, start_date, end_date)
+        if log:
+            log(f'Rebuilt attendance cube for {school.name} ({start_date} to {end_date})')
+    return True
+
+
+@app.cli.command('rebuild-attendance-cube')
+def rebuild_attendance_cube_command():
+    """Rebuild the attendance cube for every branch from raw attendance"""
+    if not rebuild_all_attendance_cubes(log=print):
+        print('No attendance records found.')
+
+
+# ==================== LIFETIME STATS ====================
+
+LIFETIME_STAT_FIELDS = ('total_days', 'late_days', 'late_minutes', 'overtime_minutes')
+
+
+def add_lifetime_deltas(deltas, staff_id, **changes):
+    """Accumulate counter changes for one staff into a {staff_id: {field: delta}} dict"""
+    staff_deltas = deltas.setdefault(staff_id, dict.fromkeys(LIFETIME_STAT_FIELDS, 0))
+    for field, value in changes.items():
+        staff_deltas[field] += value or 0
+
+
+def apply_lifetime_deltas(deltas):
+    """
+    Apply accumulated deltas with in-database increments so concurrent syncs
+    never lose updates. Missing rows are created. The caller commits.
+    """
+    now = datetime.utcnow()
+    for staff_id, staff_deltas in deltas.items():
+        if not any(staff_deltas.values()):
+            continue
+        values = {getattr(StaffLifetimeStats, field): getattr(StaffLifetimeStats, field) + delta for field, delta in staff_deltas.items() if delta}
+        values[StaffLifetimeStats.updated_at] = now
+        updated = StaffLifetimeStats.query.filter_by(staff_id=staff_id).update(values, synchronize_session=False)
+        if updated:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.add(StaffLifetimeStats(staff_id=staff_id, updated_at=now, **staff_deltas))
+        except Exception:
+            # Another request created the row first; fall back to the increment
+            StaffLifetimeStats.query.filter_by(staff_id=staff_id).update(values, synchronize_session=False)
+
+
+def compute_lifetime_stats(staff_ids=None):
+    """Aggregate lifetime counters from raw attendance, archived rows included: {staff_id: {field: value}}"""
+    source = attendance_source()
+    query = db.session.query(
+        source.staff_id,
+        db.func.count(source.id),
+        db.func.sum(db.case((source.is_late == True, 1), else_=0)),
+        db.func.sum(db.case((source.is_late == True, source.late_minutes), else_=0)),
+        db.func.sum(source.overtime_minutes)
+    )
+    if staff_ids is not None:
+        query = query.filter(source.staff_id.in_(staff_ids))
+    return {
+        row[0]: dict(zip(LIFETIME_STAT_FIELDS, (int(v or 0) for v in row[1:])))
+        for row in query.group_by(source.staff_id).all()
+    }
+
+
+def get_lifetime_stats_map(staff_ids):
+    """Primary-key lookup of lifetime counters for a list of staff"""
+    if not staff_ids:
+        return {}
+    return {st.staff_id: st for st in StaffLifetimeStats.query.filter(StaffLifetimeStats.staff_id.in_(staff_ids)).all()}
+
+
+def rebuild_lifetime_stats(fix=False):
+    """Compare stored counters with raw attendance; with fix=True overwrite mismatches. Returns mismatching staff ids."""
+    expected = compute_lifetime_stats()
+    stored = {st.staff_id: st for st in StaffLifetimeStats.query.all()}
+    zero = dict.fromkeys(LIFETIME_STAT_FIELDS, 0)
+    mismatched = []
+    for staff_id in set(expected) | set(stored):
+        values = expected.get(staff_id, zero)
+        row = stored.get(staff_id)
+        if row and all(getattr(row, field) == values[field] for field in LIFETIME_STAT_FIELDS):
+            continue
+        mismatched.append(staff_id)
+        if fix:
+            if row:
+                for field in LIFETIME_STAT_FIELDS:
+                    setattr(row, field, values[field])
+                row.updated_at = datetime.utcnow()
+            else:
+                db.session.add(StaffLifetimeStats(staff_id=staff_id, updated_at=datetime.utcnow(), **values))
+    if fix:
+        db.session.commit()
+    return mismatched
+
+
+def backfill_lifetime_stats():
+    """Migration step: bring the counters in line with raw attendance on databases upgraded from before they existed"""
+    rebuild_lifetime_stats(fix=True)
+
+
+@app.cli.command('verify-lifetime-stats')
+@click.option('--fix', is_flag=True, help='Rewrite counters that do not match raw attendance.')
+def verify_lifetime_stats_command(fix):
+    """Check per-staff lifetime counters against raw attendance"""
+    mismatched = rebuild_lifetime_stats(fix=fix)
+    if not mismatched:
+        print('Lifetime stats are consistent.')
+    elif fix:
+        print(f'Rebuilt lifetime stats for {len(mismatched)} staff.')
+    else:
+        print(f'{len(mismatched)} staff have inconsistent lifetime stats (run with --fix to rebuild): {sorted(mismatched)[:20]}')
+
+
+# ==================== ATTENDANCE ARCHIVE ====================
+
+# Whole months of attendance kept in the hot table; archive-attendance moves older rows to
+# attendance_archive. 0 keeps everything hot.
+ATTENDANCE_RETENTION_MONTHS = int(os.environ.get('ATTENDANCE_RETENTION_MONTHS', 0))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 5000))
+ATTENDANCE_COLUMNS = [column.name for column in Attendance.__table__.columns]
+
+
+def get_archive_boundary():
+    """The day after the newest archived row (every earlier day may be archived); None without an archive"""
+    def load():
+        newest = db.session.query(db.func.max(AttendanceArchive.date)).scalar()
+        return newest + timedelta(days=1) if newest else None
+    return request_memo('archive_boundary', load)
+
+
+def attendance_source(start_date=None):
+    """
+    What to query for attendance from start_date on (None = all time): Attendance itself while
+    the range stays within the hot table, otherwise an alias of Attendance over the hot and
+    archived rows together. Filter on its columns (source.date, ...) instead of Attendance's.
+    """
+    boundary = get_archive_boundary()
+    if boundary is None or (start_date is not None and start_date >= boundary):
+        return Attendance
+    union = db.union_all(
+        db.select(*[Attendance.__table__.c[name] for name in ATTENDANCE_COLUMNS]),
+        db.select(*[AttendanceArchive.__table__.c[name] for name in ATTENDANCE_COLUMNS])
+    ).subquery('attendance_all')
+    return db.aliased(Attendance, union, adapt_on_names=True)
+
+
+def is_archived_attendance(staff_id, record_date):
+    boundary = get_archive_boundary()
+    if boundary is None or record_date >= boundary:
+        return False
+    return AttendanceArchive.query.filter_by(staff_id=staff_id, date=record_date).first() is not None
+
+
+def copy_attendance_to_archive(select_from):
+    """INSERT INTO attendance_archive SELECT the attendance columns FROM select_from, skipping days already archived"""
+    columns = ', '.join(ATTENDANCE_COLUMNS)
+    conflict = ' ON CONFLICT DO NOTHING' if db.engine.dialect.name in ('postgresql', 'sqlite') else ''
+    db.session.execute(db.text(f'INSERT INTO attendance_archive ({columns}) SELECT {columns} FROM {select_from}{conflict}'))
+
+
+def archive_attendance(cutoff, batch_size=ARCHIVE_BATCH_SIZE, log=print):
+    """
+    Move attendance dated before cutoff to attendance_archive, committing one batch at a time;
+    returns the rows moved. Lifetime stats, times_late and the daily cube already count these
+    rows and stay as they are, so only range reports that reach past cutoff read the archive.
+    """
+    moved = 0
+    if attendance_is_partitioned():
+        # Whole months move with one copy and a DROP, leaving no dead rows in the hot table
+        for name, bounds, _ in get_attendance_partitions():
+            match = re.fullmatch(r'attendance_y(\d{4})m(\d{2})', name)
+            if bounds == 'DETACHED' or not match or add_months(date(int(match[1]), int(match[2]), 1), 1) > cutoff:
+                continue
+            lock_attendance_partitions()
+            rows = db.session.execute(db.text(f'SELECT count(*) FROM {name}')).scalar()
+            copy_attendance_to_archive(name)
+            db.session.execute(db.text(f'DROP TABLE {name}'))
+            db.session.commit()
+            moved += rows
+            log(f'Archived {name}: {rows} rows')
+    while True:
+        ids = [row_id for (row_id,) in db.session.query(Attendance.id).filter(
+            Attendance.date < cutoff
+        ).order_by(Attendance.date, Attendance.id).limit(batch_size).all()]
+        if not ids:
+            break
+        copy_attendance_to_archive(f"attendance WHERE id IN ({', '.join(str(row_id) for row_id in ids)})")
+        Attendance.query.filter(Attendance.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        moved += len(ids)
+        log(f'Archived {moved} rows')
+    forget_request_memo('archive_boundary')
+    return moved
+
+
+@app.cli.command('archive-attendance')
+@click.option('--months', type=int, default=None, help='Whole months to keep hot (default ATTENDANCE_RETENTION_MONTHS).')
+@click.option('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='Rows moved per transaction.')
+def archive_attendance_command(months, batch_size):
+    """Move attendance older than the retention window into attendance_archive"""
+    months = ATTENDANCE_RETENTION_MONTHS if months is None else months
+    if months <= 0:
+        print('Set ATTENDANCE_RETENTION_MONTHS or pass --months to archive.')
+        raise SystemExit(1)
+    cutoff = add_months(month_start(date.today()), -months)
+    moved = archive_attendance(cutoff, batch_size)
+    hot = db.session.query(db.func.count(Attendance.id)).scalar()
+    archived = db.session.query(db.func.count(AttendanceArchive.id)).scalar()
+    print(f'Moved {moved} rows dated before {cutoff}; {hot} hot, {archived} archived.')
+
+
+# ==================== AUTH ROUTES ====================
+
+@app.route('/')
+def index():
+    if current_user.is_authenticated:
+        return redirect(url_for('dashboard'))
+    return redirect(url_for('login'))
+
+
+@app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
@@ -598,7 +2511,7 @@ def login():
         password = request.form.get('password')
         user = User.query.filter_by(username=username).first()
         if user and user.check_password(password) and user.is_active:
-            login_user(user)
+            login_user(get_principal(user.id))
             flash('Logged in successfully!', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -625,6 +2538,7 @@ def settings():
     if request.method == 'POST':
         settings.company_name = request.form.get('company_name', 'Wakato Technologies')
         settings.company_logo_url = request.form.get('company_logo_url', '').strip() or None
+        invalidate_reference_data()
         db.session.commit()
         flash('Settings updated successfully!', 'success')
         return redirect(url_for('settings'))
@@ -642,6 +2556,8 @@ def add_organization():
         hr_email_name = request.form.get('hr_email_name', '').strip() or None
         org = Organization(name=name, logo_url=logo_url, hr_email=hr_email, hr_email_name=hr_email_name)
         db.session.add(org)
+        invalidate_reference_data()
+        invalidate_principals()
         db.session.commit()
         Department.create_defaults(org.id)
         flash('Organization added successfully with default departments!', 'success')
@@ -659,6 +2575,7 @@ def edit_organization(id):
         org.logo_url = request.form.get('logo_url', '').strip() or None
         org.hr_email = request.form.get('hr_email', '').strip() or None
         org.hr_email_name = request.form.get('hr_email_name', '').strip() or None
+        invalidate_reference_data()
         db.session.commit()
         flash('Organization updated successfully!', 'success')
         return redirect(url_for('settings'))
@@ -674,7 +2591,10 @@ def delete_organization(id):
         flash('Cannot delete organization with branches. Remove branches first.', 'danger')
         return redirect(url_for('settings'))
     db.session.delete(org)
+    invalidate_reference_data()
+    invalidate_principals()
     db.session.commit()
+    get_cache().clear(cache_namespace(id))
     flash('Organization deleted successfully!', 'success')
     return redirect(url_for('settings'))
 
@@ -707,6 +2627,7 @@ def add_department(org_id):
         return redirect(url_for('manage_departments', org_id=org_id))
     dept = Department(name=name, organization_id=org_id)
     db.session.add(dept)
+    invalidate_reference_data()
     db.session.commit()
     flash(f'Department "{name}" added successfully!', 'success')
     return redirect(url_for('manage_departments', org_id=org_id))
@@ -731,6 +2652,7 @@ def edit_department(org_id, dept_id):
         return redirect(url_for('manage_departments', org_id=org_id))
     Staff.query.join(School).filter(School.organization_id == org_id, Staff.department == old_name).update({Staff.department: new_name}, synchronize_session=False)
     dept.name = new_name
+    invalidate_reference_data()
     db.session.commit()
     flash(f'Department renamed from "{old_name}" to "{new_name}".', 'success')
     return redirect(url_for('manage_departments', org_id=org_id))
@@ -750,6 +2672,7 @@ def delete_department(org_id, dept_id):
         return redirect(url_for('manage_departments', org_id=org_id))
     dept_name = dept.name
     db.session.delete(dept)
+    invalidate_reference_data()
     db.session.commit()
     flash(f'Department "{dept_name}" deleted successfully!', 'success')
     return redirect(url_for('manage_departments', org_id=org_id))
@@ -758,25 +2681,22 @@ def delete_department(org_id, dept_id):
 @app.route('/api/branch-departments/<int:branch_id>')
 @login_required
 def get_branch_departments(branch_id):
-    school = School.query.get_or_404(branch_id)
+    reference = get_reference_data()
+    school = reference.schools.get(branch_id)
+    if school is None:
+        abort(404)
     if school.organization_id:
-        departments = Department.query.filter_by(organization_id=school.organization_id).order_by(Department.name).all()
+        departments = reference.departments.get(school.organization_id)
         if departments:
-            return jsonify([{'id': d.id, 'name': d.name} for d in departments])
+            return jsonify([{'id': dept_id, 'name': name} for dept_id, name in departments])
     # Return defaults if no organization or no departments found
-    return jsonify([
-        {'id': 0, 'name': 'Academic'}, 
-        {'id': 0, 'name': 'Administrative'}, 
-        {'id': 0, 'name': 'Management'}, 
-        {'id': 0, 'name': 'Non-Academic'}, 
-        {'id': 0, 'name': 'Support Staff'}
-    ])
+    return jsonify([{'id': 0, 'name': name} for name in DEFAULT_DEPARTMENT_NAMES])
 
 @app.route('/api/organization-departments/<int:org_id>')
 @login_required
 def get_organization_departments(org_id):
-    departments = Department.query.filter_by(organization_id=org_id).order_by(Department.name).all()
-    return jsonify([{'id': d.id, 'name': d.name} for d in departments])
+    departments = get_reference_data().departments.get(org_id, [])
+    return jsonify([{'id': dept_id, 'name': name} for dept_id, name in departments])
 
 
 @app.route('/api/organization-branches/<int:org_id>')
@@ -797,10 +2717,7 @@ def get_organization_branches(org_id):
 def dashboard():
     today = date.today()
     accessible_school_ids = current_user.get_accessible_school_ids()
-    if current_user.role == 'super_admin':
-        schools = School.query.all()
-    else:
-        schools = current_user.get_accessible_schools()
+    schools = current_user.get_accessible_schools()
     if current_user.role == 'super_admin' or accessible_school_ids:
         if current_user.role == 'super_admin':
             all_staff = Staff.query.filter_by(is_active=True).all()
@@ -837,13 +2754,8 @@ def dashboard():
 @login_required
 def api_dashboard_stats():
     today = date.today()
-    
-    if current_user.role == 'super_admin':
-        schools = School.query.all()
-        school_ids = [s.id for s in schools]
-    else:
-        school_ids = current_user.get_accessible_school_ids()
-        schools = School.query.filter(School.id.in_(school_ids)).all()
+    reference = get_reference_data()
+    school_ids = [sid for sid in current_user.get_accessible_school_ids() if sid in reference.schools]
     
     total_staff = Staff.query.filter(
         Staff.school_id.in_(school_ids),
@@ -882,8 +2794,7 @@ def api_dashboard_stats():
     first_checkin_data = None
     if first_checkin:
         staff = first_checkin.staff
-        school = School.query.get(staff.school_id)
-        use_24h = school.time_format_24h if school and school.time_format_24h is not None else True
+        use_24h = reference.school_uses_24h(staff.school_id)
         
         if use_24h:
             time_str = first_checkin.sign_in_time.strftime('%H:%M')
@@ -892,13 +2803,13 @@ def api_dashboard_stats():
         
         first_checkin_data = {
             'name': staff.name,
-            'branch': school.short_name or school.name if school else '-',
+            'branch': reference.school_label(staff.school_id),
             'department': staff.department or '-',
             'time': time_str
         }
     
     # Recent activity (last 10 check-ins/outs) - order by sign_in_time desc
-    recent = Attendance.query.join(Staff).filter(
+    recent = Attendance.query.join(Staff).options(db.contains_eager(Attendance.staff)).filter(
         Staff.school_id.in_(school_ids),
         Attendance.date == today
     ).order_by(Attendance.sign_in_time.desc()).limit(10).all()
@@ -906,8 +2817,7 @@ def api_dashboard_stats():
     recent_activity = []
     for r in recent:
         staff = r.staff
-        school = School.query.get(staff.school_id)
-        use_24h = school.time_format_24h if school and school.time_format_24h is not None else True
+        use_24h = reference.school_uses_24h(staff.school_id)
         
         if r.sign_out_time:
             action = 'signed out'
@@ -928,11 +2838,11 @@ def api_dashboard_stats():
             'name': staff.name,
             'action': action,
             'time': time_str,
-            'branch': school.short_name or school.name if school else '-'
+            'branch': reference.school_label(staff.school_id)
         })
     
     return jsonify({
-        'total_schools': len(schools),
+        'total_schools': len(school_ids),
         'total_staff': total_staff,
         'management_count': management_count,
         'today_attendance': today_attendance,
@@ -942,8 +2852,14 @@ def api_dashboard_stats():
         'recent_activity': recent_activity
     })
 
+
+# Days of sign-ins the leaderboard streak reads per query while some streak is still unbroken
+LEADERBOARD_STREAK_WINDOW_DAYS = 31
+
+
 @app.route('/api/leaderboard')
 @login_required
+@conditional_on_branch_data
 def api_leaderboard():
     from datetime import datetime, timedelta
     
@@ -991,10 +2907,8 @@ def api_leaderboard():
         end_date = today
     
     # Get accessible schools for this user
-    if current_user.role == 'super_admin':
-        accessible_school_ids = [s.id for s in School.query.all()]
-    else:
-        accessible_school_ids = current_user.get_accessible_school_ids()
+    reference = get_reference_data()
+    accessible_school_ids = current_user.get_accessible_school_ids()
     
     if not accessible_school_ids:
         return jsonify({
@@ -1004,6 +2918,8 @@ def api_leaderboard():
             'period_label': f"{start_date.strftime('%d %b')} - {end_date.strftime('%d %b %Y')}"
         })
     
+    source = attendance_source(start_date)
+    
     # First to Arrive - earliest average sign-in time
     first_to_arrive = []
     try:
@@ -1012,15 +2928,15 @@ def api_leaderboard():
             Staff.name,
             School.short_name,
             School.name.label('school_name'),
-            Attendance.sign_in_time
+            source.sign_in_time
         ).join(
-            Attendance, Staff.id == Attendance.staff_id
+            source, Staff.id == source.staff_id
         ).join(
             School, Staff.school_id == School.id
         ).filter(
-            Attendance.date >= start_date,
-            Attendance.date <= end_date,
-            Attendance.sign_in_time.isnot(None),
+            source.date >= start_date,
+            source.date <= end_date,
+            source.sign_in_time.isnot(None),
             Staff.school_id.in_(accessible_school_ids),
             Staff.is_active == True
         ).all()
@@ -1070,33 +2986,55 @@ def api_leaderboard():
             Staff.is_active == True
         ).all()
         
-        for staff in staff_list:
-            attendance_dates = db.session.query(Attendance.date).filter(
-                Attendance.staff_id == staff.id,
-                Attendance.sign_in_time.isnot(None)
-            ).order_by(Attendance.date.desc()).all()
-            
-            if not attendance_dates:
-                continue
-            
-            dates = [a.date for a in attendance_dates]
-            streak = 0
-            check_date = end_date
-            max_checks = 365
-            checks = 0
-            
-            while checks < max_checks:
-                if check_date in dates:
-                    streak += 1
-                    check_date -= timedelta(days=1)
-                elif check_date.weekday() >= 5:
-                    check_date -= timedelta(days=1)
-                else:
-                    break
-                checks += 1
+        max_checks = 365
+        calendar = WorkCalendar([reference.schools[sid] for sid in accessible_school_ids if sid in reference.schools])
+        
+        # Sign-in dates are read back one window at a time, only for staff whose streak is still
+        # unbroken, so most requests never look past the first window (or into the archive)
+        dates_by_staff = {}
+        streaks = {}
+        pending = {staff.id: staff for staff in staff_list}
+        oldest = end_date - timedelta(days=max_checks)
+        window_end = end_date
+        while pending and window_end > oldest:
+            window_start = max(window_end - timedelta(days=LEADERBOARD_STREAK_WINDOW_DAYS), oldest)
+            window_source = attendance_source(window_start + timedelta(days=1))
+            for staff_id, attendance_date in db.session.query(window_source.staff_id, window_source.date).filter(
+                window_source.staff_id.in_(list(pending)),
+                window_source.sign_in_time.isnot(None),
+                window_source.date > window_start,
+                window_source.date <= window_end
+            ).all():
+                dates_by_staff.setdefault(staff_id, set()).add(attendance_date)
             
+            for staff_id, staff in list(pending.items()):
+                dates = dates_by_staff.get(staff_id, set())
+                streak = 0
+                check_date = end_date
+                checks = 0
+                broken = False
+                
+                while checks < max_checks and check_date > window_start:
+                    if check_date in dates:
+                        streak += 1
+                        check_date -= timedelta(days=1)
+                    elif not calendar.is_work_day(staff.school_id, check_date):
+                        check_date -= timedelta(days=1)
+                    else:
+                        broken = True
+                        break
+                    checks += 1
+                
+                if not broken and checks < max_checks:
+                    continue
+                del pending[staff_id]
+                streaks[staff_id] = streak
+            window_end = window_start
+        
+        for staff in staff_list:
+            streak = streaks.get(staff.id, 0)
             if streak > 0:
-                school = School.query.get(staff.school_id)
+                school = reference.schools.get(staff.school_id)
                 best_streak.append({
                     'name': staff.name,
                     'branch': school.short_name if school and school.short_name else (school.name[:10] if school else 'N/A'),
@@ -1117,31 +3055,31 @@ def api_leaderboard():
             School.short_name,
             School.name.label('school_name')
         ).join(
-            Attendance, Staff.id == Attendance.staff_id
+            source, Staff.id == source.staff_id
         ).join(
             School, Staff.school_id == School.id
         ).filter(
-            Attendance.date >= start_date,
-            Attendance.date <= end_date,
-            Attendance.sign_in_time.isnot(None),
+            source.date >= start_date,
+            source.date <= end_date,
+            source.sign_in_time.isnot(None),
             Staff.school_id.in_(accessible_school_ids),
             Staff.is_active == True
         ).distinct().all()
         
         for staff in staff_with_attendance:
-            total_days = Attendance.query.filter(
-                Attendance.staff_id == staff.id,
-                Attendance.date >= start_date,
-                Attendance.date <= end_date,
-                Attendance.sign_in_time.isnot(None)
+            total_days = db.session.query(source).filter(
+                source.staff_id == staff.id,
+                source.date >= start_date,
+                source.date <= end_date,
+                source.sign_in_time.isnot(None)
             ).count()
             
-            late_days = Attendance.query.filter(
-                Attendance.staff_id == staff.id,
-                Attendance.date >= start_date,
-                Attendance.date <= end_date,
-                Attendance.sign_in_time.isnot(None),
-                Attendance.is_late == True
+            late_days = db.session.query(source).filter(
+                source.staff_id == staff.id,
+                source.date >= start_date,
+                source.date <= end_date,
+                source.sign_in_time.isnot(None),
+                source.is_late == True
             ).count()
             
             if late_days == 0 and total_days > 0:
@@ -1202,6 +3140,7 @@ def search_staff():
 
 @app.route('/api/branch-staff/<int:branch_id>')
 @login_required
+@conditional_on_branch_data
 def api_branch_staff(branch_id):
     school = School.query.get_or_404(branch_id)
     
@@ -1345,6 +3284,8 @@ def add_school():
             setattr(school, f'schedule_{day}_start', start)
             setattr(school, f'schedule_{day}_end', end)
         db.session.add(school)
+        invalidate_reference_data()
+        invalidate_principals()
         db.session.commit()
         flash('Branch added successfully!', 'success')
         return redirect(url_for('schools'))
@@ -1367,6 +3308,9 @@ def edit_school(id):
             end = request.form.get(f'schedule_{day}_end', '17:00')
             setattr(school, f'schedule_{day}_start', start)
             setattr(school, f'schedule_{day}_end', end)
+        invalidate_reference_data()
+        invalidate_principals()
+        invalidate_branch_data([school.id])
         db.session.commit()
         flash('Branch updated successfully!', 'success')
         return redirect(url_for('schools'))
@@ -1379,7 +3323,12 @@ def edit_school(id):
 @role_required('super_admin')
 def delete_school(id):
     school = School.query.get_or_404(id)
+    AttendanceDailyStats.query.filter_by(school_id=school.id).delete(synchronize_session=False)
+    AttendanceArrivalBucket.query.filter_by(school_id=school.id).delete(synchronize_session=False)
     db.session.delete(school)
+    invalidate_reference_data()
+    invalidate_principals()
+    invalidate_branch_data([school.id])
     db.session.commit()
     flash('Branch deleted successfully!', 'success')
     return redirect(url_for('schools'))
@@ -1444,8 +3393,10 @@ def branch_settings(id):
                 if end:
                     setattr(school, f'schedule_{day}_end', end)
             
+            invalidate_reference_data()
+            invalidate_branch_data([school.id])
             db.session.commit()
-            flash('Branch settings updated successfully!', 'success')
+            flash('Branch settings updated successfully! Use "Recalculate Attendance" to apply schedule changes to past records.', 'success')
         
         return redirect(url_for('branch_settings', id=id))
     
@@ -1469,13 +3420,19 @@ def branch_settings(id):
     # Parse work days for template
     work_days_list = (school.work_days or 'mon,tue,wed,thu,fri').split(',')
     
+    # Recent recalculation jobs for progress display
+    recalculation_jobs = RecalculationJob.query.filter_by(school_id=id).order_by(RecalculationJob.id.desc()).limit(5).all()
+    
     return render_template('branch_settings.html', 
         school=school, 
         shifts=shifts, 
         staff_list=staff_list,
         assignments=assignments,
         show_api_section=show_api_section,
-        work_days_list=work_days_list
+        work_days_list=work_days_list,
+        recalculation_jobs=recalculation_jobs,
+        is_recalculation_job_resumable=is_recalculation_job_resumable,
+        today=date.today().isoformat()
     )
 
 
@@ -1521,6 +3478,7 @@ def add_shift(id):
         grace_period_minutes=grace_period
     )
     db.session.add(shift)
+    invalidate_branch_data([id])
     db.session.commit()
     
     flash(f'Shift "{name}" created successfully!', 'success')
@@ -1568,8 +3526,9 @@ def edit_shift(id, shift_id):
     except:
         pass
     
+    invalidate_branch_data([id])
     db.session.commit()
-    flash(f'Shift "{shift.name}" updated successfully!', 'success')
+    flash(f'Shift "{shift.name}" updated successfully! Use "Recalculate Attendance" to apply it to past records.', 'success')
     return redirect(url_for('branch_settings', id=id))
 
 
@@ -1598,6 +3557,7 @@ def delete_shift(id, shift_id):
     # Deactivate all assignments for this shift
     StaffShiftAssignment.query.filter_by(shift_id=shift_id).update({'is_active': False})
     
+    invalidate_branch_data([id])
     db.session.commit()
     flash(f'Shift "{shift_name}" deleted!', 'success')
     return redirect(url_for('branch_settings', id=id))
@@ -1657,6 +3617,7 @@ def assign_shift(id):
         db.session.add(assignment)
         assigned_count += 1
     
+    invalidate_branch_data([id])
     db.session.commit()
     flash(f'{assigned_count} staff assigned to shift "{shift.name}"', 'success')
     return redirect(url_for('branch_settings', id=id))
@@ -1684,6 +3645,7 @@ def unassign_shift(id, assignment_id):
     
     staff_name = assignment.staff.name
     assignment.is_active = False
+    invalidate_branch_data([id])
     db.session.commit()
     flash(f'{staff_name} removed from shift', 'success')
     return redirect(url_for('branch_settings', id=id))
@@ -1718,6 +3680,95 @@ def get_staff_without_shift(id):
     })
 
 
+@app.route('/branch/<int:id>/recalculate', methods=['POST'])
+@login_required
+def recalculate_branch_attendance(id):
+    """Queue a background job that re-applies the current schedule to past attendance"""
+    school = School.query.get_or_404(id)
+    
+    # Check access
+    if current_user.role == 'school_admin':
+        if school.id not in current_user.get_accessible_school_ids():
+            flash('Access denied', 'danger')
+            return redirect(url_for('dashboard'))
+    elif current_user.role != 'super_admin':
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    try:
+        start_date = datetime.strptime(request.form.get('date_from', ''), '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.form.get('date_to', '') or date.today().isoformat(), '%Y-%m-%d').date()
+    except:
+        flash('Please select a valid date range to recalculate', 'danger')
+        return redirect(url_for('branch_settings', id=id))
+    
+    if start_date > end_date:
+        flash('Start date must be before end date', 'danger')
+        return redirect(url_for('branch_settings', id=id))
+    
+    total_records = Attendance.query.join(Staff).filter(
+        Staff.school_id == id,
+        Attendance.date >= start_date,
+        Attendance.date <= end_date
+    ).count()
+    
+    job = RecalculationJob(
+        school_id=id,
+        start_date=start_date,
+        end_date=end_date,
+        total_records=total_records,
+        created_by=current_user.id
+    )
+    db.session.add(job)
+    db.session.commit()
+    start_recalculation_worker()
+    
+    flash(f'Recalculating {total_records} attendance record(s) from {start_date.strftime("%d/%m/%Y")} to {end_date.strftime("%d/%m/%Y")}', 'success')
+    return redirect(url_for('branch_settings', id=id))
+
+
+@app.route('/api/recalculation-jobs/<int:job_id>')
+@login_required
+def api_recalculation_job(job_id):
+    """Progress of a recalculation job"""
+    job = RecalculationJob.query.get_or_404(job_id)
+    if current_user.role not in ['super_admin', 'school_admin']:
+        return jsonify({'error': 'Access denied'}), 403
+    if current_user.role == 'school_admin' and job.school_id not in current_user.get_accessible_school_ids():
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = job.to_dict()
+    data['resumable'] = is_recalculation_job_resumable(job)
+    return jsonify(data)
+
+
+@app.route('/recalculation-jobs/<int:job_id>/resume', methods=['POST'])
+@login_required
+def resume_recalculation_job(job_id):
+    job = RecalculationJob.query.get_or_404(job_id)
+    
+    # Check access
+    if current_user.role == 'school_admin':
+        if job.school_id not in current_user.get_accessible_school_ids():
+            flash('Access denied', 'danger')
+            return redirect(url_for('dashboard'))
+    elif current_user.role != 'super_admin':
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    if not is_recalculation_job_resumable(job):
+        flash('This recalculation is not resumable', 'warning')
+        return redirect(url_for('branch_settings', id=job.school_id))
+    
+    job.status = 'pending'
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    start_recalculation_worker()
+    
+    flash(f'Recalculation resumed from record {job.processed_records} of {job.total_records}', 'success')
+    return redirect(url_for('branch_settings', id=job.school_id))
+
+
 # ==================== STAFF ====================
 
 @app.route('/staff')
@@ -1748,48 +3799,134 @@ def staff_list():
         else:
             branches = current_user.get_accessible_schools()
     
-    # Get staff based on filters
-    if current_user.role == 'super_admin':
-        if organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
-            if branch_id and branch_id in org_school_ids:
-                staff = Staff.query.filter(Staff.school_id == branch_id).all()
-            else:
-                staff = Staff.query.filter(Staff.school_id.in_(org_school_ids)).all() if org_school_ids else []
-        elif branch_id:
-            staff = Staff.query.filter(Staff.school_id == branch_id).all()
-        else:
-            staff = Staff.query.all()
-    else:
-        accessible_school_ids = current_user.get_accessible_school_ids()
-        if not accessible_school_ids:
-            staff = []
-        elif branch_id and branch_id in accessible_school_ids:
-            staff = Staff.query.filter(Staff.school_id == branch_id).all()
-        elif organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
-            filtered_ids = [sid for sid in org_school_ids if sid in accessible_school_ids]
-            staff = Staff.query.filter(Staff.school_id.in_(filtered_ids)).all() if filtered_ids else []
-        else:
-            staff = Staff.query.filter(Staff.school_id.in_(accessible_school_ids)).all()
-    
     # Get all schools for modals (add/edit staff)
     if current_user.role == 'super_admin':
         schools = School.query.all()
     else:
         schools = current_user.get_accessible_schools()
     
+    # Staff rows are fetched page by page from api_staff_directory
+    reference = get_reference_data()
+    departments = sorted({name for org_id in ([organization_id] if organization_id else [o.id for o in organizations])
+                          for _, name in reference.departments.get(org_id, [])})
+    
     return render_template('staff.html', 
-        staff=staff,
         schools=schools,
         organizations=organizations,
         branches=branches,
+        departments=departments,
         selected_organization=organization_id,
         selected_branch=branch_id
     )
 
 
-@app.route('/staff/add', methods=['GET', 'POST'])
+def staff_directory_scope(organization_id=None, branch_id=None):
+    """School ids the current user may list for the given filters; None means every branch"""
+    if current_user.role == 'super_admin':
+        if organization_id:
+            org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
+            return [branch_id] if branch_id and branch_id in org_school_ids else org_school_ids
+        return [branch_id] if branch_id else None
+    accessible_school_ids = current_user.get_accessible_school_ids()
+    if branch_id and branch_id in accessible_school_ids:
+        return [branch_id]
+    if organization_id:
+        org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
+        return [sid for sid in org_school_ids if sid in accessible_school_ids]
+    return accessible_school_ids
+
+
+STAFF_DIRECTORY_SORTS = {
+    'name': Staff.name,
+    'staff_id': Staff.staff_id,
+    'department': Staff.department,
+    'branch': School.name,
+}
+
+
+@app.route('/api/staff')
+@login_required
+def api_staff_directory():
+    """
+    One page of the staff directory. Filters: organization_id, branch_id, department,
+    status (active/inactive), q (name, staff ID, email or department). Sorted by
+    sort/dir with a keyset cursor, so page cost does not grow with directory size.
+    """
+    scope_school_ids = staff_directory_scope(
+        request.args.get('organization_id', type=int), request.args.get('branch_id', type=int))
+    sort = request.args.get('sort', 'name')
+    if sort not in STAFF_DIRECTORY_SORTS:
+        sort = 'name'
+    descending = request.args.get('dir') == 'desc'
+    limit = min(max(request.args.get('limit', KEYSET_PAGE_SIZE, type=int), 1), 200)
+    
+    base = db.session.query(Staff).outerjoin(School, Staff.school_id == School.id)
+    if scope_school_ids is not None:
+        base = base.filter(Staff.school_id.in_(scope_school_ids or [-1]))
+    department = request.args.get('department', '').strip()
+    if department:
+        base = base.filter(Staff.department == department)
+    text = request.args.get('q', '').strip()
+    if text:
+        pattern = f'%{text}%'
+        base = base.filter(db.or_(
+            Staff.name.ilike(pattern), Staff.staff_id.ilike(pattern),
+            Staff.email.ilike(pattern), Staff.department.ilike(pattern)
+        ))
+    
+    # Active/inactive totals for the summary cards, before the status filter
+    status_counts = dict(base.with_entities(Staff.is_active, db.func.count(Staff.id)).group_by(Staff.is_active).all())
+    active_count = status_counts.get(True, 0)
+    inactive_count = sum(count for is_active, count in status_counts.items() if not is_active)
+    
+    status = request.args.get('status', '')
+    if status == 'active':
+        base = base.filter(Staff.is_active == True)
+    elif status == 'inactive':
+        base = base.filter(Staff.is_active == False)
+    
+    sort_col = db.func.coalesce(STAFF_DIRECTORY_SORTS[sort], '')
+    cursor = parse_keyset_cursor(request.args.get('after'), str, int)
+    if cursor:
+        if descending:
+            base = base.filter(db.or_(sort_col < cursor[0], db.and_(sort_col == cursor[0], Staff.id < cursor[1])))
+        else:
+            base = base.filter(db.or_(sort_col > cursor[0], db.and_(sort_col == cursor[0], Staff.id > cursor[1])))
+    order = (sort_col.desc(), Staff.id.desc()) if descending else (sort_col.asc(), Staff.id.asc())
+    
+    rows = base.with_entities(
+        Staff.id, Staff.staff_id, Staff.name, Staff.department, Staff.email, Staff.phone,
+        Staff.is_active, Staff.school_id, School.name.label('branch_name'),
+        School.short_name.label('branch_short_name'), sort_col.label('sort_value')
+    ).order_by(*order).limit(limit + 1).all()
+    
+    can_manage = current_user.role in ['super_admin', 'school_admin']
+    items = []
+    for r in rows[:limit]:
+        item = {
+            'id': r.id,
+            'staff_id': r.staff_id,
+            'name': r.name,
+            'department': r.department,
+            'email': r.email,
+            'phone': r.phone,
+            'is_active': bool(r.is_active),
+            'school_id': r.school_id,
+            'branch': (r.branch_short_name or r.branch_name) if r.branch_name else 'N/A'
+        }
+        if can_manage:
+            item['toggle_url'] = url_for('toggle_staff', id=r.id)
+            item['delete_url'] = url_for('delete_staff', id=r.id)
+        items.append(item)
+    
+    return jsonify({
+        'staff': items,
+        'next_cursor': make_keyset_cursor(rows[limit - 1].sort_value, rows[limit - 1].id) if len(rows) > limit else None,
+        'counts': {'total': active_count + inactive_count, 'active': active_count, 'inactive': inactive_count}
+    })
+
+
+@app.route('/staff/add', methods=['GET', 'POST'])
 @login_required
 @role_required('super_admin', 'school_admin')
 def add_staff():
@@ -1825,6 +3962,7 @@ def add_staff():
         
         staff = Staff(staff_id=staff_id, name=name, department=department, school_id=school_id, email=email, phone=phone, photo_url=photo_url)
         db.session.add(staff)
+        invalidate_branch_data([school_id])
         db.session.commit()
         flash('Staff added successfully!', 'success')
         return redirect(url_for('staff_list'))
@@ -1858,6 +3996,7 @@ def edit_staff(id):
         if existing:
             flash('Staff ID already exists in this organization!', 'danger')
             return redirect(url_for('staff_list'))
+    previous_school_id, previous_department, previously_active = staff.school_id, staff.department, staff.is_active
     staff.staff_id = new_staff_id
     staff.name = request.form.get('name')
     staff.department = request.form.get('department')
@@ -1866,6 +4005,10 @@ def edit_staff(id):
     staff.email = request.form.get('email', '').strip() or None
     staff.phone = request.form.get('phone', '').strip() or None
     staff.photo_url = request.form.get('photo_url', '').strip() or None
+    if staff.school_id != previous_school_id or staff.department != previous_department or staff.is_active != previously_active:
+        db.session.flush()
+        refresh_attendance_cube_dates([previous_school_id, staff.school_id], get_staff_attendance_dates(staff.id))
+    invalidate_branch_data([previous_school_id, staff.school_id])
     db.session.commit()
     flash(f'Staff "{staff.name}" updated successfully!', 'success')
     return redirect(url_for('staff_list'))
@@ -1880,6 +4023,10 @@ def toggle_staff(id):
         flash('You do not have permission to modify this staff.', 'danger')
         return redirect(url_for('staff_list'))
     staff.is_active = not staff.is_active
+    # The cube only counts active staff
+    db.session.flush()
+    refresh_attendance_cube_dates([staff.school_id], get_staff_attendance_dates(staff.id))
+    invalidate_branch_data([staff.school_id])
     db.session.commit()
     status = 'activated' if staff.is_active else 'deactivated'
     flash(f'Staff {status} successfully!', 'success')
@@ -1891,7 +4038,11 @@ def toggle_staff(id):
 @role_required('super_admin')
 def delete_staff(id):
     staff = Staff.query.get_or_404(id)
+    staff_dates = get_staff_attendance_dates(staff.id)
     db.session.delete(staff)
+    db.session.flush()
+    refresh_attendance_cube_dates([staff.school_id], staff_dates)
+    invalidate_branch_data([staff.school_id])
     db.session.commit()
     flash('Staff deleted successfully!', 'success')
     return redirect(url_for('staff_list'))
@@ -2001,6 +4152,7 @@ def bulk_upload():
                 staff = Staff(staff_id=row_staff_id, name=name, department=department, school_id=school_id, email=email, phone=phone, photo_url=photo_url)
                 db.session.add(staff)
                 added += 1
+            invalidate_branch_data([school_id])
             db.session.commit()
             if errors:
                 flash(f'Bulk upload complete! Added: {added}, Skipped: {skipped}. Errors: {"; ".join(errors[:5])}{"..." if len(errors) > 5 else ""}', 'warning')
@@ -2078,6 +4230,7 @@ def edit_user(id):
                 school = School.query.get(int(school_id))
                 if school:
                     user.allowed_schools.append(school)
+    invalidate_principals()
     db.session.commit()
     flash('User updated successfully', 'success')
     return redirect(url_for('users'))
@@ -2092,6 +4245,7 @@ def delete_user(id):
         flash('You cannot delete yourself!', 'danger')
         return redirect(url_for('users'))
     db.session.delete(user)
+    invalidate_principals()
     db.session.commit()
     flash('User deleted successfully!', 'success')
     return redirect(url_for('users'))
@@ -2128,6 +4282,11 @@ def add_query_template():
             flash('All fields are required!', 'danger')
             return redirect(url_for('add_query_template'))
         
+        unknown = find_unknown_placeholders(subject, body)
+        if unknown:
+            flash(f'Unknown placeholder(s): {", ".join(unknown)}. The subject supports {{staff_name}}, {{date}} and {{period}}.', 'danger')
+            return redirect(url_for('add_query_template'))
+        
         template = QueryTemplate(
             organization_id=organization_id, 
             title=title, 
@@ -2155,11 +4314,16 @@ def edit_query_template(id):
     template = QueryTemplate.query.get_or_404(id)
     
     if request.method == 'POST':
+        unknown = find_unknown_placeholders(request.form.get('subject'), request.form.get('body'))
+        if unknown:
+            flash(f'Unknown placeholder(s): {", ".join(unknown)}. The subject supports {{staff_name}}, {{date}} and {{period}}.', 'danger')
+            return redirect(url_for('edit_query_template', id=id))
         template.organization_id = request.form.get('organization_id')
         template.title = request.form.get('title')
         template.subject = request.form.get('subject')
         template.body = request.form.get('body')
         template.from_email = request.form.get('from_email', '').strip() or None
+        template.version = (template.version or 1) + 1
         db.session.commit()
         flash('Query template updated successfully!', 'success')
         return redirect(url_for('query_templates'))
@@ -2218,12 +4382,17 @@ def send_query():
             flash('Invalid template!', 'danger')
             return redirect(url_for('send_query'))
         
-        success_count = 0
-        fail_count = 0
-        no_email_count = 0
+        organization = template.organization
+        staff_by_id = {s.id: s for s in Staff.query.options(db.joinedload(Staff.school)).filter(
+            Staff.id.in_([int(sid) for sid in staff_ids if str(sid).isdigit()])).all()}
         
+        # Render payloads now and queue them; the outbox worker does the HTTP calls
+        message, keys = build_query_message(template, organization)
+        now = datetime.utcnow()
+        today_str = datetime.now().strftime('%d/%m/%Y')
+        records = []
         for staff_id in staff_ids:
-            staff = Staff.query.get(staff_id)
+            staff = staff_by_id.get(int(staff_id)) if str(staff_id).isdigit() else None
             if not staff:
                 continue
             
@@ -2232,41 +4401,44 @@ def send_query():
             if staff_late_count is None:
                 staff_late_count = staff.times_late
             
-            if not staff.email:
-                no_email_count += 1
-                query_record = StaffQuery(
-                    staff_id=staff.id, 
-                    template_id=template.id, 
-                    sent_by=current_user.id, 
-                    times_late_at_query=staff_late_count, 
-                    email_status='no_email'
-                )
-                db.session.add(query_record)
-                continue
-            
-            organization = template.organization
-            success, message = send_query_email(staff, template, organization, current_user, staff_late_count, period_str)
-            
-            query_record = StaffQuery(
-                staff_id=staff.id, 
-                template_id=template.id, 
-                sent_by=current_user.id, 
-                times_late_at_query=staff_late_count, 
-                email_status='sent' if success else 'failed'
-            )
-            db.session.add(query_record)
-            
-            if success:
-                success_count += 1
-            else:
-                fail_count += 1
+            email_data = None
+            if staff.email:
+                email_data = {
+                    'message': message,
+                    'personalization': build_query_personalization(staff, organization, keys, staff_late_count, period_str, today_str)
+                }
+            records.append({
+                'staff_id': staff.id,
+                'template_id': template.id,
+                'sent_by': current_user.id,
+                'sent_at': now,
+                'times_late_at_query': staff_late_count,
+                'email_status': 'pending' if email_data else 'no_email',
+                'payload': json.dumps(email_data) if email_data else None,
+                'attempts': 0,
+                'next_attempt_at': now if email_data else None
+            })
         
+        queued_count = sum(1 for r in records if r['email_status'] == 'pending')
+        no_email_count = len(records) - queued_count
+        
+        if records:
+            db.session.bulk_insert_mappings(StaffQuery, records)
+            # One UPDATE per distinct increment (a staff member normally appears once)
+            staff_by_increment = {}
+            for staff_id, increment in Counter(r['staff_id'] for r in records).items():
+                staff_by_increment.setdefault(increment, []).append(staff_id)
+            for increment, ids in staff_by_increment.items():
+                Staff.query.filter(Staff.id.in_(ids)).update({
+                    Staff.query_count: db.func.coalesce(Staff.query_count, 0) + increment,
+                    Staff.last_queried_at: now
+                }, synchronize_session=False)
         db.session.commit()
+        if queued_count:
+            wake_outbox_worker()
         
-        if success_count > 0:
-            flash(f'Successfully sent {success_count} query email(s)!', 'success')
-        if fail_count > 0:
-            flash(f'{fail_count} email(s) failed to send.', 'warning')
+        if queued_count > 0:
+            flash(f'Queued {queued_count} query email(s) for delivery.', 'success')
         if no_email_count > 0:
             flash(f'{no_email_count} staff member(s) have no email address (query recorded).', 'info')
         
@@ -2334,30 +4506,30 @@ def send_query():
     elif branch_id:
         staff_query = staff_query.filter(Staff.school_id == branch_id)
     
-    all_staff = staff_query.all()
-    
-    # Calculate late counts based on period
-    late_staff = []
-    for s in all_staff:
-        if start_date:
-            period_late_count = Attendance.query.filter(
-                Attendance.staff_id == s.id,
-                Attendance.date >= start_date,
-                Attendance.date <= end_date,
-                Attendance.is_late == True
-            ).count()
-        else:
-            period_late_count = s.times_late
-        
-        if period_late_count > 0:
-            late_staff.append({
-                'staff': s,
-                'late_count': period_late_count,
-                'total_late': s.times_late
-            })
+    # Late counts for the period in one grouped query; all-time uses the stored counter
+    staff_query = staff_query.options(db.joinedload(Staff.school))
+    if start_date:
+        source = attendance_source(start_date)
+        late_count_col = db.func.count(source.id)
+        rows = staff_query.join(source, db.and_(
+            source.staff_id == Staff.id,
+            source.date >= start_date,
+            source.date <= end_date,
+            source.is_late == True
+        )).with_entities(Staff, late_count_col).group_by(Staff.id).having(
+            late_count_col > 0
+        ).order_by(late_count_col.desc(), Staff.id).all()
+    else:
+        rows = [(s, s.times_late) for s in staff_query.filter(
+            Staff.times_late > 0
+        ).order_by(Staff.times_late.desc(), Staff.id).all()]
     
-    # Sort by late count descending
-    late_staff.sort(key=lambda x: x['late_count'], reverse=True)
+    late_staff = [{
+        'staff': s,
+        'late_count': late_count,
+        'total_late': s.times_late,
+        'query_count': s.query_count or 0
+    } for s, late_count in rows]
     
     # Get organizations and branches for filters
     if current_user.role == 'super_admin':
@@ -2398,17 +4570,50 @@ def query_tracking():
     accessible_school_ids = current_user.get_accessible_school_ids()
     organization_id = request.args.get('organization_id', type=int)
     if current_user.role == 'super_admin':
-        if organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
-            staff_with_queries = db.session.query(Staff, db.func.count(StaffQuery.id).label('query_count')).outerjoin(StaffQuery).filter(Staff.school_id.in_(org_school_ids)).group_by(Staff.id).having(db.func.count(StaffQuery.id) > 0).order_by(db.desc('query_count')).all()
-        else:
-            staff_with_queries = db.session.query(Staff, db.func.count(StaffQuery.id).label('query_count')).outerjoin(StaffQuery).group_by(Staff.id).having(db.func.count(StaffQuery.id) > 0).order_by(db.desc('query_count')).all()
         organizations = Organization.query.all()
+        scope_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()] if organization_id else None
     else:
-        staff_with_queries = db.session.query(Staff, db.func.count(StaffQuery.id).label('query_count')).outerjoin(StaffQuery).filter(Staff.school_id.in_(accessible_school_ids)).group_by(Staff.id).having(db.func.count(StaffQuery.id) > 0).order_by(db.desc('query_count')).all() if accessible_school_ids else []
         organizations = current_user.get_accessible_organizations()
-    recent_queries = StaffQuery.query.order_by(StaffQuery.sent_at.desc()).limit(50).all()
-    return render_template('query_tracking.html', staff_with_queries=staff_with_queries, recent_queries=recent_queries, organizations=organizations, selected_organization=organization_id)
+        scope_school_ids = accessible_school_ids
+    
+    # Staff summary: keyset on (query_count, id) descending
+    staff_query = Staff.query.options(db.joinedload(Staff.school)).filter(Staff.query_count > 0)
+    if scope_school_ids is not None:
+        staff_query = staff_query.filter(Staff.school_id.in_(scope_school_ids))
+    staff_cursor = parse_keyset_cursor(request.args.get('staff_after'), int, int)
+    if staff_cursor:
+        staff_query = staff_query.filter(db.or_(
+            Staff.query_count < staff_cursor[0],
+            db.and_(Staff.query_count == staff_cursor[0], Staff.id < staff_cursor[1])
+        ))
+    staff_page = staff_query.order_by(Staff.query_count.desc(), Staff.id.desc()).limit(KEYSET_PAGE_SIZE + 1).all()
+    next_staff_cursor = make_keyset_cursor(staff_page[KEYSET_PAGE_SIZE - 1].query_count, staff_page[KEYSET_PAGE_SIZE - 1].id) if len(staff_page) > KEYSET_PAGE_SIZE else None
+    staff_with_queries = [(s, s.query_count) for s in staff_page[:KEYSET_PAGE_SIZE]]
+    
+    # Recent queries: keyset on (sent_at, id) descending, related rows loaded in the same query
+    recent_query = StaffQuery.query.join(Staff, StaffQuery.staff_id == Staff.id).options(
+        db.contains_eager(StaffQuery.staff).joinedload(Staff.school),
+        db.joinedload(StaffQuery.template),
+        db.joinedload(StaffQuery.sender)
+    )
+    if scope_school_ids is not None:
+        recent_query = recent_query.filter(Staff.school_id.in_(scope_school_ids))
+    recent_cursor = parse_keyset_cursor(request.args.get('recent_before'), datetime.fromisoformat, int)
+    if recent_cursor:
+        recent_query = recent_query.filter(db.or_(
+            StaffQuery.sent_at < recent_cursor[0],
+            db.and_(StaffQuery.sent_at == recent_cursor[0], StaffQuery.id < recent_cursor[1])
+        ))
+    recent_page = recent_query.order_by(StaffQuery.sent_at.desc(), StaffQuery.id.desc()).limit(KEYSET_PAGE_SIZE + 1).all()
+    next_recent_cursor = make_keyset_cursor(recent_page[KEYSET_PAGE_SIZE - 1].sent_at, recent_page[KEYSET_PAGE_SIZE - 1].id) if len(recent_page) > KEYSET_PAGE_SIZE else None
+    recent_queries = recent_page[:KEYSET_PAGE_SIZE]
+    
+    # Picks up rows left queued by a previous process
+    wake_outbox_worker()
+    return render_template('query_tracking.html', staff_with_queries=staff_with_queries, recent_queries=recent_queries, organizations=organizations, selected_organization=organization_id,
+                           next_staff_cursor=next_staff_cursor, next_recent_cursor=next_recent_cursor,
+                           staff_after=request.args.get('staff_after') if staff_cursor else None,
+                           recent_before=request.args.get('recent_before') if recent_cursor else None)
 
 
 @app.route('/queries/staff/<int:staff_id>')
@@ -2416,8 +4621,42 @@ def query_tracking():
 @role_required('super_admin', 'hr_viewer', 'school_admin')
 def staff_query_history(staff_id):
     staff = Staff.query.get_or_404(staff_id)
-    queries = StaffQuery.query.filter_by(staff_id=staff_id).order_by(StaffQuery.sent_at.desc()).all()
-    return render_template('staff_query_history.html', staff=staff, queries=queries)
+    if current_user.role != 'super_admin' and staff.school_id not in current_user.get_accessible_school_ids():
+        flash('Access denied', 'danger')
+        return redirect(url_for('query_tracking'))
+    
+    history_query = StaffQuery.query.options(
+        db.joinedload(StaffQuery.template).joinedload(QueryTemplate.organization),
+        db.joinedload(StaffQuery.sender)
+    ).filter(StaffQuery.staff_id == staff_id)
+    cursor = parse_keyset_cursor(request.args.get('before'), datetime.fromisoformat, int)
+    if cursor:
+        history_query = history_query.filter(db.or_(
+            StaffQuery.sent_at < cursor[0],
+            db.and_(StaffQuery.sent_at == cursor[0], StaffQuery.id < cursor[1])
+        ))
+    page = history_query.order_by(StaffQuery.sent_at.desc(), StaffQuery.id.desc()).limit(KEYSET_PAGE_SIZE + 1).all()
+    next_cursor = make_keyset_cursor(page[KEYSET_PAGE_SIZE - 1].sent_at, page[KEYSET_PAGE_SIZE - 1].id) if len(page) > KEYSET_PAGE_SIZE else None
+    queries = page[:KEYSET_PAGE_SIZE]
+    
+    # Show what was actually sent when the payload is stored, else render the template now
+    previews = {}
+    for query in queries:
+        if query.payload:
+            previews[query.id] = render_query_payload(json.loads(query.payload))
+        elif query.template:
+            values = query_placeholder_values(staff, query.template.organization, query.times_late_at_query)
+            previews[query.id] = get_compiled_query_template(query.template).render(values)
+    return render_template('staff_query_history.html', staff=staff, queries=queries, previews=previews,
+                           next_cursor=next_cursor, paged=bool(cursor))
+
+
+@app.route('/api/queries/outbox')
+@login_required
+@role_required('super_admin', 'hr_viewer', 'school_admin')
+def api_query_outbox():
+    """Queue depth and delivery throughput of the query email outbox"""
+    return jsonify(get_outbox_stats())
 
 
 # ==================== REPORTS ====================
@@ -2430,6 +4669,7 @@ def reports():
 
 @app.route('/reports/attendance')
 @login_required
+@conditional_on_branch_data
 def attendance_report():
     today_param = request.args.get('today', '')
     date_from = request.args.get('date_from', '')
@@ -2450,7 +4690,8 @@ def attendance_report():
     except:
         start_date = today
         end_date = today
-    query = Attendance.query.filter(Attendance.date >= start_date, Attendance.date <= end_date)
+    source = attendance_source(start_date)
+    query = db.session.query(source).filter(source.date >= start_date, source.date <= end_date)
     accessible_school_ids = current_user.get_accessible_school_ids()
     if organization_id:
         org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
@@ -2458,14 +4699,14 @@ def attendance_report():
             staff_ids = [s.id for s in Staff.query.filter_by(school_id=school_id).all()]
         else:
             staff_ids = [s.id for s in Staff.query.filter(Staff.school_id.in_(org_school_ids)).all()] if org_school_ids else []
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
     elif school_id:
         staff_ids = [s.id for s in Staff.query.filter_by(school_id=school_id).all()]
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
     elif current_user.role != 'super_admin' and accessible_school_ids:
         staff_ids = [s.id for s in Staff.query.filter(Staff.school_id.in_(accessible_school_ids)).all()]
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
-    attendance = query.order_by(Attendance.date.desc()).all()
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+    attendance = query.order_by(source.date.desc()).all()
     if current_user.role == 'super_admin':
         schools = School.query.all()
         organizations = Organization.query.all()
@@ -2477,6 +4718,7 @@ def attendance_report():
 
 @app.route('/reports/attendance/download')
 @login_required
+@conditional_on_branch_data
 def download_attendance():
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
@@ -2493,7 +4735,8 @@ def download_attendance():
     except:
         start_date = today
         end_date = today
-    query = Attendance.query.filter(Attendance.date >= start_date, Attendance.date <= end_date)
+    source = attendance_source(start_date)
+    query = db.session.query(source).filter(source.date >= start_date, source.date <= end_date)
     accessible_school_ids = current_user.get_accessible_school_ids()
     if organization_id:
         org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
@@ -2501,14 +4744,14 @@ def download_attendance():
             staff_ids = [s.id for s in Staff.query.filter_by(school_id=school_id).all()]
         else:
             staff_ids = [s.id for s in Staff.query.filter(Staff.school_id.in_(org_school_ids)).all()] if org_school_ids else []
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
     elif school_id:
         staff_ids = [s.id for s in Staff.query.filter_by(school_id=school_id).all()]
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
     elif current_user.role != 'super_admin' and accessible_school_ids:
         staff_ids = [s.id for s in Staff.query.filter(Staff.school_id.in_(accessible_school_ids)).all()]
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
-    attendance = query.order_by(Attendance.date.desc()).all()
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+    attendance = query.order_by(source.date.desc()).all()
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(['Date', 'Staff ID', 'Name', 'Organization', 'Branch', 'Department', 'Shift', 'Sign In', 'Sign Out', 'Status', 'Late Duration', 'Overtime Duration'])
@@ -2532,6 +4775,7 @@ def download_attendance():
 
 @app.route('/reports/late')
 @login_required
+@conditional_on_branch_data
 def late_report():
     today_param = request.args.get('today', '')
     date_from = request.args.get('date_from', '')
@@ -2566,19 +4810,27 @@ def late_report():
         staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
     staff_list_data = staff_query.all()
     late_staff = []
+    staff_ids = [s.id for s in staff_list_data if s.department != 'Management']
+    lifetime_stats = get_lifetime_stats_map(staff_ids)
+    period_counts = {}
+    if start_date and end_date and staff_ids:
+        source = attendance_source(start_date)
+        period_counts = {row[0]: (row[1], int(row[2] or 0)) for row in db.session.query(
+            source.staff_id,
+            db.func.count(source.id),
+            db.func.sum(db.case((source.is_late == True, 1), else_=0))
+        ).filter(
+            source.staff_id.in_(staff_ids),
+            source.date >= start_date,
+            source.date <= end_date
+        ).group_by(source.staff_id).all()}
     for s in staff_list_data:
         if s.department == 'Management':
             continue
-        if start_date and end_date:
-            period_att_query = Attendance.query.filter(Attendance.staff_id == s.id, Attendance.date >= start_date, Attendance.date <= end_date)
-            period_total = period_att_query.count()
-            period_late = period_att_query.filter_by(is_late=True).count()
-        else:
-            period_total = 0
-            period_late = 0
-        all_att_query = Attendance.query.filter_by(staff_id=s.id)
-        all_total = all_att_query.count()
-        all_late = all_att_query.filter_by(is_late=True).count()
+        period_total, period_late = period_counts.get(s.id, (0, 0))
+        stats = lifetime_stats.get(s.id)
+        all_total = stats.total_days if stats else 0
+        all_late = stats.late_days if stats else 0
         if start_date and end_date:
             times_late = period_late
         else:
@@ -2624,6 +4876,7 @@ def late_report():
 
 @app.route('/reports/late/download')
 @login_required
+@conditional_on_branch_data
 def download_late_report():
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
@@ -2654,19 +4907,27 @@ def download_late_report():
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(['Staff ID', 'Name', 'Organization', 'Branch', 'Department', 'Shift', 'Times Late', '% Punctuality', '% Lateness'])
+    staff_ids = [s.id for s in staff_list_data if s.department != 'Management']
+    lifetime_stats = get_lifetime_stats_map(staff_ids)
+    period_counts = {}
+    if start_date and end_date and staff_ids:
+        source = attendance_source(start_date)
+        period_counts = {row[0]: (row[1], int(row[2] or 0)) for row in db.session.query(
+            source.staff_id,
+            db.func.count(source.id),
+            db.func.sum(db.case((source.is_late == True, 1), else_=0))
+        ).filter(
+            source.staff_id.in_(staff_ids),
+            source.date >= start_date,
+            source.date <= end_date
+        ).group_by(source.staff_id).all()}
     for s in staff_list_data:
         if s.department == 'Management':
             continue
-        if start_date and end_date:
-            period_att_query = Attendance.query.filter(Attendance.staff_id == s.id, Attendance.date >= start_date, Attendance.date <= end_date)
-            period_total = period_att_query.count()
-            period_late = period_att_query.filter_by(is_late=True).count()
-        else:
-            period_total = 0
-            period_late = 0
-        all_att_query = Attendance.query.filter_by(staff_id=s.id)
-        all_total = all_att_query.count()
-        all_late = all_att_query.filter_by(is_late=True).count()
+        period_total, period_late = period_counts.get(s.id, (0, 0))
+        stats = lifetime_stats.get(s.id)
+        all_total = stats.total_days if stats else 0
+        all_late = stats.late_days if stats else 0
         if start_date and end_date:
             times_late = period_late
         else:
@@ -2713,6 +4974,7 @@ def reset_late_counter():
         school_name = 'all branches'
     for s in staff:
         s.times_late = 0
+    invalidate_branch_data({s.school_id for s in staff})
     db.session.commit()
     flash(f'Late counters reset for {school_name}!', 'success')
     return redirect(url_for('late_report'))
@@ -2720,6 +4982,7 @@ def reset_late_counter():
 
 @app.route('/reports/absent')
 @login_required
+@conditional_on_branch_data
 def absent_report():
     today_param = request.args.get('today', '')
     date_from = request.args.get('date_from', '')
@@ -2753,26 +5016,34 @@ def absent_report():
     elif current_user.role != 'super_admin' and accessible_school_ids:
         staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
     all_staff = staff_query.all()
+    calendar = WorkCalendar(set(s.school for s in all_staff if s.school))
+    non_mgmt_staff = [s for s in all_staff if s.department != 'Management']
+    staff_ids = [s.id for s in non_mgmt_staff]
+    source = attendance_source(start_date)
+    present_keys = set((r.staff_id, r.date) for r in db.session.query(source.staff_id, source.date).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= start_date,
+        source.date <= end_date
+    ).all()) if staff_ids else set()
+    shift_names = {}
     absent_records = []
-    current_date = start_date
-    while current_date <= end_date:
-        for s in all_staff:
-            if s.department == 'Management':
-                continue
+    for i, is_working in enumerate(calendar.work_day_flags(start_date, end_date)):
+        if not is_working:
+            continue
+        current_date = start_date + timedelta(days=i)
+        for s in non_mgmt_staff:
             # Check if this is a work day for the staff's branch
-            if not is_work_day(s.school, current_date):
+            if not calendar.is_work_day(s.school_id, current_date) or (s.id, current_date) in present_keys:
                 continue
-            attendance = Attendance.query.filter_by(staff_id=s.id, date=current_date).first()
-            if not attendance:
-                # Get shift info
+            # Get shift info
+            if s.id not in shift_names:
                 current_shift = get_staff_current_shift(s)
-                shift_name = current_shift.name if current_shift else None
-                absent_records.append({
-                    'date': current_date, 
-                    'staff': s,
-                    'shift': shift_name
-                })
-        current_date += timedelta(days=1)
+                shift_names[s.id] = current_shift.name if current_shift else None
+            absent_records.append({
+                'date': current_date, 
+                'staff': s,
+                'shift': shift_names[s.id]
+            })
     if current_user.role == 'super_admin':
         schools = School.query.all()
         organizations = Organization.query.all()
@@ -2784,6 +5055,7 @@ def absent_report():
 
 @app.route('/reports/absent/download')
 @login_required
+@conditional_on_branch_data
 def download_absent_report():
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
@@ -2816,21 +5088,29 @@ def download_absent_report():
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(['Date', 'Staff ID', 'Name', 'Organization', 'Branch', 'Department', 'Shift'])
-    current_date = start_date
-    while current_date <= end_date:
-        for s in all_staff:
-            if s.department == 'Management':
-                continue
+    calendar = WorkCalendar(set(s.school for s in all_staff if s.school))
+    non_mgmt_staff = [s for s in all_staff if s.department != 'Management']
+    staff_ids = [s.id for s in non_mgmt_staff]
+    source = attendance_source(start_date)
+    present_keys = set((r.staff_id, r.date) for r in db.session.query(source.staff_id, source.date).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= start_date,
+        source.date <= end_date
+    ).all()) if staff_ids else set()
+    shift_names = {}
+    for i, is_working in enumerate(calendar.work_day_flags(start_date, end_date)):
+        if not is_working:
+            continue
+        current_date = start_date + timedelta(days=i)
+        for s in non_mgmt_staff:
             # Check if this is a work day for the staff's branch
-            if not is_work_day(s.school, current_date):
+            if not calendar.is_work_day(s.school_id, current_date) or (s.id, current_date) in present_keys:
                 continue
-            attendance = Attendance.query.filter_by(staff_id=s.id, date=current_date).first()
-            if not attendance:
-                # Get shift info
+            # Get shift info
+            if s.id not in shift_names:
                 current_shift = get_staff_current_shift(s)
-                shift_name = current_shift.name if current_shift else 'Regular'
-                writer.writerow([current_date.strftime('%d/%m/%Y'), s.staff_id, s.name, s.school.organization.name if s.school and s.school.organization else '', s.school.short_name or s.school.name if s.school else '', s.department, shift_name])
-        current_date += timedelta(days=1)
+                shift_names[s.id] = current_shift.name if current_shift else 'Regular'
+            writer.writerow([current_date.strftime('%d/%m/%Y'), s.staff_id, s.name, s.school.organization.name if s.school and s.school.organization else '', s.school.short_name or s.school.name if s.school else '', s.department, shift_names[s.id]])
     output.seek(0)
     filename = f'absent_{date_from}_to_{date_to}.csv'
     return Response(output.getvalue(), mimetype='text/csv', headers={'Content-Disposition': f'attachment; filename={filename}'})
@@ -2838,6 +5118,7 @@ def download_absent_report():
 
 @app.route('/reports/overtime')
 @login_required
+@conditional_on_branch_data
 def overtime_report():
     today_param = request.args.get('today', '')
     date_from = request.args.get('date_from', '')
@@ -2858,7 +5139,8 @@ def overtime_report():
     except:
         start_date = today
         end_date = today
-    query = Attendance.query.filter(Attendance.date >= start_date, Attendance.date <= end_date, Attendance.overtime_minutes > 0)
+    source = attendance_source(start_date)
+    query = db.session.query(source).filter(source.date >= start_date, source.date <= end_date, source.overtime_minutes > 0)
     accessible_school_ids = current_user.get_accessible_school_ids()
     if organization_id:
         org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
@@ -2866,14 +5148,14 @@ def overtime_report():
             staff_ids = [s.id for s in Staff.query.filter_by(school_id=school_id).all()]
         else:
             staff_ids = [s.id for s in Staff.query.filter(Staff.school_id.in_(org_school_ids)).all()] if org_school_ids else []
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
     elif school_id:
         staff_ids = [s.id for s in Staff.query.filter_by(school_id=school_id).all()]
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
     elif current_user.role != 'super_admin' and accessible_school_ids:
         staff_ids = [s.id for s in Staff.query.filter(Staff.school_id.in_(accessible_school_ids)).all()]
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
-    overtime = query.order_by(Attendance.date.desc()).all()
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+    overtime = query.order_by(source.date.desc()).all()
     if current_user.role == 'super_admin':
         schools = School.query.all()
         organizations = Organization.query.all()
@@ -2885,6 +5167,7 @@ def overtime_report():
 
 @app.route('/reports/overtime/download')
 @login_required
+@conditional_on_branch_data
 def download_overtime_report():
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
@@ -2901,7 +5184,8 @@ def download_overtime_report():
     except:
         start_date = today
         end_date = today
-    query = Attendance.query.filter(Attendance.date >= start_date, Attendance.date <= end_date, Attendance.overtime_minutes > 0)
+    source = attendance_source(start_date)
+    query = db.session.query(source).filter(source.date >= start_date, source.date <= end_date, source.overtime_minutes > 0)
     accessible_school_ids = current_user.get_accessible_school_ids()
     if organization_id:
         org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
@@ -2909,14 +5193,14 @@ def download_overtime_report():
             staff_ids = [s.id for s in Staff.query.filter_by(school_id=school_id).all()]
         else:
             staff_ids = [s.id for s in Staff.query.filter(Staff.school_id.in_(org_school_ids)).all()] if org_school_ids else []
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
     elif school_id:
         staff_ids = [s.id for s in Staff.query.filter_by(school_id=school_id).all()]
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
     elif current_user.role != 'super_admin' and accessible_school_ids:
         staff_ids = [s.id for s in Staff.query.filter(Staff.school_id.in_(accessible_school_ids)).all()]
-        query = query.filter(Attendance.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
-    overtime = query.order_by(Attendance.date.desc()).all()
+        query = query.filter(source.staff_id.in_(staff_ids)) if staff_ids else query.filter(False)
+    overtime = query.order_by(source.date.desc()).all()
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(['Date', 'Staff ID', 'Name', 'Organization', 'Branch', 'Department', 'Shift', 'Sign Out', 'Overtime'])
@@ -2930,18 +5214,42 @@ def download_overtime_report():
     return Response(output.getvalue(), mimetype='text/csv', headers={'Content-Disposition': f'attachment; filename={filename}'})
 # ==================== ANALYTICS ====================
 
-@app.route('/reports/analytics')
-@login_required
-def analytics():
-    period = request.args.get('period', '30')
-    school_id = request.args.get('school_id', '')
-    organization_id = request.args.get('organization_id', '')
-    department_filter = request.args.get('department', '')
-    start_date_param = request.args.get('start_date', '')
-    end_date_param = request.args.get('end_date', '')
-    
-    today = date.today()
-    
+def get_on_time_streaks(staff_ids, max_records=60, window_days=90):
+    """{staff id: on-time attendance records in a row, newest first, up to max_records}. Reads back
+    one date window at a time, so on a partitioned table only the recent months are scanned and
+    the archive only once a window reaches it."""
+    counts = {staff_id: 0 for staff_id in staff_ids}
+    streaks = {}
+    if not counts:
+        return streaks
+    everything = attendance_source()
+    earliest = db.session.query(db.func.min(everything.date)).filter(everything.staff_id.in_(list(counts))).scalar()
+    upper = None
+    while counts and earliest is not None and (upper is None or upper >= earliest):
+        lower = (upper or date.today()) - timedelta(days=window_days)
+        source = attendance_source(lower + timedelta(days=1))
+        query = db.session.query(source.staff_id, source.is_late).filter(
+            source.staff_id.in_(list(counts)),
+            source.date > lower
+        )
+        if upper is not None:
+            query = query.filter(source.date <= upper)
+        for staff_id, is_late in query.order_by(source.staff_id, source.date.desc()).all():
+            if staff_id not in counts:
+                continue
+            if is_late:
+                streaks[staff_id] = counts.pop(staff_id)
+                continue
+            counts[staff_id] += 1
+            if counts[staff_id] >= max_records:
+                streaks[staff_id] = counts.pop(staff_id)
+        upper = lower
+    streaks.update(counts)
+    return streaks
+
+
+def resolve_analytics_period(period, start_date_param, end_date_param, today):
+    """Returns (start_date, end_date, period_days) for an analytics period selector"""
     if period == 'today':
         start_date = today
         end_date = today
@@ -2979,9 +5287,29 @@ def analytics():
             period_days = 30
         start_date = today - timedelta(days=period_days)
         end_date = today
-    
-    previous_start = start_date - timedelta(days=period_days)
+    return start_date, end_date, period_days
+
+
+def resolve_analytics_scope(school_id, organization_id):
+    """Branch ids the analytics filters cover for the current user (None = all branches)"""
     accessible_school_ids = current_user.get_accessible_school_ids()
+    if organization_id:
+        return [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
+    elif school_id:
+        return [int(school_id)]
+    elif current_user.role != 'super_admin' and accessible_school_ids:
+        return accessible_school_ids
+    return None
+
+
+def compute_analytics(period='30', school_id='', organization_id='', department_filter='', start_date_param='', end_date_param=''):
+    """
+    Compute everything the analytics page shows for the current user. Filter lists follow
+    the user's access; the figures come from the shared cache, tagged with every branch in
+    scope so attendance, staff or shift changes there invalidate them.
+    """
+    today = date.today()
+    start_date, end_date, period_days = resolve_analytics_period(period, start_date_param, end_date_param, today)
     
     # Filter schools based on role and selected organization
     if current_user.role == 'super_admin':
@@ -3005,15 +5333,37 @@ def analytics():
                 all_depts.add(dept.name)
         departments = sorted(list(all_depts)) if all_depts else ['Academic', 'Non-Academic', 'Administrative', 'Support Staff']
     
-    staff_query = Staff.query.filter_by(is_active=True)
+    scope_school_ids = resolve_analytics_scope(school_id, organization_id)
     
-    if organization_id:
-        org_school_ids = [s.id for s in School.query.filter_by(organization_id=organization_id).all()]
-        staff_query = staff_query.filter(Staff.school_id.in_(org_school_ids))
-    elif school_id:
-        staff_query = staff_query.filter_by(school_id=school_id)
-    elif current_user.role != 'super_admin' and accessible_school_ids:
-        staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
+    branch_schools = [(school.id, school.short_name or school.name[:15]) for school in schools[:10]]
+    tag_school_ids = sorted(scope_school_ids if scope_school_ids is not None else get_reference_data().schools)
+    
+    cache = get_cache()
+    key = cache.key(cache_namespace(organization_id), 'analytics', tag_school_ids, department_filter,
+                    start_date, end_date, period_days, today, departments, branch_schools)
+    metrics = cache.get_or_set(key, lambda: compute_analytics_metrics(
+        start_date, end_date, period_days, today, scope_school_ids, department_filter, departments, branch_schools
+    ), tags=[branch_cache_tag(sid) for sid in tag_school_ids])
+    
+    return dict(
+        metrics,
+        schools=schools, organizations=organizations, departments=departments,
+        selected_school_id=school_id, selected_organization_id=organization_id, selected_department=department_filter,
+        period=period, start_date=start_date.strftime('%Y-%m-%d'), end_date=end_date.strftime('%Y-%m-%d')
+    )
+
+
+def compute_analytics_metrics(start_date, end_date, period_days, today, scope_school_ids, department_filter, departments, branch_schools):
+    """
+    KPIs and chart series from the attendance cube, and the per-staff rankings in a single
+    pass over one attendance extract. Rankings are complete, sorted lists; the page shows
+    the top five of each. branch_schools is the (id, label) list the branch chart covers.
+    """
+    previous_start = start_date - timedelta(days=period_days)
+    
+    staff_query = Staff.query.filter_by(is_active=True)
+    if scope_school_ids is not None:
+        staff_query = staff_query.filter(Staff.school_id.in_(scope_school_ids))
     
     if department_filter:
         staff_query = staff_query.filter_by(department=department_filter)
@@ -3021,58 +5371,89 @@ def analytics():
     all_staff = staff_query.all()
     staff_ids = [s.id for s in all_staff]
     
-    current_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= start_date,
-        Attendance.date <= end_date
+    # Raw rows are only loaded for the per-staff panels; KPIs and charts read the daily cube
+    source = attendance_source(start_date)
+    current_attendance = db.session.query(source).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= start_date,
+        source.date <= end_date
     ).all() if staff_ids else []
+    attendance_by_staff = {}
+    for a in current_attendance:
+        attendance_by_staff.setdefault(a.staff_id, []).append(a)
     
-    previous_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= previous_start,
-        Attendance.date < start_date
-    ).all() if staff_ids else []
+    previous_source = attendance_source(previous_start)
+    previous_late_by_staff = dict(db.session.query(
+        previous_source.staff_id, db.func.count(previous_source.id)
+    ).filter(
+        previous_source.staff_id.in_(staff_ids),
+        previous_source.date >= previous_start,
+        previous_source.date < start_date,
+        previous_source.is_late == True
+    ).group_by(previous_source.staff_id).all()) if staff_ids else {}
+    
+    this_week_start = today - timedelta(days=today.weekday())
+    last_week_start = this_week_start - timedelta(days=7)
+    
+    daily_cube = {r.date: r for r in query_attendance_cube(
+        [AttendanceDailyStats.date], min(previous_start, last_week_start), max(end_date, today),
+        scope_school_ids, department_filter
+    )}
+    
+    def cube_totals(range_start, range_end):
+        totals = {'present': 0, 'late': 0, 'late_minutes': 0, 'overtime_minutes': 0}
+        for day, r in daily_cube.items():
+            if range_start <= day <= range_end:
+                totals['present'] += r.present or 0
+                totals['late'] += r.late or 0
+                totals['late_minutes'] += r.late_minutes or 0
+                totals['overtime_minutes'] += r.overtime_minutes or 0
+        return totals
+    
+    current_totals = cube_totals(start_date, end_date)
+    previous_totals = cube_totals(previous_start, start_date - timedelta(days=1))
     
     total_staff = len(all_staff)
     branch_count = len(set(s.school_id for s in all_staff)) if all_staff else 0
-    total_records = len(current_attendance)
-    
-    # Calculate working days based on each staff's work schedule
-    working_days = 0
-    for i in range(period_days):
-        check_date = start_date + timedelta(days=i)
-        for s in all_staff[:1]:
-            if s.school and is_work_day(s.school, check_date):
-                working_days += 1
-                break
+    total_records = current_totals['present']
     
-    if working_days == 0:
-        working_days = sum(1 for i in range(period_days) if (start_date + timedelta(days=i)).weekday() < 5)
+    # Working days are counted per branch, each against its own work-day calendar
+    calendar = WorkCalendar(set(s.school for s in all_staff if s.school))
+    staff_per_school = {}
+    staff_per_department = {}
+    for s in all_staff:
+        staff_per_school[s.school_id] = staff_per_school.get(s.school_id, 0) + 1
+        staff_per_department[s.department] = staff_per_department.get(s.department, 0) + 1
+    branch_working_days = calendar.count_by_school(start_date, end_date)
+    
+    def staff_working_on(check_date, staff_counts):
+        return sum(count for sid, count in staff_counts.items() if calendar.is_work_day(sid, check_date))
     
-    expected_attendance = total_staff * working_days if total_staff > 0 else 1
+    total_expected = calendar.expected_attendance(staff_per_school, start_date, end_date)
+    expected_attendance = total_expected if total_staff > 0 else 1
     
     attendance_rate = round((total_records / expected_attendance) * 100, 1) if expected_attendance > 0 and total_records > 0 else 0
     attendance_rate = min(attendance_rate, 100)
     
-    prev_working_days = sum(1 for i in range(period_days) if (previous_start + timedelta(days=i)).weekday() < 5)
-    prev_expected = total_staff * prev_working_days if total_staff > 0 else 1
-    prev_attendance_rate = round((len(previous_attendance) / prev_expected) * 100, 1) if prev_expected > 0 and len(previous_attendance) > 0 else 0
+    prev_records = previous_totals['present']
+    prev_expected = calendar.expected_attendance(staff_per_school, previous_start, start_date - timedelta(days=1)) if total_staff > 0 else 1
+    prev_attendance_rate = round((prev_records / prev_expected) * 100, 1) if prev_expected > 0 and prev_records > 0 else 0
     prev_attendance_rate = min(prev_attendance_rate, 100)
     
     attendance_trend = round(attendance_rate - prev_attendance_rate, 1)
     
-    on_time_count = sum(1 for a in current_attendance if not a.is_late)
-    late_count = sum(1 for a in current_attendance if a.is_late)
+    late_count = current_totals['late']
+    on_time_count = total_records - late_count
     punctuality_rate = round((on_time_count / total_records) * 100, 1) if total_records > 0 else 0
     
-    prev_on_time = sum(1 for a in previous_attendance if not a.is_late)
-    prev_punctuality = round((prev_on_time / len(previous_attendance)) * 100, 1) if len(previous_attendance) > 0 else 0
+    prev_on_time = prev_records - previous_totals['late']
+    prev_punctuality = round((prev_on_time / prev_records) * 100, 1) if prev_records > 0 else 0
     punctuality_trend = round(punctuality_rate - prev_punctuality, 1)
     
-    total_late_minutes = sum(a.late_minutes for a in current_attendance if a.is_late)
+    total_late_minutes = current_totals['late_minutes']
     avg_late_minutes = round(total_late_minutes / late_count, 1) if late_count > 0 else 0
     
-    total_overtime_minutes = sum(a.overtime_minutes for a in current_attendance)
+    total_overtime_minutes = current_totals['overtime_minutes']
     overtime_hours = total_overtime_minutes // 60
     overtime_mins = total_overtime_minutes % 60
     
@@ -3080,210 +5461,213 @@ def analytics():
     trend_data = []
     punctuality_data = []
     
-    current_date = start_date
-    while current_date <= end_date:
-        if current_date.weekday() < 5:
-            day_attendance = [a for a in current_attendance if a.date == current_date]
-            day_count = len(day_attendance)
-            day_rate = round((day_count / total_staff) * 100, 1) if total_staff > 0 else 0
-            day_on_time = sum(1 for a in day_attendance if not a.is_late)
+    work_day_flags = calendar.work_day_flags(start_date, end_date)
+    
+    if period_days > 92:
+        # Long windows are plotted per week (Monday start) so the chart stays readable
+        weekly = rollup_attendance_cube([r for day, r in daily_cube.items() if start_date <= day <= end_date], 'week')
+        week_start = start_date - timedelta(days=start_date.weekday())
+        while week_start <= end_date:
+            week_totals = weekly.get(week_start, {'present': 0, 'late': 0})
+            week_expected = calendar.expected_attendance(staff_per_school, max(week_start, start_date), min(week_start + timedelta(days=6), end_date))
+            week_rate = round((week_totals['present'] / week_expected) * 100, 1) if week_expected > 0 else 0
+            week_punctuality = round(((week_totals['present'] - week_totals['late']) / week_totals['present']) * 100, 1) if week_totals['present'] > 0 else 0
+            trend_labels.append(max(week_start, start_date).strftime('%d %b'))
+            trend_data.append(min(week_rate, 100))
+            punctuality_data.append(week_punctuality)
+            week_start += timedelta(days=7)
+    else:
+        for i, is_working in enumerate(work_day_flags):
+            if not is_working:
+                continue
+            current_date = start_date + timedelta(days=i)
+            day_staff = staff_working_on(current_date, staff_per_school)
+            day_cube = daily_cube.get(current_date)
+            day_count = day_cube.present if day_cube else 0
+            day_rate = round((day_count / day_staff) * 100, 1) if day_staff > 0 else 0
+            day_on_time = day_count - (day_cube.late if day_cube else 0)
             day_punctuality = round((day_on_time / day_count) * 100, 1) if day_count > 0 else 0
             trend_labels.append(current_date.strftime('%d %b'))
             trend_data.append(min(day_rate, 100))
             punctuality_data.append(day_punctuality)
-        current_date += timedelta(days=1)
     
     late_by_day = [0, 0, 0, 0, 0, 0, 0]
-    for a in current_attendance:
-        if a.is_late:
-            late_by_day[a.date.weekday()] += 1
+    for day, r in daily_cube.items():
+        if start_date <= day <= end_date:
+            late_by_day[day.weekday()] += r.late or 0
     
     absent_by_day = [0, 0, 0, 0, 0, 0, 0]
     non_mgmt_staff = [s for s in all_staff if s.department != 'Management']
-    current_date = start_date
-    while current_date <= end_date:
-        if current_date.weekday() < 5:
-            for s in non_mgmt_staff:
-                has_attendance = any(a.date == current_date and a.staff_id == s.id for a in current_attendance)
-                if not has_attendance:
-                    absent_by_day[current_date.weekday()] += 1
-        current_date += timedelta(days=1)
+    present_keys = set((a.staff_id, a.date) for a in current_attendance)
+    for i, is_working in enumerate(work_day_flags):
+        if not is_working:
+            continue
+        current_date = start_date + timedelta(days=i)
+        for s in non_mgmt_staff:
+            if calendar.is_work_day(s.school_id, current_date) and (s.id, current_date) not in present_keys:
+                absent_by_day[current_date.weekday()] += 1
+    
+    # Peak-hour boundaries are multiples of ARRIVAL_BUCKET_MINUTES, so the histogram maps onto them exactly
+    bucket_query = db.session.query(
+        AttendanceArrivalBucket.bucket, db.func.sum(AttendanceArrivalBucket.late_arrivals)
+    ).filter(
+        AttendanceArrivalBucket.date >= start_date,
+        AttendanceArrivalBucket.date <= end_date,
+        AttendanceArrivalBucket.late_arrivals > 0
+    )
+    if scope_school_ids is not None:
+        bucket_query = bucket_query.filter(AttendanceArrivalBucket.school_id.in_(scope_school_ids))
+    if department_filter:
+        bucket_query = bucket_query.filter(AttendanceArrivalBucket.department == department_filter)
     
     peak_late_hours = {'08:00-08:15': 0, '08:15-08:30': 0, '08:30-08:45': 0, '08:45-09:00': 0, '09:00-09:30': 0, '09:30+': 0}
-    for a in current_attendance:
-        if a.is_late and a.sign_in_time:
-            total_minutes = a.sign_in_time.hour * 60 + a.sign_in_time.minute
-            if total_minutes < 8 * 60 + 15:
-                peak_late_hours['08:00-08:15'] += 1
-            elif total_minutes < 8 * 60 + 30:
-                peak_late_hours['08:15-08:30'] += 1
-            elif total_minutes < 8 * 60 + 45:
-                peak_late_hours['08:30-08:45'] += 1
-            elif total_minutes < 9 * 60:
-                peak_late_hours['08:45-09:00'] += 1
-            elif total_minutes < 9 * 60 + 30:
-                peak_late_hours['09:00-09:30'] += 1
-            else:
-                peak_late_hours['09:30+'] += 1
+    for bucket, late_arrivals in bucket_query.group_by(AttendanceArrivalBucket.bucket).all():
+        total_minutes = bucket * ARRIVAL_BUCKET_MINUTES
+        if total_minutes < 8 * 60 + 15:
+            peak_late_hours['08:00-08:15'] += late_arrivals
+        elif total_minutes < 8 * 60 + 30:
+            peak_late_hours['08:15-08:30'] += late_arrivals
+        elif total_minutes < 8 * 60 + 45:
+            peak_late_hours['08:30-08:45'] += late_arrivals
+        elif total_minutes < 9 * 60:
+            peak_late_hours['08:45-09:00'] += late_arrivals
+        elif total_minutes < 9 * 60 + 30:
+            peak_late_hours['09:00-09:30'] += late_arrivals
+        else:
+            peak_late_hours['09:30+'] += late_arrivals
     
     peak_late_labels = list(peak_late_hours.keys())
     peak_late_data = list(peak_late_hours.values())
     
+    department_cube = {r.department: r for r in query_attendance_cube(
+        [AttendanceDailyStats.department], start_date, end_date, scope_school_ids, department_filter
+    )}
     department_labels = []
     department_data = []
     for dept in departments:
-        dept_staff = [s for s in all_staff if s.department == dept]
-        if dept_staff:
-            dept_staff_ids = [s.id for s in dept_staff]
-            dept_attendance = [a for a in current_attendance if a.staff_id in dept_staff_ids]
-            dept_on_time = sum(1 for a in dept_attendance if not a.is_late)
-            dept_punctuality = round((dept_on_time / len(dept_attendance)) * 100) if dept_attendance else 0
+        if staff_per_department.get(dept):
+            dept_cube = department_cube.get(dept)
+            dept_present = dept_cube.present if dept_cube else 0
+            dept_on_time = dept_present - (dept_cube.late if dept_cube else 0)
+            dept_punctuality = round((dept_on_time / dept_present) * 100) if dept_present else 0
             department_labels.append(dept)
             department_data.append(dept_punctuality)
     
+    branch_cube = {r.school_id: r for r in query_attendance_cube(
+        [AttendanceDailyStats.school_id], start_date, end_date, scope_school_ids, department_filter
+    )}
     branch_labels = []
     branch_attendance = []
     branch_punctuality = []
-    for school in schools[:10]:
-        school_staff = [s for s in all_staff if s.school_id == school.id]
-        if school_staff:
-            school_staff_ids = [s.id for s in school_staff]
-            school_att = [a for a in current_attendance if a.staff_id in school_staff_ids]
-            school_expected = len(school_staff) * working_days if school_staff else 1
-            school_rate = round((len(school_att) / school_expected) * 100, 1) if school_expected > 0 and len(school_att) > 0 else 0
-            school_on_time = sum(1 for a in school_att if not a.is_late)
-            school_punct = round((school_on_time / len(school_att)) * 100, 1) if school_att else 0
-            branch_labels.append(school.short_name or school.name[:15])
+    for branch_id, branch_label in branch_schools:
+        school_staff_count = staff_per_school.get(branch_id, 0)
+        if school_staff_count:
+            school_cube = branch_cube.get(branch_id)
+            school_present = school_cube.present if school_cube else 0
+            school_expected = school_staff_count * branch_working_days.get(branch_id, 0)
+            school_rate = round((school_present / school_expected) * 100, 1) if school_expected > 0 and school_present > 0 else 0
+            school_on_time = school_present - (school_cube.late if school_cube else 0)
+            school_punct = round((school_on_time / school_present) * 100, 1) if school_present else 0
+            branch_labels.append(branch_label)
             branch_attendance.append(min(school_rate, 100))
             branch_punctuality.append(school_punct)
     
-    top_performers = []
-    needs_attention = []
-    for s in all_staff:
-        if s.department == 'Management':
-            continue
-        staff_attendance = [a for a in current_attendance if a.staff_id == s.id]
-        if len(staff_attendance) >= 3:
-            on_time = sum(1 for a in staff_attendance if not a.is_late)
-            punctuality = round((on_time / len(staff_attendance)) * 100, 1)
-            top_performers.append({'name': s.name, 'branch': s.school.short_name or s.school.name if s.school else 'N/A', 'punctuality': punctuality})
-        late_cnt = sum(1 for a in staff_attendance if a.is_late)
-        if late_cnt > 0:
-            needs_attention.append({'name': s.name, 'branch': s.school.short_name or s.school.name if s.school else 'N/A', 'late_count': late_cnt})
-    
-    top_performers.sort(key=lambda x: x['punctuality'], reverse=True)
-    top_performers = top_performers[:5]
-    needs_attention.sort(key=lambda x: x['late_count'], reverse=True)
-    needs_attention = needs_attention[:5]
-    
     distribution_labels = ['On Time', 'Late']
     distribution_data = [on_time_count, late_count]
     
-    total_expected = total_staff * working_days
     total_absent = total_expected - total_records if total_expected > total_records else 0
     presence_labels = ['Present', 'Absent']
     presence_data = [total_records, total_absent]
     
-    this_week_start = today - timedelta(days=today.weekday())
-    last_week_start = this_week_start - timedelta(days=7)
-    last_week_end = this_week_start - timedelta(days=1)
-    
-    this_week_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= this_week_start,
-        Attendance.date <= today
-    ).all() if staff_ids else []
-    
-    last_week_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= last_week_start,
-        Attendance.date <= last_week_end
-    ).all() if staff_ids else []
-    
-    weekly_comparison_labels = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri']
+    weekday_labels = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+    week_mask = calendar.union_mask()
+    weekly_days = [i for i in range(7) if (week_mask >> i) & 1]
+    weekly_comparison_labels = [weekday_labels[i] for i in weekly_days]
     weekly_this_week = []
     weekly_last_week = []
     
-    for day_idx in range(5):
+    for day_idx in weekly_days:
         this_day = this_week_start + timedelta(days=day_idx)
-        this_day_att = len([a for a in this_week_attendance if a.date == this_day])
-        this_day_rate = round((this_day_att / total_staff) * 100, 1) if total_staff > 0 else 0
+        this_day_staff = staff_working_on(this_day, staff_per_school)
+        this_day_att = daily_cube[this_day].present if this_day in daily_cube and this_day <= today else 0
+        this_day_rate = round((this_day_att / this_day_staff) * 100, 1) if this_day_staff > 0 else 0
         weekly_this_week.append(min(this_day_rate, 100))
         
         last_day = last_week_start + timedelta(days=day_idx)
-        last_day_att = len([a for a in last_week_attendance if a.date == last_day])
-        last_day_rate = round((last_day_att / total_staff) * 100, 1) if total_staff > 0 else 0
+        last_day_staff = staff_working_on(last_day, staff_per_school)
+        last_day_att = daily_cube[last_day].present if last_day in daily_cube else 0
+        last_day_rate = round((last_day_att / last_day_staff) * 100, 1) if last_day_staff > 0 else 0
         weekly_last_week.append(min(last_day_rate, 100))
     
+    # Per-staff rankings: one pass over the staff list and their attendance
+    schedules = {}
+    top_performers = []
+    needs_attention = []
     early_arrivals = []
-    for s in all_staff:
-        if s.department == 'Management':
-            continue
-        staff_att = [a for a in current_attendance if a.staff_id == s.id and a.sign_in_time and not a.is_late]
-        if len(staff_att) >= 3:
-            early_mins_list = []
-            for a in staff_att:
-                if a.sign_in_time and s.school:
-                    start_time, end_time, grace_mins, is_shift = get_staff_schedule_for_date(s, a.date)
-                    if start_time:
-                        scheduled = datetime.strptime(start_time, '%H:%M').time()
-                        actual = a.sign_in_time.time()
-                        if actual < scheduled:
-                            delta = datetime.combine(a.date, scheduled) - datetime.combine(a.date, actual)
-                            early_mins_list.append(int(delta.total_seconds() / 60))
-            if early_mins_list:
-                avg_early = round(sum(early_mins_list) / len(early_mins_list), 0)
-                early_arrivals.append({'name': s.name, 'branch': s.school.short_name or s.school.name if s.school else 'N/A', 'avg_early_mins': int(avg_early)})
-    
-    early_arrivals.sort(key=lambda x: x['avg_early_mins'], reverse=True)
-    early_arrivals = early_arrivals[:5]
-    
     perfect_attendance = []
-    for s in all_staff:
-        if s.department == 'Management':
-            continue
-        staff_att = [a for a in current_attendance if a.staff_id == s.id]
-        staff_on_time = [a for a in staff_att if not a.is_late]
-        if len(staff_att) >= working_days and len(staff_on_time) == len(staff_att) and len(staff_att) > 0:
-            perfect_attendance.append({'name': s.name, 'branch': s.school.short_name or s.school.name if s.school else 'N/A', 'days': len(staff_att)})
-    
-    perfect_attendance.sort(key=lambda x: x['days'], reverse=True)
-    perfect_attendance = perfect_attendance[:5]
-    
     most_improved = []
-    for s in all_staff:
-        if s.department == 'Management':
-            continue
-        current_late = sum(1 for a in current_attendance if a.staff_id == s.id and a.is_late)
-        prev_late = sum(1 for a in previous_attendance if a.staff_id == s.id and a.is_late)
-        if prev_late > current_late and prev_late > 0:
-            reduction = prev_late - current_late
-            most_improved.append({'name': s.name, 'branch': s.school.short_name or s.school.name if s.school else 'N/A', 'reduction': reduction})
-    
-    most_improved.sort(key=lambda x: x['reduction'], reverse=True)
-    most_improved = most_improved[:5]
-    
     attendance_streaks = []
     for s in all_staff:
         if s.department == 'Management':
             continue
-        staff_att = sorted([a for a in current_attendance if a.staff_id == s.id], key=lambda x: x.date, reverse=True)
+        staff_attendance = attendance_by_staff.get(s.id, [])
+        staff_info = {
+            'name': s.name,
+            'staff_id': s.staff_id,
+            'branch': s.school.short_name or s.school.name if s.school else 'N/A',
+            'department': s.department or ''
+        }
+        total = len(staff_attendance)
+        late_cnt = sum(1 for a in staff_attendance if a.is_late)
+        on_time = total - late_cnt
+        
+        if total >= 1:
+            top_performers.append(dict(staff_info, punctuality=round((on_time / total) * 100, 1), on_time=on_time, total=total))
+        
+        if late_cnt > 0:
+            needs_attention.append(dict(staff_info, late_count=late_cnt, total=total))
+        
+        on_time_signed_in = [a for a in staff_attendance if a.sign_in_time and not a.is_late]
+        if on_time_signed_in and s.school:
+            if s.school_id not in schedules:
+                schedules[s.school_id] = compile_branch_schedule(s.school)
+            early_mins_list = []
+            for a in on_time_signed_in:
+                staff_schedule = get_compiled_schedule_for_date(schedules[s.school_id], s.id, a.date)
+                if staff_schedule and staff_schedule[0] is not None:
+                    scheduled_seconds = staff_schedule[0] * 60
+                    actual = a.sign_in_time
+                    actual_seconds = actual.hour * 3600 + actual.minute * 60 + actual.second + actual.microsecond / 1000000
+                    if actual_seconds < scheduled_seconds:
+                        early_mins_list.append(int((scheduled_seconds - actual_seconds) / 60))
+            if early_mins_list:
+                avg_early = round(sum(early_mins_list) / len(early_mins_list), 0)
+                early_arrivals.append(dict(staff_info, avg_early_mins=int(avg_early), early_count=len(early_mins_list), on_time_records=len(on_time_signed_in)))
+        
+        if total > 0 and on_time == total and total >= branch_working_days.get(s.school_id, 0):
+            perfect_attendance.append(dict(staff_info, days=total))
+        
+        prev_late = previous_late_by_staff.get(s.id, 0)
+        if prev_late > late_cnt and prev_late > 0:
+            most_improved.append(dict(staff_info, reduction=prev_late - late_cnt, current_late=late_cnt, prev_late=prev_late))
+        
         streak = 0
-        for a in staff_att:
+        for a in sorted(staff_attendance, key=lambda x: x.date, reverse=True):
             if not a.is_late:
                 streak += 1
             else:
                 break
         if streak >= 3:
-            attendance_streaks.append({'name': s.name, 'branch': s.school.short_name or s.school.name if s.school else 'N/A', 'streak': streak})
+            attendance_streaks.append(dict(staff_info, streak=streak))
     
+    top_performers.sort(key=lambda x: x['punctuality'], reverse=True)
+    needs_attention.sort(key=lambda x: x['late_count'], reverse=True)
+    early_arrivals.sort(key=lambda x: x['avg_early_mins'], reverse=True)
+    perfect_attendance.sort(key=lambda x: x['days'], reverse=True)
+    most_improved.sort(key=lambda x: x['reduction'], reverse=True)
     attendance_streaks.sort(key=lambda x: x['streak'], reverse=True)
-    attendance_streaks = attendance_streaks[:5]
     
-    return render_template('analytics.html',
-        schools=schools, organizations=organizations, departments=departments,
-        selected_school_id=school_id, selected_organization_id=organization_id, selected_department=department_filter,
-        period=period, start_date=start_date.strftime('%Y-%m-%d'), end_date=end_date.strftime('%Y-%m-%d'),
+    return dict(
         attendance_rate=attendance_rate, attendance_trend=attendance_trend,
         punctuality_rate=punctuality_rate, punctuality_trend=punctuality_trend,
         total_staff=total_staff, branch_count=branch_count, total_records=total_records,
@@ -3303,156 +5687,448 @@ def analytics():
     )
 
 
+@app.route('/reports/analytics')
+@login_required
+@conditional_on_branch_data
+def analytics():
+    context = compute_analytics(
+        period=request.args.get('period', '30'),
+        school_id=request.args.get('school_id', ''),
+        organization_id=request.args.get('organization_id', ''),
+        department_filter=request.args.get('department', ''),
+        start_date_param=request.args.get('start_date', ''),
+        end_date_param=request.args.get('end_date', '')
+    )
+    return render_template('analytics.html', **trim_analytics_rankings(context))
+
+
+def trim_analytics_rankings(context):
+    """Top five of each ranking; top performers and early arrivals need at least three records"""
+    context['top_performers'] = [x for x in context['top_performers'] if x['total'] >= 3][:5]
+    context['needs_attention'] = context['needs_attention'][:5]
+    context['early_arrivals'] = [x for x in context['early_arrivals'] if x['on_time_records'] >= 3][:5]
+    context['perfect_attendance'] = context['perfect_attendance'][:5]
+    context['most_improved'] = context['most_improved'][:5]
+    context['attendance_streaks'] = context['attendance_streaks'][:5]
+    return context
+
+
+def render_pdf_file(html, path):
+    """Write html as a PDF to path, returns (pages, render_ms); runs in an export worker process"""
+    started = time.perf_counter()
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        result = pisa.CreatePDF(io.StringIO(html), dest=f)
+    if result.err:
+        os.remove(tmp_path)
+        raise ValueError('PDF rendering failed')
+    pages = len(PdfReader(tmp_path).pages)
+    os.replace(tmp_path, path)
+    return pages, int((time.perf_counter() - started) * 1000)
+
+
+def get_pdf_cache_dir():
+    path = os.path.join(EXPORT_DIR, 'pdf_cache')
+    os.makedirs(path, exist_ok=True)
+    return path
+
 
 @app.route('/reports/analytics/pdf')
 @login_required
+@conditional_on_branch_data
 def analytics_pdf():
-    today = date.today()
+    """
+    Analytics report PDF, cached by scope, period and data version. A cache miss is rendered by
+    an export job, so xhtml2pdf never runs in a web worker.
+    """
     period = request.args.get('period', '30')
+    school_id = request.args.get('school_id', '')
+    organization_id = request.args.get('organization_id', '')
+    department_filter = request.args.get('department', '')
+    start_date_param = request.args.get('start_date', '')
+    end_date_param = request.args.get('end_date', '')
+    
+    today = date.today()
+    start_date, end_date, period_days = resolve_analytics_period(period, start_date_param, end_date_param, today)
+    scope_school_ids = resolve_analytics_scope(school_id, organization_id)
+    data_version = branch_data_version(scope_school_ids if scope_school_ids is not None else get_reference_data().schools, fresh=True)
+    cache_key = hashlib.sha256(json.dumps([
+        sorted(scope_school_ids) if scope_school_ids is not None else 'all',
+        school_id, department_filter, start_date.isoformat(), end_date.isoformat(), today.isoformat(), data_version
+    ]).encode('utf-8')).hexdigest()
+    pdf_path = os.path.join(get_pdf_cache_dir(), f'{cache_key}.pdf')
+    meta_path = os.path.join(get_pdf_cache_dir(), f'{cache_key}.json')
+    
     try:
-        period_days = int(period)
+        if os.path.exists(pdf_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            meta['cached'] = True
+        elif not g.get('export_job_id'):
+            params = {key: value for key, value in request.args.items() if value}
+            submit_export_job(current_user, 'analytics-pdf', params)
+            flash('The PDF is being generated in the background. Download it again in a moment.', 'info')
+            return redirect(url_for('analytics', **params))
+        else:
+            context = trim_analytics_rankings(compute_analytics(
+                period, school_id, organization_id, department_filter, start_date_param, end_date_param
+            ))
+            selected_branch = ''
+            if school_id:
+                school = School.query.get(school_id)
+                selected_branch = (school.short_name or school.name) if school else ''
+            html = render_template('analytics_pdf.html',
+                generated_date=datetime.now().strftime('%d %B %Y, %H:%M'),
+                selected_branch=selected_branch,
+                current_year=today.year,
+                **context
+            )
+            pages, render_ms = render_pdf_file(html, pdf_path)
+            meta = {'pages': pages, 'render_ms': render_ms}
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+            meta['cached'] = False
+    except Exception as e:
+        flash(f'Error generating PDF: {str(e)}', 'error')
+        return redirect(url_for('analytics'))
+    
+    meta['data_version'] = data_version[:16]
+    response = send_file(pdf_path, mimetype='application/pdf', as_attachment=True, download_name=f'analytics_{start_date}_to_{end_date}.pdf')
+    response.headers['X-Export-Meta'] = json.dumps(meta)
+    return response
+
+
+def extract_sign_ins(schools, start_date, end_date):
+    """
+    Columnar extract of sign-ins for the simulator, read once per simulation.
+    Returns (staff_ids, sign_in_seconds, base_starts, on_shift, unscheduled_count): per row the
+    sign-in as seconds after midnight, the scheduled start in minutes (None if the day has no
+    start) and whether that start comes from an active shift. Rows on non-work days count as
+    on time and are only tallied.
+    """
+    staff_ids = []
+    sign_in_seconds = []
+    base_starts = []
+    on_shift = []
+    unscheduled_count = 0
+    source = attendance_source(start_date)
+    for school in schools:
+        schedule = compile_branch_schedule(school)
+        rows = db.session.query(
+            source.staff_id,
+            source.date,
+            source.sign_in_time
+        ).join(
+            Staff, source.staff_id == Staff.id
+        ).filter(
+            Staff.school_id == school.id,
+            Staff.department != 'Management',
+            source.date >= start_date,
+            source.date <= end_date,
+            source.sign_in_time.isnot(None)
+        ).all()
+        for staff_id, record_date, sign_in_time in rows:
+            day_schedule = get_compiled_schedule_for_date(schedule, staff_id, record_date)
+            if day_schedule is None:
+                unscheduled_count += 1
+                continue
+            staff_ids.append(staff_id)
+            sign_in_seconds.append(sign_in_time.hour * 3600 + sign_in_time.minute * 60 + sign_in_time.second)
+            base_starts.append(day_schedule[0])
+            on_shift.append(day_schedule[3])
+    return staff_ids, sign_in_seconds, base_starts, on_shift, unscheduled_count
+
+
+def sign_in_offsets(extract, start_time_override=None):
+    """
+    Returns (staff_ids, offsets, unscheduled_count) from an extract_sign_ins result, where
+    offsets[i] is the number of seconds staff_ids[i] signed in after their scheduled start.
+    start_time_override ('HH:MM') replaces the regular branch start time; staff on an
+    active shift keep their shift start. Rows left without a start count as unscheduled.
+    """
+    all_staff_ids, sign_in_seconds, base_starts, on_shift, unscheduled_count = extract
+    override_minutes = parse_time_to_minutes(start_time_override) if start_time_override else None
+    staff_ids = []
+    offsets = []
+    for staff_id, seconds, start, is_shift in zip(all_staff_ids, sign_in_seconds, base_starts, on_shift):
+        if override_minutes is not None and not is_shift:
+            start = override_minutes
+        if start is None:
+            unscheduled_count += 1
+            continue
+        staff_ids.append(staff_id)
+        offsets.append(seconds - start * 60)
+    return staff_ids, offsets, unscheduled_count
+
+
+@app.route('/api/analytics/grace-simulation')
+@login_required
+def api_grace_simulation():
+    """
+    What-if simulation of late counts for candidate grace periods and start times.
+    Works entirely in memory from a sign-in extract; nothing is written.
+    """
+    started = time.time()
+    school_id = request.args.get('school_id', type=int)
+    organization_id = request.args.get('organization_id', type=int)
+    today = date.today()
+    try:
+        start_date = datetime.strptime(request.args.get('start_date', ''), '%Y-%m-%d').date()
     except:
-        period_days = 30
-    start_date = today - timedelta(days=period_days)
-    end_date = today
-    html = f"""
-    <html>
-    <head><style>body {{ font-family: Arial; }} h1 {{ color: #333; }}</style></head>
-    <body>
-        <h1>Analytics Report</h1>
-        <p>Period: {start_date} to {end_date}</p>
-        <p>Generated: {today}</p>
-    </body>
-    </html>
+        start_date = today - timedelta(days=30)
+    try:
+        end_date = datetime.strptime(request.args.get('end_date', ''), '%Y-%m-%d').date()
+    except:
+        end_date = today
+    
+    try:
+        grace_periods = sorted(set(int(g) for g in request.args.get('grace_periods', '0,5,10,15').split(',') if g.strip()))
+    except ValueError:
+        return jsonify({'error': 'grace_periods must be a comma separated list of minutes'}), 400
+    if any(g < 0 for g in grace_periods):
+        return jsonify({'error': 'grace_periods must not be negative'}), 400
+    
+    start_times = [t.strip() for t in request.args.get('start_times', '').split(',') if t.strip()]
+    for t in start_times:
+        if parse_time_to_minutes(t) is None:
+            return jsonify({'error': f'Invalid start time: {t}'}), 400
+    top_n = min(request.args.get('top', 10, type=int) or 10, 100)
+    
+    # Resolve scope
+    if current_user.role == 'super_admin':
+        scope_query = School.query
+    else:
+        accessible_school_ids = current_user.get_accessible_school_ids()
+        if not accessible_school_ids:
+            return jsonify({'error': 'Access denied'}), 403
+        scope_query = School.query.filter(School.id.in_(accessible_school_ids))
+    if school_id:
+        schools = scope_query.filter(School.id == school_id).all()
+    elif organization_id:
+        schools = scope_query.filter(School.organization_id == organization_id).all()
+    else:
+        schools = scope_query.all()
+    if not schools:
+        return jsonify({'error': 'No accessible branches in scope'}), 404
+    
+    def summarize(sorted_offsets, offsets_by_staff, unscheduled_count, grace, start_time):
+        # Offsets are pre-sorted so each grace period is a bisect, not a rescan
+        threshold = grace * 60
+        late_count = len(sorted_offsets) - bisect.bisect_right(sorted_offsets, threshold)
+        total = len(sorted_offsets) + unscheduled_count
+        per_staff_late = []
+        for sid, staff_offsets in offsets_by_staff.items():
+            staff_late = len(staff_offsets) - bisect.bisect_right(staff_offsets, threshold)
+            if staff_late > 0:
+                per_staff_late.append((staff_late, sid))
+        per_staff_late.sort(key=lambda x: (-x[0], x[1]))
+        return {
+            'grace_period_minutes': grace,
+            'start_time': start_time,
+            'total_records': total,
+            'late_count': late_count,
+            'on_time_count': total - late_count,
+            'punctuality_rate': round(((total - late_count) / total) * 100, 1) if total > 0 else 0,
+            'late_staff_count': len(per_staff_late),
+            'top_offenders': per_staff_late[:top_n]
+        }
+    
+    # One read of the sign-ins; each candidate start time only shifts the offsets in memory
+    extract = extract_sign_ins(schools, start_date, end_date)
+    scenarios = []
+    for start_time in (start_times or [None]):
+        staff_ids, offsets, unscheduled_count = sign_in_offsets(extract, start_time)
+        sorted_offsets = sorted(offsets)
+        offsets_by_staff = {}
+        for sid, offset in zip(staff_ids, offsets):
+            offsets_by_staff.setdefault(sid, []).append(offset)
+        for staff_offsets in offsets_by_staff.values():
+            staff_offsets.sort()
+        for grace in grace_periods:
+            scenarios.append(summarize(sorted_offsets, offsets_by_staff, unscheduled_count, grace, start_time))
+    
+    # Resolve names only for staff that appear in a top offenders list
+    offender_ids = set(sid for sc in scenarios for _, sid in sc['top_offenders'])
+    offender_info = {}
+    if offender_ids:
+        for r in db.session.query(Staff.id, Staff.staff_id, Staff.name, Staff.department, School.short_name, School.name.label('school_name')).join(
+            School, Staff.school_id == School.id
+        ).filter(Staff.id.in_(offender_ids)).all():
+            offender_info[r.id] = {
+                'staff_id': r.staff_id,
+                'name': r.name,
+                'department': r.department,
+                'branch': r.short_name or r.school_name
+            }
+    for sc in scenarios:
+        sc['top_offenders'] = [dict(offender_info.get(sid, {}), late_count=cnt) for cnt, sid in sc['top_offenders']]
+    
+    return jsonify({
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'branches': [{'id': sc.id, 'name': sc.name, 'grace_period_minutes': sc.grace_period_minutes or 0} for sc in schools],
+        'scenarios': scenarios,
+        'elapsed_ms': int((time.time() - started) * 1000)
+    })
+
+
+# ==================== SPREADSHEET EXPORT ====================
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class XlsxSheet:
+    """One worksheet of an export: rows may be any iterable, typically a generator"""
+    
+    def __init__(self, title, headers, rows, header_color='#4CAF50', column_widths=None):
+        self.title = title
+        self.headers = headers
+        self.rows = rows
+        self.header_color = header_color
+        self.column_widths = column_widths or []
+
+
+def write_xlsx(fileobj, sheets):
     """
-    pdf_output = io.BytesIO()
-    pisa.CreatePDF(io.StringIO(html), dest=pdf_output)
-    pdf_output.seek(0)
-    return Response(pdf_output.getvalue(), mimetype='application/pdf',
-        headers={'Content-Disposition': f'attachment; filename=analytics_{today}.pdf'})
+    Write sheets to fileobj with xlsxwriter's constant_memory mode: each row is
+    flushed to a temp file as soon as the next one starts, so memory stays flat
+    regardless of row count. Rows must therefore be produced in order.
+    """
+    workbook = xlsxwriter.Workbook(fileobj, {'constant_memory': True, 'tmpdir': tempfile.gettempdir()})
+    for sheet in sheets:
+        worksheet = workbook.add_worksheet(sheet.title[:31])
+        for first_col, last_col, width in sheet.column_widths:
+            worksheet.set_column(first_col, last_col, width)
+        header_format = workbook.add_format({'bold': True, 'bg_color': sheet.header_color, 'font_color': 'white'})
+        worksheet.write_row(0, 0, sheet.headers, header_format)
+        for row_idx, row in enumerate(sheet.rows, 1):
+            worksheet.write_row(row_idx, 0, row)
+    workbook.close()
+
+
+def send_xlsx(filename, sheets):
+    """Build a workbook in an anonymous temp file and stream it; the file is removed when the response closes"""
+    output = tempfile.TemporaryFile()
+    try:
+        write_xlsx(output, sheets)
+        output.seek(0)
+    except Exception:
+        output.close()
+        raise
+    return send_file(output, download_name=filename, as_attachment=True, mimetype=XLSX_MIMETYPE)
+
+
+ANALYTICS_RANKING_SHEETS = {
+    'top_performers': ('Top Performers', ['Punctuality %', 'On Time', 'Total Records'], ['punctuality', 'on_time', 'total'], '#4CAF50', [(5, 7, 12)]),
+    'needs_attention': ('Needs Attention', ['Times Late', 'Total Records'], ['late_count', 'total'], '#f44336', [(5, 6, 12)]),
+    'early_arrivals': ('Early Arrivals', ['Avg Early (mins)', 'Times Early'], ['avg_early_mins', 'early_count'], '#2196F3', [(5, 6, 15)]),
+    'perfect_attendance': ('Perfect Attendance', ['Days Present'], ['days'], '#9C27B0', [(5, 5, 12)]),
+    'most_improved': ('Most Improved', ['Reduction', 'Current Late', 'Previous Late'], ['reduction', 'current_late', 'prev_late'], '#FF9800', [(5, 7, 12)]),
+    'attendance_streaks': ('On-Time Streaks', ['Current Streak (days)'], ['streak'], '#00BCD4', [(5, 5, 18)]),
+}
+
+
+def analytics_ranking_sheet(ranking, items):
+    """Worksheet for one analytics ranking list (rank, staff columns, then the ranking's metrics)"""
+    title, metric_headers, metric_fields, header_color, metric_widths = ANALYTICS_RANKING_SHEETS[ranking]
+    return XlsxSheet(
+        title=title,
+        headers=['Rank', 'Staff ID', 'Name', 'Branch', 'Department'] + metric_headers,
+        rows=([idx, item['staff_id'] or '', item['name'], item['branch'], item['department']] + [item[f] for f in metric_fields] for idx, item in enumerate(items, 1)),
+        header_color=header_color,
+        column_widths=[(0, 0, 8), (1, 1, 15), (2, 2, 25), (3, 3, 20), (4, 4, 15)] + metric_widths
+    )
 
 
 # ============== ANALYTICS DOWNLOAD ROUTES=================
 
+ANALYTICS_DOWNLOAD_PERIODS = ('today', '7', '14', '30', 'this_week', 'last_week', 'this_month', 'last_month')
+ANALYTICS_DOWNLOAD_BATCH_SIZE = int(os.environ.get('ANALYTICS_DOWNLOAD_BATCH_SIZE', 1000))
+
+
+def analytics_download_filters():
+    """
+    Read the ranking download query string. Returns (start_date, end_date, period_days, staff
+    filters); the filters keep active, non-Management staff in the selected scope and department.
+    """
+    period = request.args.get('period', 'today')
+    if period not in ANALYTICS_DOWNLOAD_PERIODS:
+        period = '30'
+    start_date, end_date, period_days = resolve_analytics_period(period, '', '', date.today())
+    
+    staff_filters = [
+        Staff.is_active == True,
+        db.or_(Staff.department.is_(None), Staff.department != 'Management')
+    ]
+    scope_school_ids = resolve_analytics_scope(request.args.get('school_id', ''), request.args.get('organization_id', ''))
+    if scope_school_ids is not None:
+        staff_filters.append(Staff.school_id.in_(scope_school_ids))
+    department_filter = request.args.get('department', '')
+    if department_filter:
+        staff_filters.append(Staff.department == department_filter)
+    return start_date, end_date, period_days, staff_filters
+
+
+def analytics_ranking_staff(*filters):
+    """Staff columns a ranking sheet shows, for the staff matching filters"""
+    return db.session.query(
+        Staff.id,
+        Staff.name,
+        Staff.staff_id,
+        Staff.department,
+        Staff.school_id,
+        School.short_name.label('branch_short_name'),
+        School.name.label('branch_name')
+    ).outerjoin(
+        School, Staff.school_id == School.id
+    ).filter(*filters)
+
+
+def analytics_ranking_rows(source, start_date, end_date, staff_filters, *metrics):
+    """Per-staff aggregates of source over [start_date, end_date], one grouped query with the staff columns"""
+    return analytics_ranking_staff(*staff_filters).add_columns(*metrics).join(
+        source, source.staff_id == Staff.id
+    ).filter(
+        source.date >= start_date,
+        source.date <= end_date
+    ).group_by(Staff.id, School.id)
+
+
+def analytics_ranking_item(row, **metrics):
+    item = {
+        'name': row.name,
+        'staff_id': row.staff_id,
+        'branch': (row.branch_short_name or row.branch_name) if row.branch_name is not None else 'N/A',
+        'department': row.department or ''
+    }
+    item.update(metrics)
+    return item
+
+
+def late_count_column(source, *conditions):
+    return db.func.sum(db.case((db.and_(source.is_late == True, *conditions), 1), else_=0))
+
+
 @app.route('/analytics/top-performers/download')
 @login_required
 def analytics_download_top_performers():
     """Download Top Performers as Excel"""
     try:
-        period = request.args.get('period', 'today')
-        school_id = request.args.get('school_id', '')
-        organization_id = request.args.get('organization_id', '')
-        department_filter = request.args.get('department', '')
-        
-        today = date.today()
-        if period == 'today':
-            start_date = today
-            end_date = today
-        elif period == '7':
-            start_date = today - timedelta(days=7)
-            end_date = today
-        elif period == '14':
-            start_date = today - timedelta(days=14)
-            end_date = today
-        elif period == '30':
-            start_date = today - timedelta(days=30)
-            end_date = today
-        elif period == 'this_week':
-            start_date = today - timedelta(days=today.weekday())
-            end_date = today
-        elif period == 'last_week':
-            start_date = today - timedelta(days=today.weekday() + 7)
-            end_date = start_date + timedelta(days=6)
-        elif period == 'this_month':
-            start_date = today.replace(day=1)
-            end_date = today
-        elif period == 'last_month':
-            first_of_this_month = today.replace(day=1)
-            end_date = first_of_this_month - timedelta(days=1)
-            start_date = end_date.replace(day=1)
-        else:
-            start_date = today - timedelta(days=30)
-            end_date = today
-        
-        # Build staff query - match main analytics route logic
-        accessible_school_ids = current_user.get_accessible_school_ids()
-        staff_query = Staff.query.filter_by(is_active=True)
-        
-        if organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=int(organization_id)).all()]
-            staff_query = staff_query.filter(Staff.school_id.in_(org_school_ids))
-        elif school_id:
-            staff_query = staff_query.filter_by(school_id=int(school_id))
-        elif current_user.role != 'super_admin' and accessible_school_ids:
-            staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
-        
-        if department_filter:
-            staff_query = staff_query.filter_by(department=department_filter)
-        
-        all_staff = staff_query.all()
-        staff_ids = [s.id for s in all_staff]
-        
-        # Get attendance for period
-        current_attendance = Attendance.query.filter(
-            Attendance.staff_id.in_(staff_ids),
-            Attendance.date >= start_date,
-            Attendance.date <= end_date
-        ).all() if staff_ids else []
-        
-        # Calculate top performers - same logic as main analytics route
-        performers = []
-        for s in all_staff:
-            if s.department == 'Management':
-                continue
-            staff_attendance = [a for a in current_attendance if a.staff_id == s.id]
-            if len(staff_attendance) >= 1:
-                on_time = sum(1 for a in staff_attendance if not a.is_late)
-                punctuality = round((on_time / len(staff_attendance)) * 100, 1)
-                performers.append({
-                    'name': s.name,
-                    'staff_id': s.staff_id,
-                    'branch': s.school.short_name or s.school.name if s.school else 'N/A',
-                    'department': s.department or '',
-                    'punctuality': punctuality,
-                    'on_time': on_time,
-                    'total': len(staff_attendance)
-                })
-        
-        performers.sort(key=lambda x: x['punctuality'], reverse=True)
-        
-        # Create Excel
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        worksheet = workbook.add_worksheet('Top Performers')
-        
-        headers = ['Rank', 'Staff ID', 'Name', 'Branch', 'Department', 'Punctuality %', 'On Time', 'Total Records']
-        header_format = workbook.add_format({'bold': True, 'bg_color': '#4CAF50', 'font_color': 'white'})
-        
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-        
-        for idx, p in enumerate(performers, 1):
-            worksheet.write(idx, 0, idx)
-            worksheet.write(idx, 1, p['staff_id'] or '')
-            worksheet.write(idx, 2, p['name'])
-            worksheet.write(idx, 3, p['branch'])
-            worksheet.write(idx, 4, p['department'])
-            worksheet.write(idx, 5, p['punctuality'])
-            worksheet.write(idx, 6, p['on_time'])
-            worksheet.write(idx, 7, p['total'])
-        
-        worksheet.set_column(0, 0, 8)
-        worksheet.set_column(1, 1, 15)
-        worksheet.set_column(2, 2, 25)
-        worksheet.set_column(3, 3, 20)
-        worksheet.set_column(4, 4, 15)
-        worksheet.set_column(5, 7, 12)
-        
-        workbook.close()
-        output.seek(0)
+        start_date, end_date, period_days, staff_filters = analytics_download_filters()
+        source = attendance_source(start_date)
+        total = db.func.count()
+        on_time = total - late_count_column(source)
+        
+        rows = analytics_ranking_rows(
+            source, start_date, end_date, staff_filters,
+            total.label('total'), on_time.label('on_time')
+        ).order_by((on_time * 1.0 / total).desc(), Staff.id).yield_per(ANALYTICS_DOWNLOAD_BATCH_SIZE)
+        performers = (
+            analytics_ranking_item(r, punctuality=round((r.on_time / r.total) * 100, 1), on_time=r.on_time, total=r.total)
+            for r in rows
+        )
         
-        filename = f"top_performers_{start_date}_to_{end_date}.xlsx"
-        return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return send_xlsx(f"top_performers_{start_date}_to_{end_date}.xlsx", [analytics_ranking_sheet('top_performers', performers)])
         
     except Exception as e:
         flash(f'Error generating report: {str(e)}', 'error')
@@ -3464,113 +6140,17 @@ def analytics_download_top_performers():
 def analytics_download_needs_attention():
     """Download Needs Attention as Excel"""
     try:
-        period = request.args.get('period', 'today')
-        school_id = request.args.get('school_id', '')
-        organization_id = request.args.get('organization_id', '')
-        department_filter = request.args.get('department', '')
-        
-        today = date.today()
-        if period == 'today':
-            start_date = today
-            end_date = today
-        elif period == '7':
-            start_date = today - timedelta(days=7)
-            end_date = today
-        elif period == '14':
-            start_date = today - timedelta(days=14)
-            end_date = today
-        elif period == '30':
-            start_date = today - timedelta(days=30)
-            end_date = today
-        elif period == 'this_week':
-            start_date = today - timedelta(days=today.weekday())
-            end_date = today
-        elif period == 'last_week':
-            start_date = today - timedelta(days=today.weekday() + 7)
-            end_date = start_date + timedelta(days=6)
-        elif period == 'this_month':
-            start_date = today.replace(day=1)
-            end_date = today
-        elif period == 'last_month':
-            first_of_this_month = today.replace(day=1)
-            end_date = first_of_this_month - timedelta(days=1)
-            start_date = end_date.replace(day=1)
-        else:
-            start_date = today - timedelta(days=30)
-            end_date = today
-        
-        accessible_school_ids = current_user.get_accessible_school_ids()
-        staff_query = Staff.query.filter_by(is_active=True)
+        start_date, end_date, period_days, staff_filters = analytics_download_filters()
+        source = attendance_source(start_date)
+        late_cnt = late_count_column(source)
         
-        if organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=int(organization_id)).all()]
-            staff_query = staff_query.filter(Staff.school_id.in_(org_school_ids))
-        elif school_id:
-            staff_query = staff_query.filter_by(school_id=int(school_id))
-        elif current_user.role != 'super_admin' and accessible_school_ids:
-            staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
+        rows = analytics_ranking_rows(
+            source, start_date, end_date, staff_filters,
+            late_cnt.label('late_count'), db.func.count().label('total')
+        ).having(late_cnt > 0).order_by(late_cnt.desc(), Staff.id).yield_per(ANALYTICS_DOWNLOAD_BATCH_SIZE)
+        attention_list = (analytics_ranking_item(r, late_count=r.late_count, total=r.total) for r in rows)
         
-        if department_filter:
-            staff_query = staff_query.filter_by(department=department_filter)
-        
-        all_staff = staff_query.all()
-        staff_ids = [s.id for s in all_staff]
-        
-        current_attendance = Attendance.query.filter(
-            Attendance.staff_id.in_(staff_ids),
-            Attendance.date >= start_date,
-            Attendance.date <= end_date
-        ).all() if staff_ids else []
-        
-        attention_list = []
-        for s in all_staff:
-            if s.department == 'Management':
-                continue
-            staff_attendance = [a for a in current_attendance if a.staff_id == s.id]
-            late_cnt = sum(1 for a in staff_attendance if a.is_late)
-            if late_cnt > 0:
-                attention_list.append({
-                    'name': s.name,
-                    'staff_id': s.staff_id,
-                    'branch': s.school.short_name or s.school.name if s.school else 'N/A',
-                    'department': s.department or '',
-                    'late_count': late_cnt,
-                    'total': len(staff_attendance)
-                })
-        
-        attention_list.sort(key=lambda x: x['late_count'], reverse=True)
-        
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        worksheet = workbook.add_worksheet('Needs Attention')
-        
-        headers = ['Rank', 'Staff ID', 'Name', 'Branch', 'Department', 'Times Late', 'Total Records']
-        header_format = workbook.add_format({'bold': True, 'bg_color': '#f44336', 'font_color': 'white'})
-        
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-        
-        for idx, item in enumerate(attention_list, 1):
-            worksheet.write(idx, 0, idx)
-            worksheet.write(idx, 1, item['staff_id'] or '')
-            worksheet.write(idx, 2, item['name'])
-            worksheet.write(idx, 3, item['branch'])
-            worksheet.write(idx, 4, item['department'])
-            worksheet.write(idx, 5, item['late_count'])
-            worksheet.write(idx, 6, item['total'])
-        
-        worksheet.set_column(0, 0, 8)
-        worksheet.set_column(1, 1, 15)
-        worksheet.set_column(2, 2, 25)
-        worksheet.set_column(3, 3, 20)
-        worksheet.set_column(4, 4, 15)
-        worksheet.set_column(5, 6, 12)
-        
-        workbook.close()
-        output.seek(0)
-        
-        filename = f"needs_attention_{start_date}_to_{end_date}.xlsx"
-        return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return send_xlsx(f"needs_attention_{start_date}_to_{end_date}.xlsx", [analytics_ranking_sheet('needs_attention', attention_list)])
         
     except Exception as e:
         flash(f'Error generating report: {str(e)}', 'error')
@@ -3582,387 +6162,107 @@ def analytics_download_needs_attention():
 def analytics_download_early_arrivals():
     """Download Early Arrivals as Excel"""
     try:
-        period = request.args.get('period', 'today')
-        school_id = request.args.get('school_id', '')
-        organization_id = request.args.get('organization_id', '')
-        department_filter = request.args.get('department', '')
-        
-        today = date.today()
-        if period == 'today':
-            start_date = today
-            end_date = today
-        elif period == '7':
-            start_date = today - timedelta(days=7)
-            end_date = today
-        elif period == '14':
-            start_date = today - timedelta(days=14)
-            end_date = today
-        elif period == '30':
-            start_date = today - timedelta(days=30)
-            end_date = today
-        elif period == 'this_week':
-            start_date = today - timedelta(days=today.weekday())
-            end_date = today
-        elif period == 'last_week':
-            start_date = today - timedelta(days=today.weekday() + 7)
-            end_date = start_date + timedelta(days=6)
-        elif period == 'this_month':
-            start_date = today.replace(day=1)
-            end_date = today
-        elif period == 'last_month':
-            first_of_this_month = today.replace(day=1)
-            end_date = first_of_this_month - timedelta(days=1)
-            start_date = end_date.replace(day=1)
-        else:
-            start_date = today - timedelta(days=30)
-            end_date = today
-        
-        accessible_school_ids = current_user.get_accessible_school_ids()
-        staff_query = Staff.query.filter_by(is_active=True)
-        
-        if organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=int(organization_id)).all()]
-            staff_query = staff_query.filter(Staff.school_id.in_(org_school_ids))
-        elif school_id:
-            staff_query = staff_query.filter_by(school_id=int(school_id))
-        elif current_user.role != 'super_admin' and accessible_school_ids:
-            staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
-        
-        if department_filter:
-            staff_query = staff_query.filter_by(department=department_filter)
-        
-        all_staff = staff_query.all()
-        staff_ids = [s.id for s in all_staff]
-        
-        current_attendance = Attendance.query.filter(
-            Attendance.staff_id.in_(staff_ids),
-            Attendance.date >= start_date,
-            Attendance.date <= end_date
-        ).all() if staff_ids else []
+        start_date, end_date, period_days, staff_filters = analytics_download_filters()
+        source = attendance_source(start_date)
+        
+        # Early minutes depend on each day's branch or shift schedule, so on-time sign-ins are
+        # streamed and summed per staff against the compiled schedules instead of grouped in SQL
+        schools = School.query.filter(School.id.in_(db.session.query(Staff.school_id).filter(*staff_filters))).all()
+        schedules = {school.id: compile_branch_schedule(school) for school in schools}
+        sign_ins = db.session.query(
+            source.staff_id, Staff.school_id, source.date, source.sign_in_time
+        ).join(
+            Staff, source.staff_id == Staff.id
+        ).filter(
+            *staff_filters,
+            Staff.school_id.isnot(None),
+            source.date >= start_date,
+            source.date <= end_date,
+            source.sign_in_time.isnot(None),
+            db.or_(source.is_late == False, source.is_late.is_(None))
+        ).yield_per(ANALYTICS_DOWNLOAD_BATCH_SIZE)
+        
+        early_totals = {}
+        for staff_id, staff_school_id, record_date, sign_in_time in sign_ins:
+            schedule = get_compiled_schedule_for_date(schedules[staff_school_id], staff_id, record_date)
+            if schedule is None or schedule[0] is None:
+                continue
+            scheduled = datetime.combine(record_date, datetime.min.time()) + timedelta(minutes=schedule[0])
+            actual = datetime.combine(record_date, sign_in_time.time())
+            if actual < scheduled:
+                totals = early_totals.setdefault(staff_id, [0, 0])
+                totals[0] += int((scheduled - actual).total_seconds() / 60)
+                totals[1] += 1
         
         early_list = []
-        for s in all_staff:
-            if s.department == 'Management':
-                continue
-            staff_att = [a for a in current_attendance if a.staff_id == s.id and a.sign_in_time and not a.is_late]
-            if len(staff_att) >= 1:
-                early_mins_list = []
-                for a in staff_att:
-                    if a.sign_in_time and s.school:
-                        # get_staff_schedule_for_date returns tuple: (start_time, end_time, grace_mins, is_shift)
-                        start_time, end_time, grace_mins, is_shift = get_staff_schedule_for_date(s, a.date)
-                        if start_time:
-                            try:
-                                scheduled = datetime.strptime(start_time, '%H:%M').time()
-                                actual = a.sign_in_time.time()
-                                if actual < scheduled:
-                                    delta = datetime.combine(a.date, scheduled) - datetime.combine(a.date, actual)
-                                    early_mins_list.append(int(delta.total_seconds() / 60))
-                            except:
-                                pass
-                if early_mins_list:
-                    avg_early = round(sum(early_mins_list) / len(early_mins_list), 0)
-                    early_list.append({
-                        'name': s.name,
-                        'staff_id': s.staff_id,
-                        'branch': s.school.short_name or s.school.name if s.school else 'N/A',
-                        'department': s.department or '',
-                        'avg_early_mins': int(avg_early),
-                        'early_count': len(early_mins_list)
-                    })
+        if early_totals:
+            for r in analytics_ranking_staff(Staff.id.in_(list(early_totals))).order_by(Staff.id).all():
+                early_mins, early_count = early_totals[r.id]
+                early_list.append(analytics_ranking_item(r, avg_early_mins=int(round(early_mins / early_count, 0)), early_count=early_count))
         
         early_list.sort(key=lambda x: x['avg_early_mins'], reverse=True)
         
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        worksheet = workbook.add_worksheet('Early Arrivals')
-        
-        headers = ['Rank', 'Staff ID', 'Name', 'Branch', 'Department', 'Avg Early (mins)', 'Times Early']
-        header_format = workbook.add_format({'bold': True, 'bg_color': '#2196F3', 'font_color': 'white'})
-        
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-        
-        for idx, item in enumerate(early_list, 1):
-            worksheet.write(idx, 0, idx)
-            worksheet.write(idx, 1, item['staff_id'] or '')
-            worksheet.write(idx, 2, item['name'])
-            worksheet.write(idx, 3, item['branch'])
-            worksheet.write(idx, 4, item['department'])
-            worksheet.write(idx, 5, item['avg_early_mins'])
-            worksheet.write(idx, 6, item['early_count'])
-        
-        worksheet.set_column(0, 0, 8)
-        worksheet.set_column(1, 1, 15)
-        worksheet.set_column(2, 2, 25)
-        worksheet.set_column(3, 3, 20)
-        worksheet.set_column(4, 4, 15)
-        worksheet.set_column(5, 6, 15)
-        
-        workbook.close()
-        output.seek(0)
-        
-        filename = f"early_arrivals_{start_date}_to_{end_date}.xlsx"
-        return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return send_xlsx(f"early_arrivals_{start_date}_to_{end_date}.xlsx", [analytics_ranking_sheet('early_arrivals', early_list)])
         
     except Exception as e:
         flash(f'Error generating report: {str(e)}', 'error')
         return redirect(url_for('analytics'))
 
-
-@app.route('/analytics/perfect-attendance/download')
-@login_required
-def analytics_download_perfect_attendance():
-    """Download Perfect Attendance as Excel"""
-    try:
-        period = request.args.get('period', 'today')
-        school_id = request.args.get('school_id', '')
-        organization_id = request.args.get('organization_id', '')
-        department_filter = request.args.get('department', '')
-        
-        today = date.today()
-        if period == 'today':
-            start_date = today
-            end_date = today
-        elif period == '7':
-            start_date = today - timedelta(days=7)
-            end_date = today
-        elif period == '14':
-            start_date = today - timedelta(days=14)
-            end_date = today
-        elif period == '30':
-            start_date = today - timedelta(days=30)
-            end_date = today
-        elif period == 'this_week':
-            start_date = today - timedelta(days=today.weekday())
-            end_date = today
-        elif period == 'last_week':
-            start_date = today - timedelta(days=today.weekday() + 7)
-            end_date = start_date + timedelta(days=6)
-        elif period == 'this_month':
-            start_date = today.replace(day=1)
-            end_date = today
-        elif period == 'last_month':
-            first_of_this_month = today.replace(day=1)
-            end_date = first_of_this_month - timedelta(days=1)
-            start_date = end_date.replace(day=1)
-        else:
-            start_date = today - timedelta(days=30)
-            end_date = today
-        
-        # Calculate working days
-        period_days = (end_date - start_date).days + 1
-        working_days = sum(1 for i in range(period_days) if (start_date + timedelta(days=i)).weekday() < 5)
-        
-        accessible_school_ids = current_user.get_accessible_school_ids()
-        staff_query = Staff.query.filter_by(is_active=True)
-        
-        if organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=int(organization_id)).all()]
-            staff_query = staff_query.filter(Staff.school_id.in_(org_school_ids))
-        elif school_id:
-            staff_query = staff_query.filter_by(school_id=int(school_id))
-        elif current_user.role != 'super_admin' and accessible_school_ids:
-            staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
-        
-        if department_filter:
-            staff_query = staff_query.filter_by(department=department_filter)
-        
-        all_staff = staff_query.all()
-        staff_ids = [s.id for s in all_staff]
-        
-        current_attendance = Attendance.query.filter(
-            Attendance.staff_id.in_(staff_ids),
-            Attendance.date >= start_date,
-            Attendance.date <= end_date
-        ).all() if staff_ids else []
-        
-        perfect_list = []
-        for s in all_staff:
-            if s.department == 'Management':
-                continue
-            staff_att = [a for a in current_attendance if a.staff_id == s.id]
-            staff_on_time = [a for a in staff_att if not a.is_late]
-            # Perfect = attended all working days with no late
-            if len(staff_att) >= working_days and len(staff_on_time) == len(staff_att) and len(staff_att) > 0:
-                perfect_list.append({
-                    'name': s.name,
-                    'staff_id': s.staff_id,
-                    'branch': s.school.short_name or s.school.name if s.school else 'N/A',
-                    'department': s.department or '',
-                    'days': len(staff_att)
-                })
-        
-        perfect_list.sort(key=lambda x: x['days'], reverse=True)
-        
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        worksheet = workbook.add_worksheet('Perfect Attendance')
-        
-        headers = ['Rank', 'Staff ID', 'Name', 'Branch', 'Department', 'Days Present']
-        header_format = workbook.add_format({'bold': True, 'bg_color': '#9C27B0', 'font_color': 'white'})
-        
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-        
-        for idx, item in enumerate(perfect_list, 1):
-            worksheet.write(idx, 0, idx)
-            worksheet.write(idx, 1, item['staff_id'] or '')
-            worksheet.write(idx, 2, item['name'])
-            worksheet.write(idx, 3, item['branch'])
-            worksheet.write(idx, 4, item['department'])
-            worksheet.write(idx, 5, item['days'])
-        
-        worksheet.set_column(0, 0, 8)
-        worksheet.set_column(1, 1, 15)
-        worksheet.set_column(2, 2, 25)
-        worksheet.set_column(3, 3, 20)
-        worksheet.set_column(4, 4, 15)
-        worksheet.set_column(5, 5, 12)
-        
-        workbook.close()
-        output.seek(0)
-        
-        filename = f"perfect_attendance_{start_date}_to_{end_date}.xlsx"
-        return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        
-    except Exception as e:
-        flash(f'Error generating report: {str(e)}', 'error')
-        return redirect(url_for('analytics'))
-
-
-@app.route('/analytics/most-improved/download')
-@login_required
-def analytics_download_most_improved():
-    """Download Most Improved as Excel"""
-    try:
-        period = request.args.get('period', 'today')
-        school_id = request.args.get('school_id', '')
-        organization_id = request.args.get('organization_id', '')
-        department_filter = request.args.get('department', '')
-        
-        today = date.today()
-        if period == 'today':
-            start_date = today
-            end_date = today
-            period_days = 1
-        elif period == '7':
-            start_date = today - timedelta(days=7)
-            end_date = today
-            period_days = 7
-        elif period == '14':
-            start_date = today - timedelta(days=14)
-            end_date = today
-            period_days = 14
-        elif period == '30':
-            start_date = today - timedelta(days=30)
-            end_date = today
-            period_days = 30
-        elif period == 'this_week':
-            start_date = today - timedelta(days=today.weekday())
-            end_date = today
-            period_days = (end_date - start_date).days + 1
-        elif period == 'last_week':
-            start_date = today - timedelta(days=today.weekday() + 7)
-            end_date = start_date + timedelta(days=6)
-            period_days = 7
-        elif period == 'this_month':
-            start_date = today.replace(day=1)
-            end_date = today
-            period_days = (end_date - start_date).days + 1
-        elif period == 'last_month':
-            first_of_this_month = today.replace(day=1)
-            end_date = first_of_this_month - timedelta(days=1)
-            start_date = end_date.replace(day=1)
-            period_days = (end_date - start_date).days + 1
-        else:
-            start_date = today - timedelta(days=30)
-            end_date = today
-            period_days = 30
-        
-        previous_start = start_date - timedelta(days=period_days)
-        
-        accessible_school_ids = current_user.get_accessible_school_ids()
-        staff_query = Staff.query.filter_by(is_active=True)
-        
-        if organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=int(organization_id)).all()]
-            staff_query = staff_query.filter(Staff.school_id.in_(org_school_ids))
-        elif school_id:
-            staff_query = staff_query.filter_by(school_id=int(school_id))
-        elif current_user.role != 'super_admin' and accessible_school_ids:
-            staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
-        
-        if department_filter:
-            staff_query = staff_query.filter_by(department=department_filter)
-        
-        all_staff = staff_query.all()
-        staff_ids = [s.id for s in all_staff]
-        
-        current_attendance = Attendance.query.filter(
-            Attendance.staff_id.in_(staff_ids),
-            Attendance.date >= start_date,
-            Attendance.date <= end_date
-        ).all() if staff_ids else []
-        
-        previous_attendance = Attendance.query.filter(
-            Attendance.staff_id.in_(staff_ids),
-            Attendance.date >= previous_start,
-            Attendance.date < start_date
-        ).all() if staff_ids else []
-        
-        improved_list = []
-        for s in all_staff:
-            if s.department == 'Management':
-                continue
-            current_late = sum(1 for a in current_attendance if a.staff_id == s.id and a.is_late)
-            prev_late = sum(1 for a in previous_attendance if a.staff_id == s.id and a.is_late)
-            if prev_late > current_late and prev_late > 0:
-                reduction = prev_late - current_late
-                improved_list.append({
-                    'name': s.name,
-                    'staff_id': s.staff_id,
-                    'branch': s.school.short_name or s.school.name if s.school else 'N/A',
-                    'department': s.department or '',
-                    'reduction': reduction,
-                    'current_late': current_late,
-                    'prev_late': prev_late
-                })
-        
-        improved_list.sort(key=lambda x: x['reduction'], reverse=True)
-        
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        worksheet = workbook.add_worksheet('Most Improved')
-        
-        headers = ['Rank', 'Staff ID', 'Name', 'Branch', 'Department', 'Reduction', 'Current Late', 'Previous Late']
-        header_format = workbook.add_format({'bold': True, 'bg_color': '#FF9800', 'font_color': 'white'})
-        
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-        
-        for idx, item in enumerate(improved_list, 1):
-            worksheet.write(idx, 0, idx)
-            worksheet.write(idx, 1, item['staff_id'] or '')
-            worksheet.write(idx, 2, item['name'])
-            worksheet.write(idx, 3, item['branch'])
-            worksheet.write(idx, 4, item['department'])
-            worksheet.write(idx, 5, item['reduction'])
-            worksheet.write(idx, 6, item['current_late'])
-            worksheet.write(idx, 7, item['prev_late'])
+
+@app.route('/analytics/perfect-attendance/download')
+@login_required
+def analytics_download_perfect_attendance():
+    """Download Perfect Attendance as Excel"""
+    try:
+        start_date, end_date, period_days, staff_filters = analytics_download_filters()
+        source = attendance_source(start_date)
+        total = db.func.count()
+        
+        # Working days per branch calendar
+        schools = School.query.filter(School.id.in_(db.session.query(Staff.school_id).filter(*staff_filters))).all()
+        branch_working_days = WorkCalendar(set(schools)).count_by_school(start_date, end_date)
+        
+        # Perfect = attended all working days with no late
+        rows = analytics_ranking_rows(
+            source, start_date, end_date, staff_filters,
+            total.label('days')
+        ).having(late_count_column(source) == 0).order_by(total.desc(), Staff.id).yield_per(ANALYTICS_DOWNLOAD_BATCH_SIZE)
+        perfect_list = (
+            analytics_ranking_item(r, days=r.days)
+            for r in rows if r.days >= branch_working_days.get(r.school_id, 0)
+        )
         
-        worksheet.set_column(0, 0, 8)
-        worksheet.set_column(1, 1, 15)
-        worksheet.set_column(2, 2, 25)
-        worksheet.set_column(3, 3, 20)
-        worksheet.set_column(4, 4, 15)
-        worksheet.set_column(5, 7, 12)
+        return send_xlsx(f"perfect_attendance_{start_date}_to_{end_date}.xlsx", [analytics_ranking_sheet('perfect_attendance', perfect_list)])
         
-        workbook.close()
-        output.seek(0)
+    except Exception as e:
+        flash(f'Error generating report: {str(e)}', 'error')
+        return redirect(url_for('analytics'))
+
+
+@app.route('/analytics/most-improved/download')
+@login_required
+def analytics_download_most_improved():
+    """Download Most Improved as Excel"""
+    try:
+        start_date, end_date, period_days, staff_filters = analytics_download_filters()
+        previous_start = start_date - timedelta(days=period_days)
+        source = attendance_source(previous_start)
+        current_late = late_count_column(source, source.date >= start_date)
+        prev_late = late_count_column(source, source.date < start_date)
+        
+        rows = analytics_ranking_rows(
+            source, previous_start, end_date, staff_filters,
+            current_late.label('current_late'), prev_late.label('prev_late')
+        ).having(
+            prev_late > current_late,
+            prev_late > 0
+        ).order_by((prev_late - current_late).desc(), Staff.id).yield_per(ANALYTICS_DOWNLOAD_BATCH_SIZE)
+        improved_list = (
+            analytics_ranking_item(r, reduction=r.prev_late - r.current_late, current_late=r.current_late, prev_late=r.prev_late)
+            for r in rows
+        )
         
-        filename = f"most_improved_{start_date}_to_{end_date}.xlsx"
-        return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return send_xlsx(f"most_improved_{start_date}_to_{end_date}.xlsx", [analytics_ranking_sheet('most_improved', improved_list)])
         
     except Exception as e:
         flash(f'Error generating report: {str(e)}', 'error')
@@ -3974,88 +6274,75 @@ def analytics_download_most_improved():
 def analytics_download_streaks():
     """Download On-Time Streaks as Excel"""
     try:
-        period = request.args.get('period', 'today')
-        school_id = request.args.get('school_id', '')
-        organization_id = request.args.get('organization_id', '')
-        department_filter = request.args.get('department', '')
-        
+        start_date, end_date, period_days, staff_filters = analytics_download_filters()
         today = date.today()
         
-        accessible_school_ids = current_user.get_accessible_school_ids()
-        staff_query = Staff.query.filter_by(is_active=True)
-        
-        if organization_id:
-            org_school_ids = [s.id for s in School.query.filter_by(organization_id=int(organization_id)).all()]
-            staff_query = staff_query.filter(Staff.school_id.in_(org_school_ids))
-        elif school_id:
-            staff_query = staff_query.filter_by(school_id=int(school_id))
-        elif current_user.role != 'super_admin' and accessible_school_ids:
-            staff_query = staff_query.filter(Staff.school_id.in_(accessible_school_ids))
-        
-        if department_filter:
-            staff_query = staff_query.filter_by(department=department_filter)
-        
-        all_staff = staff_query.all()
-        
-        streaks_list = []
-        for s in all_staff:
-            if s.department == 'Management':
-                continue
-            # Get attendance sorted by date descending
-            staff_att = Attendance.query.filter_by(staff_id=s.id).order_by(Attendance.date.desc()).limit(60).all()
-            
-            streak = 0
-            for a in staff_att:
-                if not a.is_late:
-                    streak += 1
-                else:
-                    break
-            
-            if streak >= 3:
-                streaks_list.append({
-                    'name': s.name,
-                    'staff_id': s.staff_id,
-                    'branch': s.school.short_name or s.school.name if s.school else 'N/A',
-                    'department': s.department or '',
-                    'streak': streak
-                })
+        staff_rows = analytics_ranking_staff(*staff_filters).order_by(Staff.id).all()
         
+        streaks = get_on_time_streaks([r.id for r in staff_rows])
+        streaks_list = [analytics_ranking_item(r, streak=streaks.get(r.id, 0)) for r in staff_rows if streaks.get(r.id, 0) >= 3]
         streaks_list.sort(key=lambda x: x['streak'], reverse=True)
         
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        worksheet = workbook.add_worksheet('On-Time Streaks')
-        
-        headers = ['Rank', 'Staff ID', 'Name', 'Branch', 'Department', 'Current Streak (days)']
-        header_format = workbook.add_format({'bold': True, 'bg_color': '#00BCD4', 'font_color': 'white'})
-        
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-        
-        for idx, item in enumerate(streaks_list, 1):
-            worksheet.write(idx, 0, idx)
-            worksheet.write(idx, 1, item['staff_id'] or '')
-            worksheet.write(idx, 2, item['name'])
-            worksheet.write(idx, 3, item['branch'])
-            worksheet.write(idx, 4, item['department'])
-            worksheet.write(idx, 5, item['streak'])
-        
-        worksheet.set_column(0, 0, 8)
-        worksheet.set_column(1, 1, 15)
-        worksheet.set_column(2, 2, 25)
-        worksheet.set_column(3, 3, 20)
-        worksheet.set_column(4, 4, 15)
-        worksheet.set_column(5, 5, 18)
+        return send_xlsx(f"on_time_streaks_{today}.xlsx", [analytics_ranking_sheet('attendance_streaks', streaks_list)])
         
-        workbook.close()
-        output.seek(0)
+    except Exception as e:
+        flash(f'Error generating report: {str(e)}', 'error')
+        return redirect(url_for('analytics'))
+
+
+@app.route('/analytics/workbook/download')
+@login_required
+def analytics_download_workbook():
+    """Download the whole analytics view (KPIs, chart series and full rankings) as one workbook"""
+    try:
+        data = compute_analytics(
+            period=request.args.get('period', '30'),
+            school_id=request.args.get('school_id', ''),
+            organization_id=request.args.get('organization_id', ''),
+            department_filter=request.args.get('department', ''),
+            start_date_param=request.args.get('start_date', ''),
+            end_date_param=request.args.get('end_date', '')
+        )
         
-        filename = f"on_time_streaks_{today}.xlsx"
-        return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        summary = [
+            ['Period', f"{data['start_date']} to {data['end_date']}"],
+            ['Total Staff', data['total_staff']],
+            ['Branches', data['branch_count']],
+            ['Attendance Records', data['total_records']],
+            ['Attendance Rate %', data['attendance_rate']],
+            ['Attendance Trend (pts)', data['attendance_trend']],
+            ['Punctuality Rate %', data['punctuality_rate']],
+            ['Punctuality Trend (pts)', data['punctuality_trend']],
+            ['On Time', data['on_time_count']],
+            ['Late', data['late_count']],
+            ['Avg Late (mins)', data['avg_late_minutes']],
+            ['Overtime', f"{data['overtime_hours']}h {data['overtime_mins']}m"],
+        ]
+        weekday_labels = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+        
+        sheets = [
+            XlsxSheet('Summary', ['Metric', 'Value'], summary, '#607D8B', [(0, 0, 25), (1, 1, 25)]),
+            XlsxSheet('Trend', ['Date', 'Attendance %', 'Punctuality %'],
+                      zip(data['trend_labels'], data['trend_data'], data['punctuality_data']), '#607D8B', [(0, 2, 15)]),
+            XlsxSheet('By Weekday', ['Day', 'Late', 'Absent'],
+                      zip(weekday_labels, data['late_by_day'], data['absent_by_day']), '#607D8B', [(0, 2, 12)]),
+            XlsxSheet('Peak Late Hours', ['Time', 'Late Arrivals'],
+                      zip(data['peak_late_labels'], data['peak_late_data']), '#607D8B', [(0, 1, 15)]),
+            XlsxSheet('Departments', ['Department', 'Punctuality %'],
+                      zip(data['department_labels'], data['department_data']), '#607D8B', [(0, 0, 25), (1, 1, 15)]),
+            XlsxSheet('Branches', ['Branch', 'Attendance %', 'Punctuality %'],
+                      zip(data['branch_labels'], data['branch_attendance'], data['branch_punctuality']), '#607D8B', [(0, 0, 20), (1, 2, 15)]),
+            XlsxSheet('Weekly Comparison', ['Day', 'This Week %', 'Last Week %'],
+                      zip(data['weekly_comparison_labels'], data['weekly_this_week'], data['weekly_last_week']), '#607D8B', [(0, 2, 15)]),
+        ] + [analytics_ranking_sheet(ranking, data[ranking]) for ranking in ANALYTICS_RANKING_SHEETS]
+        
+        return send_xlsx(f"analytics_{data['start_date']}_to_{data['end_date']}.xlsx", sheets)
         
     except Exception as e:
         flash(f'Error generating report: {str(e)}', 'error')
         return redirect(url_for('analytics'))
+
+
 # ============== ANALYTICS VIEW ALL ROUTES ==============
 
 @app.route('/analytics/top-performers')
@@ -4113,10 +6400,11 @@ def analytics_top_performers():
     all_staff = staff_query.all()
     staff_ids = [s.id for s in all_staff]
     
-    current_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= start_date,
-        Attendance.date <= end_date
+    source = attendance_source(start_date)
+    current_attendance = db.session.query(source).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= start_date,
+        source.date <= end_date
     ).all() if staff_ids else []
     
     performers = []
@@ -4202,10 +6490,11 @@ def analytics_needs_attention():
     all_staff = staff_query.all()
     staff_ids = [s.id for s in all_staff]
     
-    current_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= start_date,
-        Attendance.date <= end_date
+    source = attendance_source(start_date)
+    current_attendance = db.session.query(source).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= start_date,
+        source.date <= end_date
     ).all() if staff_ids else []
     
     attention_list = []
@@ -4289,10 +6578,11 @@ def analytics_early_arrivals():
     all_staff = staff_query.all()
     staff_ids = [s.id for s in all_staff]
     
-    current_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= start_date,
-        Attendance.date <= end_date
+    source = attendance_source(start_date)
+    current_attendance = db.session.query(source).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= start_date,
+        source.date <= end_date
     ).all() if staff_ids else []
     
     early_list = []
@@ -4373,9 +6663,6 @@ def analytics_perfect_attendance():
         start_date = today - timedelta(days=30)
         end_date = today
     
-    period_days = (end_date - start_date).days + 1
-    working_days = sum(1 for i in range(period_days) if (start_date + timedelta(days=i)).weekday() < 5)
-    
     accessible_school_ids = current_user.get_accessible_school_ids()
     staff_query = Staff.query.filter_by(is_active=True)
     
@@ -4393,19 +6680,22 @@ def analytics_perfect_attendance():
     all_staff = staff_query.all()
     staff_ids = [s.id for s in all_staff]
     
-    current_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= start_date,
-        Attendance.date <= end_date
+    source = attendance_source(start_date)
+    current_attendance = db.session.query(source).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= start_date,
+        source.date <= end_date
     ).all() if staff_ids else []
     
+    branch_working_days = WorkCalendar(set(s.school for s in all_staff if s.school)).count_by_school(start_date, end_date)
+    
     perfect_list = []
     for s in all_staff:
         if s.department == 'Management':
             continue
         staff_att = [a for a in current_attendance if a.staff_id == s.id]
         staff_on_time = [a for a in staff_att if not a.is_late]
-        if len(staff_att) >= working_days and len(staff_on_time) == len(staff_att) and len(staff_att) > 0:
+        if len(staff_att) >= branch_working_days.get(s.school_id, 0) and len(staff_on_time) == len(staff_att) and len(staff_att) > 0:
             perfect_list.append({
                 'staff': s,
                 'days': len(staff_att)
@@ -4490,16 +6780,17 @@ def analytics_most_improved():
     all_staff = staff_query.all()
     staff_ids = [s.id for s in all_staff]
     
-    current_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= start_date,
-        Attendance.date <= end_date
+    source = attendance_source(previous_start)
+    current_attendance = db.session.query(source).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= start_date,
+        source.date <= end_date
     ).all() if staff_ids else []
     
-    previous_attendance = Attendance.query.filter(
-        Attendance.staff_id.in_(staff_ids),
-        Attendance.date >= previous_start,
-        Attendance.date < start_date
+    previous_attendance = db.session.query(source).filter(
+        source.staff_id.in_(staff_ids),
+        source.date >= previous_start,
+        source.date < start_date
     ).all() if staff_ids else []
     
     improved_list = []
@@ -4557,17 +6848,11 @@ def analytics_streaks():
     all_staff = staff_query.all()
     
     streaks_list = []
+    streaks = get_on_time_streaks([s.id for s in all_staff if s.department != 'Management'])
     for s in all_staff:
         if s.department == 'Management':
             continue
-        staff_att = Attendance.query.filter_by(staff_id=s.id).order_by(Attendance.date.desc()).limit(60).all()
-        
-        streak = 0
-        for a in staff_att:
-            if not a.is_late:
-                streak += 1
-            else:
-                break
+        streak = streaks.get(s.id, 0)
         
         if streak >= 1:
             streaks_list.append({
@@ -4590,8 +6875,475 @@ def analytics_streaks():
 
 
 
+# ==================== EXPORT JOBS ====================
+
+# Export type -> download view that produces the file. The view runs unchanged in an
+# export worker process, inside a synthetic request authenticated as the submitting user.
+EXPORT_TYPES = {
+    'attendance': 'download_attendance',
+    'late': 'download_late_report',
+    'absent': 'download_absent_report',
+    'overtime': 'download_overtime_report',
+    'top-performers': 'analytics_download_top_performers',
+    'needs-attention': 'analytics_download_needs_attention',
+    'early-arrivals': 'analytics_download_early_arrivals',
+    'perfect-attendance': 'analytics_download_perfect_attendance',
+    'most-improved': 'analytics_download_most_improved',
+    'streaks': 'analytics_download_streaks',
+    'analytics-workbook': 'analytics_download_workbook',
+    'analytics-pdf': 'analytics_pdf',
+}
+# Files are written by the export worker and served by whichever web process gets the download,
+# so with more than one host EXPORT_DIR must be a directory they all share (e.g. a network mount);
+# the default is local to this machine
+EXPORT_DIR = os.environ.get('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'attendance_exports'))
+# At most this many export jobs run at once across every worker process; enforced by the claim
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 2))
+EXPORT_POLL_SECONDS = float(os.environ.get('EXPORT_POLL_SECONDS', 2))
+# Set to 0 when dedicated `flask export-worker` processes run the queue; otherwise a web
+# process that queues a job starts a short-lived worker process for it
+EXPORT_SPAWN_WORKER = os.environ.get('EXPORT_SPAWN_WORKER', '1') != '0'
+EXPORT_CLAIM_LOCK_KEY = 7310453
+EXPORT_TTL_SECONDS = int(os.environ.get('EXPORT_TTL_SECONDS', 6 * 3600))
+EXPORT_STALE_SECONDS = int(os.environ.get('EXPORT_STALE_SECONDS', 1800))
+# A running job's worker refreshes its heartbeat this often; four missed beats mean the worker died
+EXPORT_HEARTBEAT_SECONDS = int(os.environ.get('EXPORT_HEARTBEAT_SECONDS', 30))
+EXPORT_MAX_ACTIVE_PER_USER = int(os.environ.get('EXPORT_MAX_ACTIVE_PER_USER', 5))
+EXPORT_CLEANUP_INTERVAL = 300
+
+_export_process = None
+_export_lock = threading.Lock()
+_last_export_cleanup = [0.0]
+
+
+def make_export_job_key(user_id, export_type, params):
+    payload = json.dumps([user_id, export_type, sorted(params.items())])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def export_heartbeat_cutoff():
+    return datetime.utcnow() - timedelta(seconds=EXPORT_HEARTBEAT_SECONDS * 4)
+
+
+def is_export_job_stale(job):
+    """Running job whose worker died (restart, crash), or a job nobody claimed for EXPORT_STALE_SECONDS"""
+    if job.status == 'running':
+        last_seen = job.heartbeat_at or job.started_at
+        return not last_seen or last_seen < export_heartbeat_cutoff()
+    if job.status == 'pending':
+        return not job.created_at or (datetime.utcnow() - job.created_at).total_seconds() > EXPORT_STALE_SECONDS
+    return False
+
+
+@contextmanager
+def export_job_heartbeat(job_id):
+    """Refresh a running job's heartbeat from a side thread, so cleanup can tell a slow export from a dead worker"""
+    stop = threading.Event()
+    
+    def beat():
+        with app.app_context():
+            while not stop.wait(EXPORT_HEARTBEAT_SECONDS):
+                try:
+                    with db.engine.begin() as conn:
+                        conn.execute(db.update(ExportJob).where(
+                            ExportJob.id == job_id, ExportJob.status == 'running'
+                        ).values(heartbeat_at=datetime.utcnow()))
+                except Exception as e:
+                    app.logger.warning(f"Export job {job_id} heartbeat failed: {e}")
+    
+    thread = threading.Thread(target=beat, name=f'export-heartbeat-{job_id}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def claim_export_job():
+    """
+    Move the oldest pending job to running unless EXPORT_WORKERS jobs already run; returns its id.
+    The running count is checked inside the claiming UPDATE, and on PostgreSQL claims are also
+    serialized with an advisory lock, so the limit holds across all worker processes.
+    """
+    while True:
+        candidate = db.session.query(ExportJob.id).filter(ExportJob.status == 'pending').order_by(ExportJob.id).first()
+        db.session.commit()
+        if not candidate:
+            return None
+        now = datetime.utcnow()
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': EXPORT_CLAIM_LOCK_KEY})
+        running = db.aliased(ExportJob)
+        running_count = db.session.query(db.func.count(running.id)).filter(
+            running.status == 'running', db.func.coalesce(running.heartbeat_at, running.started_at) >= export_heartbeat_cutoff()
+        ).scalar_subquery()
+        claimed = ExportJob.query.filter(
+            ExportJob.id == candidate.id, ExportJob.status == 'pending', running_count < EXPORT_WORKERS
+        ).update({ExportJob.status: 'running', ExportJob.started_at: now, ExportJob.heartbeat_at: now}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return candidate.id
+        # Either every slot is taken or another worker won this job; only the latter is worth a retry
+        if ExportJob.query.filter(ExportJob.id == candidate.id, ExportJob.status == 'pending').count():
+            db.session.commit()
+            return None
+
+
+def run_export_job(job_id):
+    """Render a claimed job's download view and store its body on disk"""
+    with app.app_context():
+        file_path = None
+        try:
+            job = db.session.get(ExportJob, job_id)
+            if not job or job.status != 'running':
+                return
+            
+            user = db.session.get(User, job.created_by)
+            params = json.loads(job.params) if job.params else {}
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            
+            with app.test_request_context(query_string=params), export_job_heartbeat(job_id):
+                login_user(get_principal(user.id))
+                g.export_job_id = job.id
+                response = app.make_response(app.view_functions[EXPORT_TYPES[job.export_type]]())
+                try:
+                    if response.status_code != 200:
+                        raise ValueError('Export is not available for these parameters')
+                    disposition = response.headers.get('Content-Disposition', '')
+                    match = re.search(r'filename="?([^";]+)"?', disposition)
+                    filename = match.group(1) if match else f'{job.export_type}_export'
+                    meta = response.headers.get('X-Export-Meta')
+                    file_path = os.path.join(EXPORT_DIR, f'{job.id}_{secrets.token_hex(8)}{os.path.splitext(filename)[1]}')
+                    with open(file_path, 'wb') as f:
+                        for chunk in response.response:
+                            f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+                finally:
+                    response.close()
+            
+            job = db.session.get(ExportJob, job_id)
+            if not job:
+                # Removed while rendering (e.g. its owner was deleted); nobody can download the file
+                os.remove(file_path)
+                return
+            job.status = 'completed'
+            job.file_path = file_path
+            job.filename = filename
+            job.mimetype = response.mimetype
+            job.file_size = os.path.getsize(file_path)
+            job.meta = meta
+            job.completed_at = datetime.utcnow()
+            job.expires_at = job.completed_at + timedelta(seconds=EXPORT_TTL_SECONDS)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(ExportJob, job_id)
+            if job:
+                job.status = 'failed'
+                job.error = str(e)
+                job.completed_at = datetime.utcnow()
+                job.expires_at = job.completed_at + timedelta(seconds=EXPORT_TTL_SECONDS)
+                db.session.commit()
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+        finally:
+            db.session.remove()
+
+
+def run_export_worker(exit_when_idle=True):
+    """Claim and run export jobs until the queue is empty (spawned worker) or forever (dedicated worker)"""
+    with app.app_context():
+        try:
+            while True:
+                try:
+                    job_id = claim_export_job()
+                    if job_id:
+                        run_export_job(job_id)
+                        continue
+                    if exit_when_idle and not ExportJob.query.filter(ExportJob.status == 'pending').count():
+                        return
+                    cleanup_expired_exports()
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Export worker error: {e}")
+                time.sleep(EXPORT_POLL_SECONDS)
+        finally:
+            db.session.remove()
+
+
+def start_export_worker():
+    """Start a worker process for the queue unless the one this web process started is still running"""
+    global _export_process
+    if not EXPORT_SPAWN_WORKER:
+        return
+    with _export_lock:
+        if _export_process is None or not _export_process.is_alive():
+            # Spawned rather than forked so no DB connections or locks are inherited
+            _export_process = multiprocessing.get_context('spawn').Process(
+                target=run_export_worker, name='export-worker', daemon=False)
+            _export_process.start()
+
+
+def submit_export_job(user, export_type, params):
+    """
+    Create and queue an export job, or return the identical job already queued
+    or running for this user. Returns (job, created).
+    """
+    job_key = make_export_job_key(user.id, export_type, params)
+    with _export_lock:
+        existing = ExportJob.query.filter(
+            ExportJob.job_key == job_key,
+            ExportJob.status.in_(['pending', 'running'])
+        ).order_by(ExportJob.id.desc()).first()
+        if existing and not is_export_job_stale(existing):
+            return existing, False
+        job = ExportJob(job_key=job_key, export_type=export_type, params=json.dumps(params), created_by=user.id)
+        db.session.add(job)
+        db.session.commit()
+    start_export_worker()
+    return job, True
+
+
+def cleanup_expired_exports(force=False):
+    """Delete expired export files and their job rows; runs at most every EXPORT_CLEANUP_INTERVAL"""
+    now = time.time()
+    if not force and now - _last_export_cleanup[0] < EXPORT_CLEANUP_INTERVAL:
+        return 0
+    _last_export_cleanup[0] = now
+    
+    expired = ExportJob.query.filter(ExportJob.expires_at.isnot(None), ExportJob.expires_at < datetime.utcnow()).all()
+    stale = [job for job in ExportJob.query.filter(ExportJob.status.in_(['pending', 'running'])).all() if is_export_job_stale(job)]
+    for job in expired + stale:
+        if job.file_path and os.path.exists(job.file_path):
+            try:
+                os.remove(job.file_path)
+            except OSError:
+                pass
+        db.session.delete(job)
+    db.session.commit()
+    
+    pdf_cache_dir = get_pdf_cache_dir()
+    for name in os.listdir(pdf_cache_dir):
+        path = os.path.join(pdf_cache_dir, name)
+        try:
+            if now - os.path.getmtime(path) > EXPORT_TTL_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
+    return len(expired) + len(stale)
+
+
+def can_access_export_job(job):
+    return job.created_by == current_user.id or current_user.role == 'super_admin'
+
+
+@app.route('/api/exports', methods=['POST'])
+@login_required
+def api_create_export():
+    """Queue a report/analytics download: {"export_type": "late", "params": {...}}"""
+    data = request.get_json(silent=True) or {}
+    export_type = data.get('export_type', '')
+    if export_type not in EXPORT_TYPES:
+        return jsonify({'error': f'Unknown export type. Use one of: {", ".join(sorted(EXPORT_TYPES))}'}), 400
+    params = data.get('params') or {}
+    if not isinstance(params, dict):
+        return jsonify({'error': 'params must be an object'}), 400
+    params = {str(k): str(v) for k, v in params.items() if v not in (None, '')}
+    
+    cleanup_expired_exports()
+    
+    active = ExportJob.query.filter(
+        ExportJob.created_by == current_user.id,
+        ExportJob.status.in_(['pending', 'running'])
+    ).all()
+    job_key = make_export_job_key(current_user.id, export_type, params)
+    active = [job for job in active if not is_export_job_stale(job)]
+    if len(active) >= EXPORT_MAX_ACTIVE_PER_USER and not any(job.job_key == job_key for job in active):
+        return jsonify({'error': 'Too many exports in progress, please wait for one to finish'}), 429
+    
+    job, created = submit_export_job(current_user, export_type, params)
+    data = job.to_dict()
+    data['deduplicated'] = not created
+    return jsonify(data), 202
+
+
+@app.route('/api/exports/<int:job_id>')
+@login_required
+def api_export_job(job_id):
+    job = ExportJob.query.get_or_404(job_id)
+    if not can_access_export_job(job):
+        return jsonify({'error': 'Access denied'}), 403
+    return jsonify(job.to_dict())
+
+
+@app.route('/exports/<int:job_id>/download')
+@login_required
+def download_export(job_id):
+    job = ExportJob.query.get_or_404(job_id)
+    if not can_access_export_job(job):
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    if job.status != 'completed' or not job.file_path or not os.path.exists(job.file_path):
+        flash('This export is not ready or has expired', 'warning')
+        return redirect(url_for('reports'))
+    return send_file(job.file_path, mimetype=job.mimetype, as_attachment=True, download_name=job.filename)
+
+
+@app.cli.command('export-worker')
+@click.option('--once', is_flag=True, help='Run the queued jobs and exit instead of polling forever.')
+def export_worker_command(once):
+    """Run queued report and analytics export jobs."""
+    click.echo('Export worker started.')
+    run_export_worker(exit_when_idle=once)
+
+
+@app.cli.command('cleanup-exports')
+def cleanup_exports_command():
+    """Delete expired export files and abandoned export jobs"""
+    removed = cleanup_expired_exports(force=True)
+    print(f'Removed {removed} export job(s).')
+
+
+# ==================== RESPONSE COMPRESSION ====================
+
+# Bodies smaller than this go out as-is; streamed bodies are always compressed
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+COMPRESS_ZSTD_LEVEL = int(os.environ.get('COMPRESS_ZSTD_LEVEL', 3))
+COMPRESS_MIMETYPES = {
+    'text/html', 'text/css', 'text/csv', 'text/plain', 'text/xml', 'text/javascript',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml'
+}
+# Server preference when the client accepts several equally; brotli and zstd need their optional packages
+COMPRESS_ENCODINGS = tuple(encoding for encoding, available in (
+    ('zstd', zstandard is not None), ('br', brotli is not None), ('gzip', True)
+) if available)
+
+
+def compress_bytes(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compress(data)
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+class StreamCompressor:
+    """Compresses a streamed body chunk by chunk, flushing each so the client is never kept waiting"""
+    
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'zstd':
+            self.compressor = zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compressobj()
+        elif encoding == 'br':
+            self.compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+    
+    def chunk(self, data):
+        if self.encoding == 'zstd':
+            return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == 'br':
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self):
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+def compress_stream(body, encoding):
+    compressor = StreamCompressor(encoding)
+    try:
+        for data in body:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if data:
+                yield compressor.chunk(data)
+        yield compressor.finish()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def compressed_body(data, encoding, cacheable):
+    """Compressed bytes of data; views mark repeat payloads (response.cache_compressed) to reuse them"""
+    if not cacheable:
+        return compress_bytes(data, encoding)
+    cache = get_cache()
+    key = cache.key(cache_namespace(), 'compressed', encoding, hashlib.sha1(data).hexdigest())
+    return cache.get_or_set(key, lambda: compress_bytes(data, encoding))
+
+
+@app.after_request
+def compress_response(response):
+    """Negotiated zstd/brotli/gzip for text responses (Accept-Encoding, best quality wins)"""
+    if (response.status_code < 200 or response.status_code in (204, 206, 304) or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES
+            or 'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(COMPRESS_ENCODINGS)
+    if not encoding:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compressed_body(data, encoding, getattr(response, 'cache_compressed', False)))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from the identity representation the view tagged
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def get_staff_roster_for_api(school):
+    """The kiosk roster, cached until the branch's data changes or the day (and so shift cover) rolls over"""
+    cache = get_cache()
+    key = cache.key(cache_namespace(school.organization_id), 'roster', school.id, date.today())
+    return cache.get_or_set(key, lambda: get_staff_data_for_api(school), tags=(branch_cache_tag(school.id),))
+
+
 # ==================== API ====================
 
+def insert_attendance_sign_in(staff_id, record_date, sign_in_time, is_late, late_minutes):
+    """Create the staff member's row for the day unless one exists; True if this call created it"""
+    if is_archived_attendance(staff_id, record_date):
+        return False
+    values = dict(staff_id=staff_id, date=record_date, sign_in_time=sign_in_time, is_late=is_late, late_minutes=late_minutes)
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        statement = insert(Attendance).values(**values).on_conflict_do_nothing(index_elements=['staff_id', 'date'])
+        return db.session.execute(statement).rowcount == 1
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(Attendance).values(**values))
+        return True
+    except Exception:
+        # The unique (staff_id, date) index rejected a second row
+        return False
+
+
+def record_attendance_sign_out(staff_id, record_date, sign_out_time, overtime_minutes):
+    """Set the day's sign-out unless it already has one; True if this call set it"""
+    return Attendance.query.filter(
+        Attendance.staff_id == staff_id,
+        Attendance.date == record_date,
+        Attendance.sign_out_time.is_(None)
+    ).update({
+        Attendance.sign_out_time: sign_out_time,
+        Attendance.overtime_minutes: overtime_minutes
+    }, synchronize_session=False) == 1
+
+
 @app.route('/api/sync', methods=['GET', 'POST', 'OPTIONS'])
 def api_sync():
     if request.method == 'OPTIONS':
@@ -4622,7 +7374,7 @@ def api_sync():
     action = data.get('action')
     
     if action == 'get_staff' or (action is None and 'records' in data and len(data.get('records', [])) == 0):
-        staff_list_data = get_staff_data_for_api(school)
+        staff_list_data = get_staff_roster_for_api(school)
         response = jsonify({
             'success': True, 
             'staff': staff_list_data, 
@@ -4636,66 +7388,75 @@ def api_sync():
             }
         })
         response.headers.add('Access-Control-Allow-Origin', '*')
+        # Identical until the roster changes, so every kiosk of the branch reuses one compression
+        response.cache_compressed = True
         return response
     
     if action == 'sync_attendance' or (action is None and 'records' in data):
         records = data.get('records', [])
         synced = 0
         errors = []
+        cube_deltas = {'days': {}, 'buckets': {}}
+        lifetime_deltas = {}
+        # Kiosks retry and several workers ingest at once: rows are written with insert-if-absent
+        # and conditional updates, so a repeated sign-in or sign-out is applied exactly once
+        staff_codes = {str(record.get('staff_id')) for record in records}
+        staff_by_code = {s.staff_id: s for s in Staff.query.filter(
+            Staff.school_id == school.id, Staff.staff_id.in_(staff_codes)
+        ).all()} if staff_codes else {}
         for record in records:
             try:
-                staff = Staff.query.filter_by(staff_id=record['staff_id'], school_id=school.id).first()
+                staff = staff_by_code.get(str(record['staff_id']))
                 if not staff:
                     errors.append(f"Staff {record['staff_id']} not found")
                     continue
                 record_date = datetime.strptime(record['date'], '%Y-%m-%d').date()
-                attendance = Attendance.query.filter_by(staff_id=staff.id, date=record_date).first()
                 sign_in_time = record.get('sign_in_time') or record.get('timestamp')
                 sign_out_time = record.get('sign_out_time')
                 record_type = record.get('type', 'sign_in')
                 
-                if record_type == 'sign_in' or (sign_in_time and not attendance):
-                    if not attendance:
-                        if 'timestamp' in record:
-                            sign_in_datetime = datetime.strptime(record['timestamp'], '%Y-%m-%d %H:%M:%S')
-                        else:
-                            sign_in_datetime = datetime.strptime(f"{record['date']} {sign_in_time}", '%Y-%m-%d %H:%M:%S')
-                        
-                        # Use new helper function for late calculation
-                        is_late, late_minutes, scheduled_start = calculate_late_status(staff, sign_in_datetime, record_date)
-                        
+                if sign_in_time:
+                    if 'timestamp' in record:
+                        sign_in_datetime = datetime.strptime(record['timestamp'], '%Y-%m-%d %H:%M:%S')
+                    else:
+                        sign_in_datetime = datetime.strptime(f"{record['date']} {sign_in_time}", '%Y-%m-%d %H:%M:%S')
+                    
+                    is_late, late_minutes, scheduled_start = calculate_late_status(staff, sign_in_datetime, record_date)
+                    
+                    if insert_attendance_sign_in(staff.id, record_date, sign_in_datetime, is_late, late_minutes):
                         if is_late and staff.department != 'Management':
-                            staff.times_late += 1
-                        
-                        attendance = Attendance(
-                            staff_id=staff.id, 
-                            date=record_date, 
-                            sign_in_time=sign_in_datetime, 
-                            is_late=is_late, 
-                            late_minutes=late_minutes
-                        )
-                        db.session.add(attendance)
+                            Staff.query.filter_by(id=staff.id).update(
+                                {Staff.times_late: Staff.times_late + 1}, synchronize_session=False
+                            )
+                        if staff.is_active:
+                            add_cube_deltas(cube_deltas, staff.department, record_date, sign_in_datetime, present_count=1,
+                                            late_count=1 if is_late else 0, late_minutes_sum=late_minutes if is_late else 0)
+                        add_lifetime_deltas(lifetime_deltas, staff.id, total_days=1, late_days=1 if is_late else 0, late_minutes=late_minutes if is_late else 0)
                         synced += 1
                 
-                if record_type == 'sign_out' or (sign_out_time and attendance and not attendance.sign_out_time):
-                    if attendance and not attendance.sign_out_time:
-                        if 'timestamp' in record:
-                            sign_out_datetime = datetime.strptime(record['timestamp'], '%Y-%m-%d %H:%M:%S')
-                        else:
-                            sign_out_datetime = datetime.strptime(f"{record['date']} {sign_out_time}", '%Y-%m-%d %H:%M:%S')
-                        
-                        attendance.sign_out_time = sign_out_datetime
-                        
-                        # Use new helper function for overtime calculation
-                        overtime_minutes = calculate_overtime(staff, sign_out_datetime, record_date)
-                        attendance.overtime_minutes = overtime_minutes
-                        
+                if sign_out_time or (record_type == 'sign_out' and 'timestamp' in record):
+                    if 'timestamp' in record:
+                        sign_out_datetime = datetime.strptime(record['timestamp'], '%Y-%m-%d %H:%M:%S')
+                    else:
+                        sign_out_datetime = datetime.strptime(f"{record['date']} {sign_out_time}", '%Y-%m-%d %H:%M:%S')
+                    
+                    overtime_minutes = calculate_overtime(staff, sign_out_datetime, record_date)
+                    if record_attendance_sign_out(staff.id, record_date, sign_out_datetime, overtime_minutes):
+                        if staff.is_active:
+                            add_cube_deltas(cube_deltas, staff.department, record_date, overtime_minutes_sum=overtime_minutes)
+                        add_lifetime_deltas(lifetime_deltas, staff.id, overtime_minutes=overtime_minutes)
                         synced += 1
             except Exception as e:
                 errors.append(str(e))
         
+        apply_attendance_cube_deltas(school.id, cube_deltas)
+        apply_lifetime_deltas(lifetime_deltas)
         db.session.commit()
-        staff_list_data = get_staff_data_for_api(school)
+        if synced:
+            # Bumped in its own short transaction, so concurrent syncs of the branch never wait on its version row
+            invalidate_branch_data([school.id])
+            db.session.commit()
+        staff_list_data = get_staff_roster_for_api(school)
         response = jsonify({
             'success': True, 
             'synced': synced, 
@@ -4773,147 +7534,565 @@ def api_sync():
     return response, 400
 
 
+# ==================== MIGRATIONS ====================
+
+# An index a migration step creates; built CONCURRENTLY on Postgres so writes are not blocked
+IndexSpec = namedtuple('IndexSpec', 'name table columns unique', defaults=(False,))
+# MIGRATIONS is append-only: a shipped step never changes, fixes are new steps. Tolerant steps
+# skip statements that fail (the legacy "add if missing" changes, which older databases may
+# already have or SQLite may not support); other steps stop at their first error.
+Migration = namedtuple('Migration', 'version name statements tolerant')
+MIGRATION_LOCK_KEY = 7310451
+
+
+def merge_duplicate_attendance():
+    """
+    Fold duplicate (staff_id, date) rows into the one signed in first, so the unique index can be built.
+    Staff.times_late is adjusted here, but the cube and lifetime stats are rebuilt with the live
+    helpers, so this step relies on them reading the attendance table as it stands at this version
+    (nothing is archived before the migrations have run).
+    """
+    duplicates = db.session.query(Attendance.staff_id, Attendance.date).group_by(
+        Attendance.staff_id, Attendance.date
+    ).having(db.func.count(Attendance.id) > 1).subquery()
+    groups = {}
+    for a in Attendance.query.join(
+        duplicates, db.and_(Attendance.staff_id == duplicates.c.staff_id, Attendance.date == duplicates.c.date)
+    ).all():
+        groups.setdefault((a.staff_id, a.date), []).append(a)
+    if not groups:
+        return
+    touched = {}
+    late_removed = Counter()
+    for (staff_id, day), rows in groups.items():
+        rows.sort(key=lambda a: (a.sign_in_time is None, a.sign_in_time or datetime.max, a.id))
+        keeper = rows[0]
+        signed_out = [a for a in rows if a.sign_out_time]
+        if signed_out:
+            latest = max(signed_out, key=lambda a: a.sign_out_time)
+            keeper.sign_out_time = latest.sign_out_time
+            keeper.overtime_minutes = latest.overtime_minutes
+        for extra in rows[1:]:
+            # Each late duplicate sign-in counted towards times_late a second time
+            if extra.is_late:
+                late_removed[staff_id] += 1
+            db.session.delete(extra)
+        touched.setdefault(staff_id, set()).add(day)
+    db.session.flush()
+    staff_by_delta = {}
+    for staff_id, count in late_removed.items():
+        staff_by_delta.setdefault(count, []).append(staff_id)
+    for count, ids in staff_by_delta.items():
+        Staff.query.filter(Staff.id.in_(ids)).update({
+            Staff.times_late: db.case((Staff.times_late - count < 0, 0), else_=Staff.times_late - count)
+        }, synchronize_session=False)
+    school_dates = {}
+    for staff_id, school_id in db.session.query(Staff.id, Staff.school_id).filter(Staff.id.in_(list(touched))).all():
+        school_dates.setdefault(school_id, set()).update(touched[staff_id])
+    for school_id, days in school_dates.items():
+        refresh_attendance_cube_dates([school_id], days)
+    rebuild_lifetime_stats(fix=True)
+
+
+MIGRATIONS = [
+    Migration(1, 'baseline columns and tables', [
+        'ALTER TABLE staff DROP CONSTRAINT IF EXISTS staff_staff_id_key',
+        'ALTER TABLE staff ADD COLUMN IF NOT EXISTS email VARCHAR(120)',
+        'ALTER TABLE staff ADD COLUMN IF NOT EXISTS phone VARCHAR(20)',
+        'ALTER TABLE staff ADD COLUMN IF NOT EXISTS photo_url VARCHAR(500)',
+        'ALTER TABLE organizations ADD COLUMN IF NOT EXISTS hr_email VARCHAR(120)',
+        'ALTER TABLE organizations ADD COLUMN IF NOT EXISTS hr_email_name VARCHAR(100)',
+        'ALTER TABLE schools ADD COLUMN IF NOT EXISTS schedule_sat_start VARCHAR(5) DEFAULT \'08:00\'',
+        'ALTER TABLE schools ADD COLUMN IF NOT EXISTS schedule_sat_end VARCHAR(5) DEFAULT \'17:00\'',
+        'ALTER TABLE schools ADD COLUMN IF NOT EXISTS schedule_sun_start VARCHAR(5) DEFAULT \'08:00\'',
+        'ALTER TABLE schools ADD COLUMN IF NOT EXISTS schedule_sun_end VARCHAR(5) DEFAULT \'17:00\'',
+        'ALTER TABLE schools ADD COLUMN IF NOT EXISTS shift_mode_enabled BOOLEAN DEFAULT FALSE',
+        'ALTER TABLE schools ADD COLUMN IF NOT EXISTS time_format_24h BOOLEAN DEFAULT TRUE',
+        'ALTER TABLE schools ADD COLUMN IF NOT EXISTS work_days VARCHAR(50) DEFAULT \'mon,tue,wed,thu,fri\'',
+        'ALTER TABLE schools ADD COLUMN IF NOT EXISTS grace_period_minutes INTEGER DEFAULT 0',
+        'ALTER TABLE schools ALTER COLUMN work_days TYPE VARCHAR(50)',
+        'ALTER TABLE shifts ADD COLUMN IF NOT EXISTS grace_period_minutes INTEGER DEFAULT 0',
+        'ALTER TABLE shifts ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE',
+        'ALTER TABLE shifts ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+        'ALTER TABLE staff_shift_assignments ADD COLUMN IF NOT EXISTS effective_from DATE DEFAULT CURRENT_DATE',
+        'ALTER TABLE staff_shift_assignments ADD COLUMN IF NOT EXISTS effective_to DATE',
+        'ALTER TABLE staff_shift_assignments ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE',
+        'ALTER TABLE staff_shift_assignments ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+        'ALTER TABLE export_jobs ADD COLUMN IF NOT EXISTS meta TEXT',
+        'ALTER TABLE query_templates ADD COLUMN IF NOT EXISTS version INTEGER DEFAULT 1',
+        'ALTER TABLE staff ADD COLUMN IF NOT EXISTS query_count INTEGER DEFAULT 0',
+        'ALTER TABLE staff ADD COLUMN IF NOT EXISTS last_queried_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS ix_staff_queries_staff_sent ON staff_queries (staff_id, sent_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_staff_queries_sent ON staff_queries (sent_at, id)',
+        'ALTER TABLE staff_queries ADD COLUMN IF NOT EXISTS payload TEXT',
+        'ALTER TABLE staff_queries ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0',
+        'ALTER TABLE staff_queries ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP',
+        'ALTER TABLE staff_queries ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(40)',
+        'ALTER TABLE staff_queries ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP',
+        'ALTER TABLE staff_queries ADD COLUMN IF NOT EXISTS last_error TEXT',
+        'ALTER TABLE staff_queries ADD COLUMN IF NOT EXISTS delivered_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS ix_staff_queries_email_status ON staff_queries (email_status)',
+        '''CREATE TABLE IF NOT EXISTS departments (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            organization_id INTEGER NOT NULL REFERENCES organizations(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'ALTER TABLE schools ADD COLUMN organization_id INTEGER',
+        'ALTER TABLE schools ADD COLUMN logo_url VARCHAR(500)',
+        '''CREATE TABLE IF NOT EXISTS user_schools (
+            user_id INTEGER NOT NULL,
+            school_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, school_id),
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (school_id) REFERENCES schools(id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS query_templates (
+            id SERIAL PRIMARY KEY,
+            organization_id INTEGER NOT NULL REFERENCES organizations(id),
+            title VARCHAR(100) NOT NULL,
+            subject VARCHAR(200) NOT NULL,
+            body TEXT NOT NULL,
+            from_email VARCHAR(255),
+            created_by INTEGER NOT NULL REFERENCES users(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )''',
+        'ALTER TABLE query_templates ADD COLUMN IF NOT EXISTS from_email VARCHAR(255)',
+        '''CREATE TABLE IF NOT EXISTS staff_queries (
+            id SERIAL PRIMARY KEY,
+            staff_id INTEGER NOT NULL REFERENCES staff(id),
+            template_id INTEGER NOT NULL REFERENCES query_templates(id),
+            sent_by INTEGER NOT NULL REFERENCES users(id),
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            times_late_at_query INTEGER DEFAULT 0,
+            email_status VARCHAR(20) DEFAULT 'pending'
+        )''',
+        '''CREATE TABLE IF NOT EXISTS shifts (
+            id SERIAL PRIMARY KEY,
+            school_id INTEGER NOT NULL REFERENCES schools(id) ON DELETE CASCADE,
+            name VARCHAR(50) NOT NULL,
+            start_time VARCHAR(5) NOT NULL,
+            end_time VARCHAR(5) NOT NULL,
+            grace_period_minutes INTEGER DEFAULT 0,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS staff_shift_assignments (
+            id SERIAL PRIMARY KEY,
+            staff_id INTEGER NOT NULL REFERENCES staff(id) ON DELETE CASCADE,
+            shift_id INTEGER NOT NULL REFERENCES shifts(id) ON DELETE CASCADE,
+            effective_from DATE NOT NULL DEFAULT CURRENT_DATE,
+            effective_to DATE,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ], True),
+    Migration(2, 'indexes for attendance, staff and shift lookups', [
+        IndexSpec('ix_attendance_staff_date', 'attendance', ('staff_id', 'date')),
+        IndexSpec('ix_attendance_date', 'attendance', ('date',)),
+        IndexSpec('ix_staff_school_active', 'staff', ('school_id', 'is_active')),
+        IndexSpec('ix_staff_staff_id', 'staff', ('staff_id',)),
+        IndexSpec('ix_staff_shift_assignments_staff_active', 'staff_shift_assignments', ('staff_id', 'is_active')),
+    ], False),
+    Migration(3, 'one attendance row per staff member and day', [
+        merge_duplicate_attendance,
+        IndexSpec('uq_attendance_staff_date', 'attendance', ('staff_id', 'date'), unique=True),
+        # The unique index serves every lookup the plain one did
+        'DROP INDEX IF EXISTS ix_attendance_staff_date',
+    ], False),
+    # Fills the cube for databases upgraded from before it existed, and drops inactive staff from it
+    Migration(4, 'backfill the attendance cube', [rebuild_all_attendance_cubes], False),
+    Migration(5, 'backfill lifetime attendance counters', [backfill_lifetime_stats], False),
+    Migration(6, 'backfill per-staff query counters', [refresh_staff_query_counters], False),
+    Migration(7, 'export job heartbeats', [
+        'ALTER TABLE export_jobs ADD COLUMN heartbeat_at TIMESTAMP',
+    ], True),
+]
+
+
+@contextmanager
+def migration_lock():
+    """Keeps two processes deploying at once from running the same steps (Postgres only)"""
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(db.text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+
+
+def create_index(spec):
+    columns = ', '.join(spec.columns)
+    kind = 'UNIQUE INDEX' if spec.unique else 'INDEX'
+    # A partitioned table cannot be indexed CONCURRENTLY; the index cascades to each partition instead
+    if db.engine.dialect.name != 'postgresql' or (spec.table == 'attendance' and attendance_is_partitioned()):
+        db.session.execute(db.text(f'CREATE {kind} IF NOT EXISTS {spec.name} ON {spec.table} ({columns})'))
+        db.session.commit()
+        return
+    # CONCURRENTLY cannot run inside a transaction, and an interrupted build leaves an invalid index behind
+    db.session.commit()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        invalid = conn.execute(db.text(
+            'SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = :name AND NOT i.indisvalid'
+        ), {'name': spec.name}).first()
+        if invalid:
+            conn.execute(db.text(f'DROP INDEX CONCURRENTLY IF EXISTS {spec.name}'))
+        conn.execute(db.text(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS {spec.name} ON {spec.table} ({columns})'))
+
+
+def execute_migration_statement(statement):
+    if isinstance(statement, IndexSpec):
+        create_index(statement)
+    elif callable(statement):
+        statement()
+        db.session.commit()
+    else:
+        db.session.execute(db.text(statement))
+        db.session.commit()
+
+
+def get_applied_migrations():
+    return {version for (version,) in db.session.query(SchemaVersion.version).all()}
+
+
+def migration_is_heavy(migration):
+    """Whether a step builds indexes or rewrites data, which can take minutes on a large database"""
+    return any(isinstance(statement, IndexSpec) or callable(statement) for statement in migration.statements)
+
+
+def run_migrations(log=print, from_request=False):
+    """
+    Create missing tables, then apply each pending step in order and record it; returns the versions applied.
+    From a web request, heavy steps only run while attendance is still empty and partition maintenance
+    is left to the CLI, so no request holds long locks or outlives the worker timeout.
+    """
+    applied_now = []
+    with migration_lock():
+        db.create_all()
+        applied = get_applied_migrations()
+        for migration in MIGRATIONS:
+            if migration.version in applied:
+                continue
+            if from_request and migration_is_heavy(migration) and Attendance.query.first():
+                log(f'Migration {migration.version} ({migration.name}) left for `flask db-migrate`')
+                break
+            started = time.time()
+            for statement in migration.statements:
+                try:
+                    execute_migration_statement(statement)
+                except Exception:
+                    db.session.rollback()
+                    if not migration.tolerant:
+                        raise
+            db.session.add(SchemaVersion(version=migration.version, name=migration.name))
+            db.session.commit()
+            applied_now.append(migration.version)
+            log(f'Applied migration {migration.version}: {migration.name} ({int((time.time() - started) * 1000)} ms)')
+        if from_request or not ATTENDANCE_PARTITIONING or db.engine.dialect.name != 'postgresql':
+            return applied_now
+        if not partition_attendance_table(log=log):
+            created = ensure_attendance_partitions()
+            if created:
+                log(f'Created attendance partitions: {", ".join(created)}')
+    return applied_now
+
+
+@app.cli.command('db-migrate')
+@click.option('--status', is_flag=True, help='List applied and pending steps without applying anything.')
+def db_migrate_command(status):
+    """Apply pending schema migration steps"""
+    if status:
+        db.create_all()
+        applied = get_applied_migrations()
+        for migration in MIGRATIONS:
+            print(f"{migration.version:>4}  {'applied' if migration.version in applied else 'pending'}  {migration.name}")
+        return
+    if not run_migrations():
+        print('Schema is up to date.')
+
+
+def index_usage_checks():
+    """(label, query, index names that may serve it) for the hot report and sync lookups"""
+    today = date.today()
+    month_ago = today - timedelta(days=30)
+    return [
+        ('attendance of staff over a date range',
+         Attendance.query.filter(Attendance.staff_id.in_([1, 2, 3]), Attendance.date >= month_ago, Attendance.date <= today),
+         {'uq_attendance_staff_date'}),
+        ('attendance of one staff member on a day', Attendance.query.filter_by(staff_id=1, date=today), {'uq_attendance_staff_date'}),
+        ('attendance over a date range', Attendance.query.filter(Attendance.date >= month_ago, Attendance.date <= today), {'ix_attendance_date'}),
+        ('active staff of a branch', Staff.query.filter_by(school_id=1, is_active=True), {'ix_staff_school_active'}),
+        ('staff by staff ID within a branch', Staff.query.filter_by(staff_id='S001', school_id=1), {'ix_staff_staff_id', 'ix_staff_school_active'}),
+        ('active shift assignments of a staff member', StaffShiftAssignment.query.filter_by(staff_id=1, is_active=True),
+         {'ix_staff_shift_assignments_staff_active'}),
+    ]
+
+
+def partition_index_names(name):
+    """An index and, on a partitioned table, the per-partition indexes Postgres made from it"""
+    if db.engine.dialect.name != 'postgresql':
+        return {name}
+    children = db.session.execute(db.text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:name)'
+    ), {'name': name}).scalars().all()
+    return {name, *children}
+
+
+def explain_query(query):
+    """The database's plan for a query, one line per step"""
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name != 'postgresql':
+        return [row[-1] for row in db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql))]
+    with db.engine.connect() as conn:
+        # Small tables make the planner prefer sequential scans; ruling them out shows whether an index can serve the query
+        conn.execute(db.text('SET LOCAL enable_seqscan = off'))
+        plan = [row[0] for row in conn.execute(db.text('EXPLAIN ' + sql))]
+        conn.rollback()
+    return plan
+
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """EXPLAIN the hot report queries and fail if any of them cannot use its index"""
+    failures = 0
+    for label, query, indexes in index_usage_checks():
+        plan = explain_query(query)
+        used = sorted(name for name in indexes
+                      if any(index in line for index in partition_index_names(name) for line in plan))
+        if used:
+            print(f'OK       {label}: {", ".join(used)}')
+        else:
+            failures += 1
+            print(f'MISSING  {label}: expected {" or ".join(sorted(indexes))}')
+            for line in plan:
+                print(f'           {line}')
+    if failures:
+        raise SystemExit(1)
+
+
+# ==================== ATTENDANCE PARTITIONS ====================
+
+# Optional on Postgres: attendance becomes a table partitioned by month, so date-filtered reports
+# only read the months they cover. Once this is enabled `flask db-migrate` converts the table, and
+# `flask attendance-partitions --ensure` should run daily (e.g. from cron) to create upcoming months.
+ATTENDANCE_PARTITIONING = os.environ.get('ATTENDANCE_PARTITIONING', '0') == '1'
+ATTENDANCE_PARTITION_MONTHS_AHEAD = int(os.environ.get('ATTENDANCE_PARTITION_MONTHS_AHEAD', 3))
+ATTENDANCE_PARTITION_LOCK_KEY = 7310452
+# Catches rows of months that have no partition yet; moved out when their partition is created
+ATTENDANCE_DEFAULT_PARTITION = 'attendance_default'
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def attendance_partition_name(month):
+    return f'attendance_y{month.year}m{month.month:02d}'
+
+
+def parse_partition_month(value):
+    """'2025-03' -> date(2025, 3, 1)"""
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+def attendance_is_partitioned():
+    if db.engine.dialect.name != 'postgresql':
+        return False
+    return db.session.execute(db.text(
+        "SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass('attendance')"
+    )).scalar() == 'p'
+
+
+def lock_attendance_partitions():
+    """Serialises partition changes until the current transaction ends"""
+    db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': ATTENDANCE_PARTITION_LOCK_KEY})
+
+
+def table_exists(name):
+    return db.session.execute(db.text('SELECT to_regclass(:name)'), {'name': name}).scalar() is not None
+
+
+def attendance_partition_attached(name):
+    """True if attached, False if a standalone table, None if there is no such table"""
+    return db.session.execute(db.text(
+        'SELECT c.relispartition FROM pg_class c WHERE c.oid = to_regclass(:name)'
+    ), {'name': name}).scalar()
+
+
+def get_attendance_partitions():
+    """(name, bounds, estimated rows) of the attached partitions, then the detached monthly tables"""
+    attached = db.session.execute(db.text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('attendance') ORDER BY c.relname"
+    )).all()
+    detached = db.session.execute(db.text(
+        "SELECT c.relname, 'DETACHED', c.reltuples::bigint FROM pg_class c "
+        "WHERE c.relname ~ '^attendance_y[0-9]{4}m[0-9]{2}$' AND c.relkind = 'r' AND NOT c.relispartition "
+        "ORDER BY c.relname"
+    )).all()
+    return [tuple(row) for row in attached + detached]
+
+
+def attach_attendance_month(name, month):
+    """Attach a standalone table as the partition of a month, first taking over that month's rows
+    from the default partition (Postgres refuses the attach while they are there)"""
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    db.session.execute(db.text(
+        f'INSERT INTO {name} SELECT * FROM {ATTENDANCE_DEFAULT_PARTITION} '
+        'WHERE date >= :start AND date < :end ON CONFLICT DO NOTHING'
+    ), bounds)
+    moved = db.session.execute(db.text(
+        f'DELETE FROM {ATTENDANCE_DEFAULT_PARTITION} WHERE date >= :start AND date < :end'
+    ), bounds).rowcount
+    db.session.execute(db.text(
+        f"ALTER TABLE attendance ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{bounds['start'].isoformat()}') TO ('{bounds['end'].isoformat()}')"
+    ))
+    if moved:
+        db.session.execute(db.text(f'ANALYZE {name}, {ATTENDANCE_DEFAULT_PARTITION}'))
+
+
+def create_attendance_partition(month):
+    """Add the partition of a month unless it exists; True if it was created. The caller commits."""
+    name = attendance_partition_name(month)
+    if table_exists(name):
+        return False
+    db.session.execute(db.text(f'CREATE TABLE {name} (LIKE attendance INCLUDING DEFAULTS)'))
+    attach_attendance_month(name, month)
+    return True
+
+
+def ensure_attendance_partitions(months_ahead=None):
+    """Create the partitions of this month, the next few and any month parked in the default
+    partition; returns the names created"""
+    if not attendance_is_partitioned():
+        return []
+    months_ahead = ATTENDANCE_PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    current = month_start(date.today())
+    lock_attendance_partitions()
+    months = {add_months(current, offset) for offset in range(months_ahead + 1)}
+    months.update(db.session.execute(db.text(
+        f"SELECT DISTINCT date_trunc('month', date)::date FROM {ATTENDANCE_DEFAULT_PARTITION}"
+    )).scalars().all())
+    created = [attendance_partition_name(month) for month in sorted(months) if create_attendance_partition(month)]
+    db.session.commit()
+    return created
+
+
+def partition_attendance_table(months_ahead=None, log=print):
+    """Rebuild attendance as a table partitioned by month, in one transaction; False if it already is.
+    The table is locked while its rows are copied, so large databases should do this in a quiet hour."""
+    if db.engine.dialect.name != 'postgresql':
+        raise RuntimeError('Attendance partitioning needs PostgreSQL')
+    if attendance_is_partitioned():
+        return False
+    months_ahead = ATTENDANCE_PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    started = time.time()
+    lock_attendance_partitions()
+    db.session.execute(db.text('LOCK TABLE attendance IN ACCESS EXCLUSIVE MODE'))
+    sequence = db.session.execute(db.text("SELECT pg_get_serial_sequence('attendance', 'id')")).scalar()
+    first_day = db.session.query(db.func.min(Attendance.date)).scalar() or date.today()
+    for statement in [
+        'ALTER TABLE attendance RENAME TO attendance_unpartitioned',
+        'ALTER TABLE attendance_unpartitioned RENAME CONSTRAINT attendance_pkey TO attendance_unpartitioned_pkey',
+        'ALTER INDEX IF EXISTS uq_attendance_staff_date RENAME TO uq_attendance_unpartitioned_staff_date',
+        'ALTER INDEX IF EXISTS ix_attendance_date RENAME TO ix_attendance_unpartitioned_date',
+        'CREATE TABLE attendance (LIKE attendance_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (date)',
+        # Keys of a partitioned table must include the partition column
+        'ALTER TABLE attendance ADD PRIMARY KEY (id, date)',
+        'ALTER TABLE attendance ADD FOREIGN KEY (staff_id) REFERENCES staff (id)',
+        'CREATE UNIQUE INDEX uq_attendance_staff_date ON attendance (staff_id, date)',
+        'CREATE INDEX ix_attendance_date ON attendance (date)',
+        f'CREATE TABLE {ATTENDANCE_DEFAULT_PARTITION} PARTITION OF attendance DEFAULT',
+    ]:
+        db.session.execute(db.text(statement))
+    month = month_start(first_day)
+    last = add_months(month_start(date.today()), months_ahead)
+    while month <= last:
+        db.session.execute(db.text(
+            f"CREATE TABLE {attendance_partition_name(month)} PARTITION OF attendance "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        ))
+        month = add_months(month, 1)
+    copied = db.session.execute(db.text('INSERT INTO attendance SELECT * FROM attendance_unpartitioned')).rowcount
+    if sequence:
+        db.session.execute(db.text(f'ALTER SEQUENCE {sequence} OWNED BY attendance.id'))
+    db.session.execute(db.text('DROP TABLE attendance_unpartitioned'))
+    db.session.commit()
+    # The new partitions have no planner statistics until analysed
+    db.session.execute(db.text('ANALYZE attendance'))
+    db.session.commit()
+    log(f'Partitioned attendance by month: {copied} rows from {first_day} ({int((time.time() - started) * 1000)} ms)')
+    return True
+
+
+def invalidate_all_branch_data():
+    invalidate_branch_data([school_id for (school_id,) in db.session.query(School.id).all()])
+
+
+@app.cli.command('attendance-partitions')
+@click.option('--convert', is_flag=True, help='Turn the attendance table into monthly partitions (locks it while copying).')
+@click.option('--ensure', is_flag=True, help='Create the partitions of this month and the months ahead.')
+@click.option('--months-ahead', type=int, default=None, help='Months ahead to create (default ATTENDANCE_PARTITION_MONTHS_AHEAD).')
+@click.option('--detach', 'detach_month', default=None, help='Detach the partition of a month (YYYY-MM); its rows stay in a standalone table.')
+@click.option('--attach', 'attach_month', default=None, help='Attach a previously detached month (YYYY-MM) again.')
+def attendance_partitions_command(convert, ensure, months_ahead, detach_month, attach_month):
+    """List, create, detach and attach the monthly attendance partitions (PostgreSQL)"""
+    if db.engine.dialect.name != 'postgresql':
+        print('Attendance partitioning needs PostgreSQL.')
+        raise SystemExit(1)
+    if convert:
+        with migration_lock():
+            if not partition_attendance_table(months_ahead):
+                print('Attendance is already partitioned.')
+    if not attendance_is_partitioned():
+        print('Attendance is not partitioned; run with --convert first.')
+        raise SystemExit(1)
+    if ensure:
+        created = ensure_attendance_partitions(months_ahead)
+        print(f'Created {", ".join(created)}' if created else 'All partitions exist.')
+    if detach_month:
+        name = attendance_partition_name(parse_partition_month(detach_month))
+        if not attendance_partition_attached(name):
+            print(f'{name} is not an attached partition.')
+            raise SystemExit(1)
+        lock_attendance_partitions()
+        db.session.execute(db.text(f'ALTER TABLE attendance DETACH PARTITION {name}'))
+        invalidate_all_branch_data()
+        db.session.commit()
+        print(f'Detached {name}; reports no longer read it, the daily cube and lifetime stats keep its totals.')
+    if attach_month:
+        month = parse_partition_month(attach_month)
+        name = attendance_partition_name(month)
+        if attendance_partition_attached(name) is not False:
+            print(f'{name} is not a detached partition.')
+            raise SystemExit(1)
+        lock_attendance_partitions()
+        attach_attendance_month(name, month)
+        invalidate_all_branch_data()
+        db.session.commit()
+        print(f'Attached {name}.')
+    for name, bounds, rows in get_attendance_partitions():
+        print(f'{name:<22} ~{max(rows, 0):>9} rows  {bounds}')
+
+
 # ==================== INIT DB ====================
 
 @app.route('/init-db')
 def init_db():
     try:
-        db.create_all()
-        try:
-            db.session.execute(db.text('ALTER TABLE staff DROP CONSTRAINT IF EXISTS staff_staff_id_key'))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        migrations = [
-            'ALTER TABLE staff ADD COLUMN IF NOT EXISTS email VARCHAR(120)',
-            'ALTER TABLE staff ADD COLUMN IF NOT EXISTS phone VARCHAR(20)',
-            'ALTER TABLE staff ADD COLUMN IF NOT EXISTS photo_url VARCHAR(500)',
-            'ALTER TABLE organizations ADD COLUMN IF NOT EXISTS hr_email VARCHAR(120)',
-            'ALTER TABLE organizations ADD COLUMN IF NOT EXISTS hr_email_name VARCHAR(100)',
-            'ALTER TABLE schools ADD COLUMN IF NOT EXISTS schedule_sat_start VARCHAR(5) DEFAULT \'08:00\'',
-            'ALTER TABLE schools ADD COLUMN IF NOT EXISTS schedule_sat_end VARCHAR(5) DEFAULT \'17:00\'',
-            'ALTER TABLE schools ADD COLUMN IF NOT EXISTS schedule_sun_start VARCHAR(5) DEFAULT \'08:00\'',
-            'ALTER TABLE schools ADD COLUMN IF NOT EXISTS schedule_sun_end VARCHAR(5) DEFAULT \'17:00\'',
-            'ALTER TABLE schools ADD COLUMN IF NOT EXISTS shift_mode_enabled BOOLEAN DEFAULT FALSE',
-            'ALTER TABLE schools ADD COLUMN IF NOT EXISTS time_format_24h BOOLEAN DEFAULT TRUE',
-            'ALTER TABLE schools ADD COLUMN IF NOT EXISTS work_days VARCHAR(50) DEFAULT \'mon,tue,wed,thu,fri\'',
-            'ALTER TABLE schools ADD COLUMN IF NOT EXISTS grace_period_minutes INTEGER DEFAULT 0',
-            'ALTER TABLE schools ALTER COLUMN work_days TYPE VARCHAR(50)',
-            'ALTER TABLE shifts ADD COLUMN IF NOT EXISTS grace_period_minutes INTEGER DEFAULT 0',
-            'ALTER TABLE shifts ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE',
-            'ALTER TABLE shifts ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
-            'ALTER TABLE staff_shift_assignments ADD COLUMN IF NOT EXISTS effective_from DATE DEFAULT CURRENT_DATE',
-            'ALTER TABLE staff_shift_assignments ADD COLUMN IF NOT EXISTS effective_to DATE',
-            'ALTER TABLE staff_shift_assignments ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE',
-            'ALTER TABLE staff_shift_assignments ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
-        ]
-        for sql in migrations:
-            try:
-                db.session.execute(db.text(sql))
-                db.session.commit()
-            except:
-                db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('''CREATE TABLE IF NOT EXISTS departments (
-                id SERIAL PRIMARY KEY, 
-                name VARCHAR(100) NOT NULL, 
-                organization_id INTEGER NOT NULL REFERENCES organizations(id), 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )'''))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('ALTER TABLE schools ADD COLUMN organization_id INTEGER'))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('ALTER TABLE schools ADD COLUMN logo_url VARCHAR(500)'))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('''CREATE TABLE IF NOT EXISTS user_schools (
-                user_id INTEGER NOT NULL, 
-                school_id INTEGER NOT NULL, 
-                PRIMARY KEY (user_id, school_id), 
-                FOREIGN KEY (user_id) REFERENCES users(id), 
-                FOREIGN KEY (school_id) REFERENCES schools(id)
-            )'''))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('''CREATE TABLE IF NOT EXISTS query_templates (
-                id SERIAL PRIMARY KEY, 
-                organization_id INTEGER NOT NULL REFERENCES organizations(id), 
-                title VARCHAR(100) NOT NULL, 
-                subject VARCHAR(200) NOT NULL, 
-                body TEXT NOT NULL, 
-                from_email VARCHAR(255),
-                created_by INTEGER NOT NULL REFERENCES users(id), 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
-                is_active BOOLEAN DEFAULT TRUE
-            )'''))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('ALTER TABLE query_templates ADD COLUMN IF NOT EXISTS from_email VARCHAR(255)'))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('''CREATE TABLE IF NOT EXISTS staff_queries (
-                id SERIAL PRIMARY KEY, 
-                staff_id INTEGER NOT NULL REFERENCES staff(id), 
-                template_id INTEGER NOT NULL REFERENCES query_templates(id), 
-                sent_by INTEGER NOT NULL REFERENCES users(id), 
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
-                times_late_at_query INTEGER DEFAULT 0, 
-                email_status VARCHAR(20) DEFAULT 'pending'
-            )'''))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('''CREATE TABLE IF NOT EXISTS shifts (
-                id SERIAL PRIMARY KEY, 
-                school_id INTEGER NOT NULL REFERENCES schools(id) ON DELETE CASCADE, 
-                name VARCHAR(50) NOT NULL, 
-                start_time VARCHAR(5) NOT NULL, 
-                end_time VARCHAR(5) NOT NULL, 
-                grace_period_minutes INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )'''))
-            db.session.commit()
-        except:
-            db.session.rollback()
-        
-        try:
-            db.session.execute(db.text('''CREATE TABLE IF NOT EXISTS staff_shift_assignments (
-                id SERIAL PRIMARY KEY, 
-                staff_id INTEGER NOT NULL REFERENCES staff(id) ON DELETE CASCADE, 
-                shift_id INTEGER NOT NULL REFERENCES shifts(id) ON DELETE CASCADE, 
-                effective_from DATE NOT NULL DEFAULT CURRENT_DATE,
-                effective_to DATE,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )'''))
-            db.session.commit()
-        except:
-            db.session.rollback()
+        run_migrations(log=app.logger.info, from_request=True)
+        pending = [m.version for m in MIGRATIONS if m.version not in get_applied_migrations()]
         
         if not SystemSettings.query.first():
             settings = SystemSettings(company_name='Wakato Technologies')
@@ -4929,6 +8108,8 @@ def init_db():
                 Department.create_defaults(org.id)
         
         db.session.commit()
+        if pending:
+            return f'Database initialized, but migration(s) {", ".join(map(str, pending))} build indexes or rewrite data; run `flask db-migrate` to apply them.'
         return 'Database initialized successfully! All tables and columns ready.'
     except Exception as e:
         return f'Error: {str(e)}'